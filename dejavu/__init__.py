@@ -42,8 +42,10 @@ from geniusql import logic, logicfuncs, _AttributeDocstrings
 from dejavu import logflags
 from dejavu import analysis
 sort = analysis.sort
+sort_key = analysis.sort_key
 
-from dejavu.sandboxes import Sandbox
+from dejavu.sandboxes import Sandbox, SandboxPool
+from dejavu.sandboxes import AsyncSandbox, ReadOnlySandbox
 from dejavu.schemas import *
 from dejavu.units import *
 
@@ -1,6 +1,7 @@
 """Analysis tools for dejavu Units."""
 
-__all__ = ['COUNT', 'CrossTab', 'SUM', 'sort']
+__all__ = ['AVG', 'Aggregator', 'COUNT', 'CrossTab', 'Descending', 'MAX',
+           'MIN', 'SUM', 'column_key', 'sort', 'sort_key']
 
 def sort(attrs):
     """Return a 'cmp' function for list.sort() for Units from attrs.
@@ -37,6 +38,56 @@ def sort(attrs):
     return sort_func
 
 
+class Descending(object):
+    """A sort key which orders before other Descending keys if it is greater.
+    
+    Wrap the key of a column in one of these to sort that column in
+    descending order within an otherwise ascending composite key.
+    """
+    
+    __slots__ = ['key']
+    
+    def __init__(self, key):
+        self.key = key
+    
+    def __cmp__(self, other):
+        return cmp(other.key, self.key)
+
+
+def column_key(value, descending=False):
+    """Return a sort key for one column value, in the manner of sort.
+    
+    None values sort before all others (after, if descending).
+    """
+    key = (value is not None, value)
+    if descending:
+        return Descending(key)
+    return key
+
+
+def sort_key(attrs):
+    """Return a 'key' function for list.sort() for Units from attrs.
+    
+    The attrs sequence is as for sort, and Units are ordered the same way;
+    but a key function is called only once per Unit, not once per
+    comparison, and can be used to select the first n Units with heapq.
+    """
+    if isinstance(attrs, basestring):
+        attrs = [attrs]
+    attrs = [(attr.split(" ", 1)[0], attr.endswith(" DESC"))
+             for attr in attrs]
+    
+    def key(unit):
+        values = []
+        for attr, descending in attrs:
+            v = getattr(unit, attr)
+            if callable(v):
+                v = v()
+            values.append(column_key(v, descending))
+        return tuple(values)
+    return key
+
+
 def _force_function(attr):
     """If attr is callable, return it, else wrap it in a function."""
     if callable(attr):
@@ -48,6 +99,24 @@ def _force_function(attr):
     return g
 
 
+def _fold(function, attribute, combine):
+    """Return an aggregate function which combines the non-None values."""
+    value = _force_function(attribute)
+    
+    def aggfunc(obj, current_agg_value):
+        a, b = current_agg_value, value(obj)
+        if a is None:
+            return b
+        if b is None:
+            return a
+        return combine(a, b)
+    
+    # Describe the aggregate, so that stores may translate it (to SQL).
+    aggfunc.function = function
+    aggfunc.attribute = attribute
+    return aggfunc
+
+
 def SUM(attribute):
     """sum(attribute) -> create an aggregate function for use with crosstab().
     
@@ -55,28 +124,115 @@ def SUM(attribute):
     all objects in self.source, or a further callable to which each obj
     is passed and evaluated.
     """
-    if callable(attribute):
-        def aggfunc(obj, current_agg_value):
-            a, b = current_agg_value, attribute(obj)
-            if a is None:
-                return b
-            if b is None:
-                return a
-            return a + b
-    else:
-        def aggfunc(obj, current_agg_value):
-            a, b = current_agg_value, getattr(obj, attribute)
-            if a is None:
-                return b
-            if b is None:
-                return a
-            return a + b
+    return _fold('sum', attribute, lambda a, b: a + b)
+
+
+def MIN(attribute):
+    """min(attribute) -> create an aggregate function for use with crosstab().
+    
+    'attribute' is an attribute name or callable, as for SUM.
+    """
+    return _fold('min', attribute, min)
+
+
+def MAX(attribute):
+    """max(attribute) -> create an aggregate function for use with crosstab().
+    
+    'attribute' is an attribute name or callable, as for SUM.
+    """
+    return _fold('max', attribute, max)
+
+
+def AVG(attribute):
+    """avg(attribute) -> create an aggregate function for use with crosstab().
+    
+    'attribute' is an attribute name or callable, as for SUM. The running
+    value of the aggregate is a (total, count) pair of the non-None values;
+    the finish attribute of the returned function turns it into the mean.
+    """
+    value = _force_function(attribute)
+    
+    def aggfunc(obj, current_agg_value):
+        total, n = current_agg_value or (None, 0)
+        b = value(obj)
+        if b is None:
+            return total, n
+        if total is None:
+            return b, 1
+        return total + b, n + 1
+    
+    def finish(current_agg_value):
+        total, n = current_agg_value or (None, 0)
+        if not n:
+            return None
+        if isinstance(total, (int, long)):
+            total = float(total)
+        return total / n
+    
+    aggfunc.function = 'avg'
+    aggfunc.attribute = attribute
+    aggfunc.finish = finish
     return aggfunc
 
 
 def COUNT(obj, current_agg_value):
     """count -> an aggregate function for use with crosstab()."""
     return (current_agg_value or 0) + 1
+COUNT.function = 'count'
+COUNT.attribute = None
+
+
+class Aggregator(object):
+    """Incremental hash aggregation of objects into groups.
+    
+    Example:
+        >>> agg = analysis.Aggregator(['Legs'], {'n': analysis.COUNT})
+        >>> for animal in box.xrecall(Animal):
+        ...     agg.add(animal)
+        >>> agg.results()
+        {(4,): {'n': 12}, (2,): {'n': 3}}
+    
+    Only the running value of each aggregate is kept for each group,
+    so the objects themselves may be streamed through add().
+    """
+    
+    def __init__(self, group_by=(), aggregates=None):
+        """Aggregator(group_by=(), aggregates={'count': COUNT})
+        
+        group_by: a sequence of attribute names or callables, whose
+            values form the key of each group.
+        
+        aggregates: a dict of {name: aggregate function}, such as
+            {'n': COUNT, 'total': SUM('Price')}.
+        """
+        self.group_by = [_force_function(group) for group in group_by]
+        if aggregates is None:
+            aggregates = {'count': COUNT}
+        self.aggregates = aggregates.items()
+        # {group key: {name: running value}}
+        self.groups = {}
+    
+    def add(self, obj):
+        """Fold the given object into the running value of its group."""
+        key = tuple([group(obj) for group in self.group_by])
+        values = self.groups.get(key)
+        if values is None:
+            values = self.groups[key] = {}
+        for name, aggfunc in self.aggregates:
+            values[name] = aggfunc(obj, values.get(name))
+    
+    def results(self):
+        """Return a dict of {group key: {name: aggregate value}}."""
+        finishers = [(name, aggfunc.finish)
+                     for name, aggfunc in self.aggregates
+                     if getattr(aggfunc, "finish", None)]
+        results = {}
+        for key, values in self.groups.iteritems():
+            values = values.copy()
+            for name, finish in finishers:
+                values[name] = finish(values.get(name))
+            results[key] = values
+        return results
 
 
 class CrossTab(list):
@@ -135,6 +291,12 @@ class CrossTab(list):
             row = rows.setdefault(key, {})
             row[col_key] = aggfunc(obj, row.get(col_key))
         
+        finish = getattr(aggfunc, "finish", None)
+        if finish is not None:
+            for row in rows.itervalues():
+                for col_key, value in row.items():
+                    row[col_key] = finish(value)
+        
         column_keys = column_keys.keys()
         column_keys.sort()
         return rows, column_keys
@@ -119,19 +119,14 @@ class UnitCollection(TemporaryUnit):
     def units(self, quota=None):
         cls = self.unit_class()
         
-        output = []
         self.acquire()
         try:
-            for i, eachID in enumerate(self.Members):
-                if quota and i >= quota:
-                    break
-                filter = dict(zip(cls.identifiers, eachID))
-                unit = self.sandbox.unit(cls, **filter)
-                if unit:
-                    output.append(unit)
+            members = self.Members
+            if quota:
+                members = members[:quota]
+            return self.sandbox.units_by_id(cls, members)
         finally:
             self.release()
-        return output
     
     def xdict(self, attr):
         """Return a dictionary of {Unit.attr: [Unit, Unit, ...]}."""
@@ -478,13 +473,9 @@ class RuleProcessor(object):
                     if id not in mem:
                         mem.append(id)
             else:
-                newset = []
-                for id in mem:
-                    filter = dict(zip(cls.identifiers, id))
-                    unit = self.sandbox.unit(cls, **filter)
-                    if unit and expr(unit):
-                        newset.append(id)
-                A.Members = newset
+                A.Members = [unit.identity() for unit
+                             in self.sandbox.units_by_id(cls, mem)
+                             if expr(unit)]
         finally:
             A.release()
     
@@ -18,6 +18,10 @@ class UnrecallableError(DejavuError):
     """Exception raised when a Unit was sought but not recalled."""
     pass
 
+class ReadOnlyError(DejavuError):
+    """Exception raised when changing Units of a read-only Sandbox."""
+    pass
+
 class StorageWarning(UserWarning):
     """Warning about functionality which is not supported by all SM's."""
     pass
@@ -110,6 +110,8 @@ class Converter(object):
 
 def unit_to_dict(unit):
     """Return a JSON-able dict for the given Dejavu Unit instance."""
+    if unit._deferred:
+        unit._undefer(*unit._deferred)
     d = unit._properties.copy()
     d['__dejavu.class__'] = unit.__class__.__name__
     return d
@@ -121,16 +123,11 @@ def dict_to_unit(d, store=None, cls=None):
         clsname = d['__dejavu.class__']
         cls = store.class_by_name(clsname)
     
-    unit = cls()
-    # Set _properties directly to avoid __set__ overhead.
-    # As always, this must be FULLY populated, even if some values are None.
-    params = {}
+    params = []
     for k in cls.properties:
         v = d.get(k, None)
         # The JSON serializer stores tuples as lists
         if v is not None and getattr(cls, k).type is tuple:
             v = tuple(v)
-        params[k] = v
-    unit._properties = params
-    unit.cleanse()
-    return unit
+        params.append(v)
+    return cls._from_row(params, coerce=False)
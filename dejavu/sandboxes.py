@@ -3,18 +3,208 @@ try:
 except NameError:
     from sets import Set as set
 
+try:
+    from collections import deque
+except ImportError:
+    deque = None
+import copy
+import datetime
+import Queue
+import threading
+import types
+import weakref
+
 import dejavu
-from dejavu import errors
-from geniusql import codewalk, logic
+from dejavu import analysis, errors
+from geniusql import astwalk, logic
+
+
+def _attribute(node, arg):
+    """Return attr if the given AST node is 'arg.attr', else None."""
+    if (isinstance(node, astwalk.ast.Getattr)
+        and isinstance(node.expr, astwalk.ast.Name)
+        and node.expr.name == arg):
+        return node.attrname
+    return None
+
+def _constant(node):
+    """Return (True, value) if the given AST node is a constant."""
+    if isinstance(node, astwalk.ast.Const):
+        return True, node.value
+    if isinstance(node, (astwalk.ast.Tuple, astwalk.ast.List)):
+        values = []
+        for item in node.nodes:
+            if not isinstance(item, astwalk.ast.Const):
+                return False, None
+            values.append(item.value)
+        return True, tuple(values)
+    return False, None
+
+def _constraints(expr):
+    """Return {attr: values} for the comparisons which expr requires.
+    
+    Only comparisons of the form 'x.attr == value', 'value == x.attr'
+    or 'x.attr in (values)' (where each value is a constant) which are
+    joined to the rest of the expr by a top-level 'and' are recognized.
+    Any unit which matches expr has one of the given values for each
+    given attr; other parts of the expr are ignored, so callers must
+    still test each unit against the whole expr.
+    """
+    if getattr(expr, "kwargs", None) or getattr(expr, "ast", None) is None:
+        return {}
+    args = list(expr.ast.args)
+    if len(args) != 1:
+        return {}
+    
+    root = expr.ast.root
+    if isinstance(root, astwalk.ast.And):
+        operands = root.nodes
+    else:
+        operands = [root]
+    
+    constraints = {}
+    for operand in operands:
+        if not (isinstance(operand, astwalk.ast.Compare)
+                and len(operand.ops) == 1):
+            continue
+        left = operand.expr
+        compare, right = operand.ops[0]
+        attr = _attribute(left, args[0])
+        isconst, value = _constant(right)
+        if attr is None or not isconst:
+            if compare != '==':
+                continue
+            attr = _attribute(right, args[0])
+            isconst, value = _constant(left)
+            if attr is None or not isconst:
+                continue
+        
+        if compare == '==':
+            values = [value]
+        elif (compare == 'in' and
+              isinstance(value, (tuple, list, frozenset))):
+            values = list(value)
+        else:
+            continue
+        
+        if attr in constraints:
+            # Both comparisons must hold.
+            values = [v for v in values if v in constraints[attr]]
+        constraints[attr] = values
+    return constraints
+
+def _identities(cls, constraints):
+    """Return the list of identities of cls which constraints allow, or None.
+    
+    None is returned if constraints do not restrict every identifier.
+    """
+    if not cls.identifiers:
+        return None
+    identities = [()]
+    for key in cls.identifiers:
+        values = constraints.get(key)
+        if values is None:
+            return None
+        identities = [ident + (value,) for ident in identities
+                      for value in values]
+    
+    seen = {}
+    result = []
+    for ident in identities:
+        try:
+            if ident in seen:
+                continue
+        except TypeError:
+            return None
+        seen[ident] = None
+        result.append(ident)
+    return result
+
+def _in_filter(key, values):
+    """Return an Expression which matches units whose key is in values."""
+    return logic.Expression(lambda x: getattr(x, key) in values)
+
+def _identity_filter(identifiers, identities):
+    """Return an Expression which matches (at least) the given identities."""
+    f = None
+    for i in range(len(identifiers)):
+        values = []
+        for ident in identities:
+            if ident[i] not in values:
+                values.append(ident[i])
+        if f is None:
+            f = _in_filter(identifiers[i], values)
+        else:
+            f = f + _in_filter(identifiers[i], values)
+    return f
+
+def _detach(unit):
+    """Return a copy of the given unit, with no sandbox, for saving.
+    
+    The copy has the unit's loaded state and knows which of its
+    properties have changed. Deferred properties which were never loaded
+    stay deferred (rather than being loaded from storage now), and values
+    of mutable properties are deep-copied.
+    """
+    cls = unit.__class__
+    # (CompactProperties.copy also returns a plain dict.)
+    props = unit._properties.copy()
+    for key in cls._hashed_properties:
+        props[key] = copy.deepcopy(props[key])
+    
+    dup = cls._loader(coerce=False, deferred=unit._deferred or ())(props)
+    if unit._changed:
+        dup._changed = set(unit._changed)
+    if cls._hashed_properties:
+        dup._initial_property_hash = unit._initial_property_hash
+    return dup
+
+# A key in each secondary index for units whose value is unknown
+# (because it was deferred) or cannot be hashed.
+_unindexed = object()
 
 
-_simple_attr_compare = ''.join(map(chr, (
-    codewalk.opmap['LOAD_FAST'], 0, 0,
-    codewalk.opmap['LOAD_ATTR'], 1, 0,
-    codewalk.opmap['LOAD_CONST'], 1, 0,
-    codewalk.opmap['COMPARE_OP'], 2, 0,
-    codewalk.opmap['RETURN_VALUE']
-    )))
+def _related_key(expr, order):
+    """Return a hashable key for the given expr and order, or None.
+    
+    Lambdas (and Expressions made from them) which are written inline in
+    the caller share a single code object, so they produce the same key
+    on each call as long as their defaults and free variables are equal.
+    """
+    if expr is None:
+        exprkey = None
+    elif isinstance(expr, dict):
+        exprkey = tuple(sorted(expr.items()))
+    else:
+        func = expr
+        if isinstance(expr, logic.Expression):
+            if getattr(expr, "kwargs", None):
+                return None
+            func = expr.func
+        if not isinstance(func, types.FunctionType):
+            return None
+        cells = ()
+        if func.func_closure:
+            try:
+                cells = tuple([c.cell_contents for c in func.func_closure])
+            except AttributeError:
+                # Python 2.4 cells do not expose their contents.
+                return None
+        exprkey = (func.func_code, func.func_defaults, cells)
+    
+    if isinstance(order, list):
+        order = tuple(order)
+    elif isinstance(order, logic.Expression):
+        order = order.func.func_code
+    elif isinstance(order, types.FunctionType):
+        order = order.func_code
+    
+    key = (exprkey, order)
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
 
 
 class Sandbox(object):
@@ -47,41 +237,101 @@ class Sandbox(object):
     with storage.new_sandbox() as box:
         WAP = box.unit(Zoo, Name='Wild Animal Park')
         WAP.Opens = now
+    
+    By default, a Sandbox keeps every Unit it has seen until flush_all,
+    which can take a great deal of memory in long-running processes.
+    If max_units is not None, the Sandbox instead holds only the
+    max_units most recently used Units (plus any dirty ones) strongly;
+    the rest are held by weak reference, so they remain in the identity
+    map as long as your code holds a reference to them, and are otherwise
+    discarded. Changes made in place to mutable property values (such as
+    list.append) of Units which are no longer referenced may be lost;
+    set such values with the '=' operator instead.
+    
+    If coalesce is True, the first call to a ToOne association which
+    cannot be answered from the cache loads the far Units of that
+    association for every Unit of the near class in this Sandbox, with
+    a single query (see prefetch). So code like:
+    
+    for a in box.recall(Animal):
+        print a.Zoo().Name
+    
+    makes two queries, not one per Animal.
     """
     
-    def __init__(self, store):
+    readonly = False
+    
+    # The most dirty Units which an aggregate leaves out of its query to
+    # storage (with an 'ID not in (...)' clause); with more, the Sandbox
+    # aggregates over its own view instead.
+    max_excluded_units = 100
+    
+    def __init__(self, store, max_units=None, coalesce=False):
         self.store = store
+        self.max_units = max_units
+        self.coalesce = coalesce
         self._caches = {}
+        if max_units is None:
+            self._held = None
+            self._pinned = None
+        else:
+            if deque is None:
+                raise TypeError("max_units requires Python 2.4 or later.")
+            # {id(unit): [unit, occurrences in _held_order]}
+            self._held = {}
+            self._held_order = deque()
+            # {id(unit): unit} for dirty units which have left _held.
+            self._pinned = {}
+        # {farClass: {(association, near value, (expr, order)):
+        #             [far identities]}}
+        self._related = {}
+        # {cls: {key: {value: set([cache keys])}}}
+        self._indexes = {}
     
     def __getattr__(self, key):
         # Support "magic recaller" methods on self.
-        for cls in self.store.classes:
-            name = cls.__name__
-            if name == key:
-                if cls.identifiers:
-                    uniq = cls.identifiers
-                else:
-                    uniq = cls._properties.keys()
-                def recaller(*args, **kwargs):
-                    # Allow identifiers to be supplied as args or kwargs
-                    # (since the common case will be a single identifier).
-                    for arg, key in zip(args, uniq):
-                        kwargs[str(key)] = arg
-                    return self.unit(cls, **kwargs)
-                recaller.__doc__ = "A single %s Unit, else None." % name
-                return recaller
-        raise AttributeError("Sandbox object has no attribute '%s'" % key)
+        if key.startswith('__'):
+            raise AttributeError("Sandbox object has no attribute '%s'" % key)
+        try:
+            cls = self.store.class_by_name(key)
+        except KeyError:
+            raise AttributeError("Sandbox object has no attribute '%s'" % key)
+        
+        if cls.identifiers:
+            uniq = cls.identifiers
+        else:
+            uniq = cls.properties
+        def recaller(*args, **kwargs):
+            # Allow identifiers to be supplied as args or kwargs
+            # (since the common case will be a single identifier).
+            for arg, key in zip(args, uniq):
+                kwargs[str(key)] = arg
+            return self.unit(cls, **kwargs)
+        recaller.__doc__ = "A single %s Unit, else None." % key
+        # Keep the recaller, so we don't come back here for it.
+        self.__dict__[key] = recaller
+        return recaller
     
     def memorize(self, *units):
-        """Persist the given unit(s) in storage."""
+        """Persist the given unit(s) in storage.
+        
+        Multiple units are passed to the store in a single reserve_many
+        call (which some stores can perform in bulk) before any of them
+        is cached or has its on_memorize method called.
+        """
         for unit in units:
-            cls = unit.__class__
             unit.sandbox = self
-            
-            # Ask the store to accept the unit, assigning it primary key values
-            # if necessary. The store should also call unit.cleanse() if it
-            # saves the whole unit state on this call.
-            self.store.reserve(unit)
+        
+        # Ask the store to accept the units, assigning them primary key values
+        # if necessary. The store should also call unit.cleanse() if it
+        # saves the whole unit state on this call.
+        if len(units) == 1:
+            self.store.reserve(units[0])
+        else:
+            self.store.reserve_many(units)
+        
+        for unit in units:
+            cls = unit.__class__
             
             # Insert the unit into the cache.
             if cls.identifiers:
@@ -90,6 +340,9 @@ class Sandbox(object):
                 # Use id(unit) instead of unit.ID
                 uid = id(unit)
             self._cache(cls)[uid] = unit
+            self._index_add(cls, uid, unit)
+            self._hold(unit)
+            self._invalidate_related(cls)
             
             # Do this at the end of the func, since most on_memorize
             # will want to have an identity when called.
@@ -97,7 +350,11 @@ class Sandbox(object):
                 unit.on_memorize()
     
     def forget(self, *units):
-        """Destroy the given units, both in the cache and storage."""
+        """Destroy the given units, both in the cache and storage.
+        
+        Multiple units are destroyed in storage with a single
+        call to store.destroy_many.
+        """
         for unit in units:
             cls = unit.__class__
             
@@ -106,9 +363,16 @@ class Sandbox(object):
             else:
                 uid = id(unit)
             del self._cache(cls)[uid]
-            
-            self.store.destroy(unit)
-            
+            self._index_remove(cls, uid, unit)
+            self._invalidate_related(cls)
+            self._unpin(unit)
+        
+        if len(units) == 1:
+            self.store.destroy(units[0])
+        else:
+            self.store.destroy_many(units)
+        
+        for unit in units:
             # This must be done after the destroy() call, so that a
             # related unit can poll all instances of this class.
             if hasattr(unit, "on_forget"):
@@ -116,7 +380,8 @@ class Sandbox(object):
             
             unit.sandbox = None
     
-    def xrecall(self, classes, expr=None, order=None, limit=None, offset=None):
+    def xrecall(self, classes, expr=None, order=None, limit=None,
+                offset=None, defer=None):
         """Iterator over units of the given class(es) which match expr.
         
         If the 'classes' arg is a UnitJoin, each yielded value will
@@ -136,6 +401,11 @@ class Sandbox(object):
             * You're using this sandbox as read-only, or
             * You call flush_all() after mutating Units but before recalling
                 multiple classes.
+        
+        defer: a sequence of names of properties which the store need not
+            fetch; they are loaded on first access (see undefer). If None
+            (the default), the class' own deferred properties are used.
+            Pass an empty sequence to fetch every property.
         """
         if isinstance(classes, dejavu.UnitJoin):
             for unitrow in self._xmultirecall(classes, expr, order=order,
@@ -149,28 +419,48 @@ class Sandbox(object):
         
         cache = self._cache(cls)
         
-        # Special-case the scenario where one Unit is expected
-        # and called by ID. We should be able to save a database hit.
-        if expr:
-            fc = expr.func.func_code
-            if (fc.co_code == _simple_attr_compare and
-                    cls.identifiers == (fc.co_names[-1], )):
-                ID = fc.co_consts[-1]
-                unit = cache.get((ID,))
-                if unit is not None:
-                    # Do NOT call on_recall here. That should be called
-                    # only at the Sandbox-SM boundary.
-                    yield unit
-                    return
-        
         if limit:
             offset = offset or 0
             limit = offset + limit
         elif limit == 0:
             return
         
+        constraints = {}
+        identities = None
+        if expr:
+            constraints = _constraints(expr)
+            if not offset:
+                identities = _identities(cls, constraints)
+                if identities is not None and order and len(identities) > 1:
+                    # We'd have to interleave with storage (see below).
+                    identities = None
+        
         keys = []
-        if order:
+        if identities is not None:
+            # The expr names the units it wants by identity. Serve those
+            # which are in our cache, and ask storage only for the rest.
+            # We should be able to save a database hit.
+            keys = set()
+            missing = []
+            for id in identities:
+                unit = cache.get(id)
+                if unit is None:
+                    missing.append(id)
+                else:
+                    keys.add(id)
+                    if expr.evaluate(unit):
+                        # Do NOT call on_recall here. That should be called
+                        # only at the Sandbox-SM boundary.
+                        self._hold(unit)
+                        yield unit
+                        if limit:
+                            limit -= 1
+                            if limit == 0:
+                                return
+            if not missing:
+                return
+            expr = expr + _identity_filter(cls.identifiers, missing)
+        elif order:
             # If an order is supplied, there's no point in running the
             # query against our cache (because we'd have to interleave
             # the results with those from storage anyway). We'll still
@@ -183,12 +473,23 @@ class Sandbox(object):
             # Query the cache. We have to use a static copy of the
             # keys, to ensure that our cache doesn't change size
             # during iteration (due to overlapping xrecalls).
-            keys = cache.keys()
-            for id in keys:
+            keys = set(cache.keys())
+            candidates = None
+            for attr, values in constraints.iteritems():
+                uids = self._index_lookup(cls, attr, values)
+                if uids is not None and (candidates is None or
+                                         len(uids) < len(candidates)):
+                    candidates = uids
+            if candidates is None:
+                candidates = list(keys)
+            else:
+                candidates = list(candidates)
+            for id in candidates:
                 unit = cache.get(id)
                 if unit and ((expr is None) or expr.evaluate(unit)):
                     # Do NOT call on_recall here. That should be called
                     # only at the Sandbox-SM boundary.
+                    self._hold(unit)
                     yield unit
                     if limit:
                         limit -= 1
@@ -199,7 +500,8 @@ class Sandbox(object):
         if not cls.identifiers:
             # Classes with no identifiers cannot be compared to our cache
             for unit in self.store.xrecall(cls, expr, order=order,
-                                           limit=limit, offset=offset):
+                                           limit=limit, offset=offset,
+                                           defer=defer):
                 unit.sandbox = self
                 if hasattr(unit, 'on_recall'):
                     try:
@@ -209,7 +511,8 @@ class Sandbox(object):
                 yield unit
         else:
             for unit in self.store.xrecall(cls, expr, order=order,
-                                           limit=limit, offset=offset):
+                                           limit=limit, offset=offset,
+                                           defer=defer):
                 id = unit.identity()
                 # Don't offer up a unit that was already checked in our cache
                 # (whether it matched the expr() or not--we assume the cache
@@ -225,10 +528,13 @@ class Sandbox(object):
                     # Make sure the cache lookup and get happens atomically.
                     existing = cache.get(id)
                     if existing:
+                        self._hold(existing)
                         yield existing
                     else:
                         unit.sandbox = self
                         cache[id] = unit
+                        self._index_add(cls, id, unit)
+                        self._hold(unit)
                         if hasattr(unit, 'on_recall'):
                             try:
                                 unit.on_recall()
@@ -236,7 +542,8 @@ class Sandbox(object):
                                 continue
                         yield unit
     
-    def recall(self, classes, expr=None, order=None, limit=None, offset=None):
+    def recall(self, classes, expr=None, order=None, limit=None,
+               offset=None, defer=None, prefetch=None):
         """List of units of the given class(es) which match expr.
         
         If the 'classes' arg is a UnitJoin, each yielded value will
@@ -256,9 +563,285 @@ class Sandbox(object):
             * You're using this sandbox as read-only, or
             * You call flush_all() after mutating Units but before recalling
                 multiple classes.
+        
+        prefetch: a sequence of association paths (see the prefetch method)
+            to load for the recalled units. Ignored for UnitJoins.
+        """
+        units = [x for x in self.xrecall(classes, expr, order=order,
+                                         limit=limit, offset=offset,
+                                         defer=defer)]
+        if prefetch and not isinstance(classes, dejavu.UnitJoin):
+            self.prefetch(units, prefetch)
+        return units
+    
+    def prefetch(self, units, paths):
+        """Load the far units of the given association paths for all units.
+        
+        Each path is a dotted string of association names, starting from
+        the class of the given units; for example, given Zoo units,
+        'Animal.Food' loads the Animals of every Zoo, and then the Food
+        of every one of those Animals. Each level is loaded with a single
+        query (using an IN list of the near values), and the far units
+        are placed in this sandbox, so that subsequent calls like
+        zoo.Animal() (with no other arguments) are answered from memory.
+        """
+        if isinstance(paths, basestring):
+            paths = [paths]
+        for path in paths:
+            level = units
+            for name in path.split("."):
+                if not level:
+                    break
+                cls = level[0].__class__
+                try:
+                    association = cls._associations[name]
+                except KeyError:
+                    raise errors.AssociationError(
+                        "%r has no association named %r." % (cls, name))
+                level = self._prefetch(association, level)
+    
+    def _prefetch(self, association, units):
+        """Load and group the far units of association for the given units."""
+        farClass = association.farClass
+        farKey = association.farKey
+        
+        values = {}
+        for unit in units:
+            value = getattr(unit, association.nearKey)
+            if value is not None:
+                values[value] = None
+        if not farClass.identifiers:
+            # Far units cannot be found again in our cache.
+            return []
+        
+        groups = self._related.setdefault(farClass, {})
+        needed = [v for v in values if (association, v, (None, None))
+                  not in groups]
+        if needed:
+            found = dict([(v, []) for v in needed])
+            expr = logic.Expression(lambda x: getattr(x, farKey) in needed)
+            for farunit in self.xrecall(farClass, expr):
+                ids = found.get(getattr(farunit, farKey))
+                if ids is not None:
+                    ids.append(farunit.identity())
+            # Our recall may have invalidated the groups.
+            groups = self._related.setdefault(farClass, {})
+            for value, ids in found.iteritems():
+                groups[(association, value, (None, None))] = ids
+        
+        farunits = []
+        for value in values:
+            related = self._related_units(association, value)
+            if related:
+                farunits.extend(related)
+        return farunits
+    
+    def _coalesced_related(self, association, unit):
+        """Prefetch association for all units like the given one, if allowed.
+        
+        If self.coalesce is True, the far units of the given association
+        are loaded for every unit of the given unit's class in our cache
+        (except those whose far units are already known), and True is
+        returned. Otherwise, nothing is loaded and False is returned.
+        """
+        if not self.coalesce or not association.farClass.identifiers:
+            return False
+        nearunits = self._cache(unit.__class__).values()
+        nearunits.append(unit)
+        self._prefetch(association, nearunits)
+        return True
+    
+    def _related_units(self, association, value, expr=None, order=None):
+        """Return known far units for the association and value, or None.
+        
+        Far units are known if they were prefetched, or remembered by
+        a previous call to _remember_related with an equivalent
+        expr and order.
+        """
+        groups = self._related.get(association.farClass)
+        if not groups:
+            return None
+        exprkey = _related_key(expr, order)
+        if exprkey is None:
+            return None
+        key = (association, value, exprkey)
+        ids = groups.get(key)
+        if ids is None:
+            return None
+        
+        cache = self._cache(association.farClass)
+        units = []
+        for id in ids:
+            unit = cache.get(id)
+            if unit is None:
+                # The unit has been repressed; we no longer know the set.
+                del groups[key]
+                return None
+            units.append(unit)
+        return units
+    
+    def _remember_related(self, association, value, units,
+                          expr=None, order=None):
+        """Remember the far units for the given association, value and expr.
+        
+        Subsequent calls to _related_units with the same arguments will
+        return the same units (until the far class is invalidated).
+        """
+        farClass = association.farClass
+        if not farClass.identifiers:
+            return
+        exprkey = _related_key(expr, order)
+        if exprkey is None:
+            return
+        groups = self._related.setdefault(farClass, {})
+        groups[(association, value, exprkey)] = [u.identity() for u in units]
+    
+    def _invalidate_related(self, cls, filtered_only=False):
+        """Forget known groupings of far units of the given class.
+        
+        If filtered_only is True, only groupings which were remembered
+        for a particular expr or order are forgotten; this is sufficient
+        when a property other than an association key has changed.
+        """
+        if self._related:
+            if filtered_only:
+                groups = self._related.get(cls)
+                if groups:
+                    for key in groups.keys():
+                        if key[2] != (None, None):
+                            del groups[key]
+            else:
+                self._related.pop(cls, None)
+    
+    def _index_lookup(self, cls, key, values):
+        """Return the cache keys of units of cls which may have key in values.
+        
+        If the key is not indexed (or a value cannot be hashed), return None;
+        the caller must then examine every cached unit of cls. The returned
+        set may include units whose value is not known (see _index_add),
+        so callers must still test each unit.
+        """
+        if key not in cls._indexed_properties or key in cls.identifiers:
+            return None
+        if self.max_units is not None:
+            # Indexes would keep entries for units which have been
+            # discarded from our (weak) cache.
+            return None
+        indexes = self._indexes.get(cls)
+        if indexes is None:
+            # Build the indexes for cls on first use; they are
+            # maintained from then on by the methods which
+            # add or remove cached units (and by UnitProperty.__set__).
+            indexes = {}
+            for k in cls._indexed_properties:
+                if k not in cls.identifiers:
+                    indexes[k] = {}
+            self._indexes[cls] = indexes
+            for uid, unit in self._cache(cls).iteritems():
+                self._index_add(cls, uid, unit)
+        
+        index = indexes[key]
+        uids = set()
+        for value in values:
+            try:
+                bucket = index.get(value)
+            except TypeError:
+                return None
+            if bucket:
+                uids.update(bucket)
+        unknown = index.get(_unindexed)
+        if unknown:
+            uids.update(unknown)
+        return uids
+    
+    def _index_add(self, cls, uid, unit):
+        """Add the given unit (with the given cache key) to the indexes of cls.
+        
+        Units whose value for an indexed key is deferred, or cannot be
+        hashed, are indexed under a special key which every lookup includes.
+        """
+        indexes = self._indexes.get(cls)
+        if indexes:
+            props = unit._properties
+            deferred = unit._deferred
+            for key, index in indexes.iteritems():
+                if deferred and key in deferred:
+                    self._index_put(index, _unindexed, uid)
+                else:
+                    self._index_put(index, props[key], uid)
+    
+    def _index_remove(self, cls, uid, unit):
+        """Remove the unit (with the given cache key) from cls indexes."""
+        indexes = self._indexes.get(cls)
+        if indexes:
+            props = unit._properties
+            for key, index in indexes.iteritems():
+                self._index_discard(index, props[key], uid)
+                self._index_discard(index, _unindexed, uid)
+    
+    def _index_put(self, index, value, uid):
+        """Add uid to the given index under the given value."""
+        try:
+            bucket = index.get(value)
+        except TypeError:
+            value = _unindexed
+            bucket = index.get(value)
+        if bucket is None:
+            index[value] = set([uid])
+        else:
+            bucket.add(uid)
+    
+    def _index_discard(self, index, value, uid):
+        """Remove uid from the given index under the given value."""
+        try:
+            bucket = index.get(value)
+        except TypeError:
+            return
+        if bucket:
+            bucket.discard(uid)
+            if not bucket:
+                del index[value]
+    
+    def _reindex(self, unit, key, oldvalue, newvalue):
+        """Move the given unit in the index for key (called by __set__)."""
+        cls = unit.__class__
+        indexes = self._indexes.get(cls)
+        if indexes:
+            index = indexes.get(key)
+            if index is None:
+                return
+            if cls.identifiers:
+                uid = unit.identity()
+            else:
+                uid = id(unit)
+            if self._cache(cls).get(uid) is not unit:
+                # The unit is not (yet) in our cache.
+                return
+            self._index_discard(index, oldvalue, uid)
+            self._index_put(index, newvalue, uid)
+    
+    def undefer(self, cls, keys, units=()):
+        """Load the given deferred properties for the given units of cls.
+        
+        Every other unit of cls in this sandbox which has also deferred
+        all of the given keys is loaded at the same time, so that reading
+        a deferred property while iterating over recalled units costs
+        one query, not one query per unit.
         """
-        return [x for x in self.xrecall(classes, expr, order=order,
-                                        limit=limit, offset=offset)]
+        batch = {}
+        for unit in units:
+            batch[id(unit)] = unit
+        if cls.identifiers:
+            for unit in self._cache(cls).values():
+                deferred = unit._deferred
+                if deferred:
+                    for key in keys:
+                        if key not in deferred:
+                            break
+                    else:
+                        batch[id(unit)] = unit
+        if batch:
+            self.store.undefer(cls, keys, batch.values())
     
     def unit(self, cls, **kwargs):
         """A single Unit which matches the given kwargs, else None.
@@ -279,17 +862,31 @@ class Sandbox(object):
                     if u is not None:
                         u.sandbox = self
                         cache[ident] = u
+                        self._index_add(cls, ident, u)
+                        self._hold(u)
                         if hasattr(u, 'on_recall'):
                             try:
                                 u.on_recall()
                             except errors.UnrecallableError:
                                 return None
+                else:
+                    self._hold(u)
                 return u
         
         # Query the cache. We have to use a static copy of the
         # keys, to ensure that our cache doesn't change size
         # during iteration (due to overlapping xrecalls).
-        keys = cache.keys()
+        # If any kwarg is indexed, examine only the smallest
+        # set of units which the indexes offer.
+        keys = None
+        for k, v in kwargs.iteritems():
+            uids = self._index_lookup(cls, k, (v,))
+            if uids is not None and (keys is None or len(uids) < len(keys)):
+                keys = uids
+        if keys is None:
+            keys = cache.keys()
+        else:
+            keys = list(keys)
         for id in keys:
             u = cache.get(id)
             if u:
@@ -299,6 +896,7 @@ class Sandbox(object):
                 else:
                     # Do NOT call on_recall here. That should be called
                     # only at the Sandbox-SM boundary.
+                    self._hold(u)
                     return u
         
         # Query Storage.
@@ -315,8 +913,11 @@ class Sandbox(object):
                 id = u.identity()
                 existing = cache.get(id)
                 if existing:
+                    self._hold(existing)
                     return existing
                 cache[id] = u
+                self._index_add(cls, id, u)
+                self._hold(u)
             
             if hasattr(u, 'on_recall'):
                 try:
@@ -325,6 +926,52 @@ class Sandbox(object):
                     return None
         return u
     
+    def units_by_id(self, cls, identities):
+        """List of Units of cls for the given identities, in the same order.
+        
+        Each identity is a tuple of values, in the order of cls.identifiers.
+        Units in our cache are served first; the rest are fetched with a
+        single call to store.unit_many. Identities which match no Unit
+        (or whose Unit is unrecallable) are skipped.
+        """
+        cache = self._cache(cls)
+        identities = [tuple(id) for id in identities]
+        
+        found = {}
+        missing = []
+        for id in identities:
+            u = cache.get(id)
+            if u is None:
+                missing.append(id)
+            else:
+                found[id] = u
+        
+        if missing:
+            for id, u in self.store.unit_many(cls, missing).iteritems():
+                # Very important that we check for an existing unit, as its
+                # state may have changed in memory but not in storage.
+                existing = cache.get(id)
+                if existing is not None:
+                    found[id] = existing
+                    continue
+                u.sandbox = self
+                cache[id] = u
+                self._index_add(cls, id, u)
+                if hasattr(u, 'on_recall'):
+                    try:
+                        u.on_recall()
+                    except errors.UnrecallableError:
+                        continue
+                found[id] = u
+        
+        units = []
+        for id in identities:
+            u = found.get(id)
+            if u is not None:
+                self._hold(u)
+                units.append(u)
+        return units
+    
     def _xmultirecall(self, classes, expr=None,
                       order=None, limit=None, offset=None):
         """Recall units of each cls if they together match the expr.
@@ -365,11 +1012,15 @@ class Sandbox(object):
                     # This is a 'dummy unit' from an outer join.
                     continue
                 cache = self._cache(unit.__class__)
-                if id in cache:
+                existing = cache.get(id)
+                if existing is not None:
                     # Keep the unit which is in our cache!
-                    unitset[index] = cache[id]
+                    unitset[index] = existing
+                    self._hold(existing)
                 else:
                     cache[id] = unit
+                    self._index_add(unit.__class__, id, unit)
+                    self._hold(unit)
                     unit.sandbox = self
                     if hasattr(unit, 'on_recall'):
                         try:
@@ -392,51 +1043,50 @@ class Sandbox(object):
         
         This is generally much faster than recall, and should be preferred
         for performance-sensitive code.
+        
+        Queries over a UnitJoin, or whose attributes are an Expression,
+        are handed whole to storage unless this sandbox holds dirty Units
+        of one of the classes involved (see _xjoinview).
         """
         if not isinstance(query, dejavu.Query):
             query = dejavu.Query(*query)
         
+        if (isinstance(query.relation, dejavu.UnitJoin) or
+            isinstance(query.attributes, logic.Expression)):
+            for datarow in self._xjoinview(query, distinct):
+                yield datarow
+            return
+        
         expr = query.restriction
         attrs = query.attributes
-        if isinstance(query.relation, dejavu.UnitJoin):
-            classes = query.relation
-        else:
-            classes = [query.relation]
         
         # Add the identity attribute(s) if not present. This is necessary
         # to avoid duplicating objects which are already in our cache.
-        if isinstance(query.attributes, logic.Expression):
-            # TODO: add support for this
-            choke
-        elif isinstance(query.relation, dejavu.UnitJoin):
-            # TODO: add support for this
-            choke
-        else:
-            cls = query.relation
-            fields = list(query.attributes)
-            indices = []
-            added_fields = 0
-            for key in cls.identifiers:
-                if key not in fields:
-                    added_fields += 1
-                    fields.append(key)
-                indices.append(fields.index(key))
+        cls = query.relation
+        fields = list(attrs)
+        indices = []
+        added_fields = 0
+        for key in cls.identifiers:
+            if key not in fields:
+                added_fields += 1
+                fields.append(key)
+            indices.append(fields.index(key))
         
         seen = {}
         
-        for cls in classes:
-            cache = self._cache(cls)
-            for unit in cache.itervalues():
-                if expr is None or expr(unit):
-                    datarow = tuple([getattr(unit, attr) for attr in attrs])
-                    if distinct:
-                        if datarow not in seen:
-                            yield datarow
-                            seen[datarow] = None
-                    else:
+        cache = self._cache(cls)
+        for unit in cache.values():
+            if expr is None or expr(unit):
+                datarow = tuple([getattr(unit, attr) for attr in attrs])
+                if distinct:
+                    if datarow not in seen:
                         yield datarow
+                        seen[datarow] = None
+                else:
+                    yield datarow
         
-        for datarow in self.store.xview((query.relation, fields, expr), distinct=distinct):
+        storequery = dejavu.Query(cls, fields, expr)
+        for datarow in self.store.xview(storequery, distinct=distinct):
             id = tuple([datarow[x] for x in indices])
             if id not in cache:
                 if added_fields:
@@ -450,23 +1100,211 @@ class Sandbox(object):
                 else:
                     yield datarow
     
+    def _xjoinview(self, query, distinct=False):
+        """Yield tuples for a Query over a UnitJoin or of an Expression.
+        
+        Clean Units in our cache hold the same values as storage, so
+        unless we hold dirty Units of one of the classes involved, the
+        whole Query is passed to storage (where a database can answer
+        it with a single SELECT). Otherwise, rows are reconciled against
+        the identity map: for attribute names, the identifier columns of
+        each class are added to the query, and any row which includes a
+        dirty Unit is rebuilt (and re-tested) from the cached Units. An
+        Expression cannot be extended that way, so its rows are formed
+        from recalled Units instead.
+        
+        As with recall of a UnitJoin, rows which storage would not return,
+        but which our dirty Units would now satisfy, are not yielded.
+        """
+        if isinstance(query.relation, dejavu.UnitJoin):
+            classes = list(query.relation)
+        else:
+            classes = [query.relation]
+        expr = query.restriction
+        attrs = query.attributes
+        
+        dirty = {}
+        for cls in classes:
+            if cls.identifiers and cls not in dirty:
+                ids = [id for id, unit in self._cache(cls).items()
+                       if unit.dirty()]
+                if ids:
+                    dirty[cls] = set(ids)
+        if not dirty:
+            for datarow in self.store.xview(query, distinct=distinct):
+                yield datarow
+            return
+        
+        seen = {}
+        
+        if isinstance(attrs, logic.Expression):
+            for unitrow in self.xrecall(query.relation, expr):
+                if len(classes) == 1:
+                    unitrow = (unitrow,)
+                # Cached Units may no longer match the restriction.
+                if not expr(*unitrow):
+                    continue
+                datarow = tuple(attrs(*unitrow))
+                if distinct:
+                    if datarow not in seen:
+                        yield datarow
+                        seen[datarow] = None
+                else:
+                    yield datarow
+            return
+        
+        # Add the identifier columns of each class, and note where the
+        # requested columns and the identity of each class fall in a row.
+        fields, spans, indices = [], [], []
+        start = 0
+        for cls, names in zip(classes, attrs):
+            names = list(names)
+            spans.append((start, start + len(names)))
+            for key in cls.identifiers:
+                if key not in names:
+                    names.append(key)
+            indices.append([start + names.index(key)
+                            for key in cls.identifiers])
+            fields.append(names)
+            start += len(names)
+        
+        storequery = dejavu.Query(query.relation, fields, expr)
+        for row in self.store.xview(storequery, distinct=distinct):
+            ids = [tuple([row[x] for x in idx]) for idx in indices]
+            for cls, id in zip(classes, ids):
+                if id in dirty.get(cls, ()):
+                    break
+            else:
+                datarow = []
+                for begin, end in spans:
+                    datarow.extend(row[begin:end])
+                datarow = tuple(datarow)
+                if distinct:
+                    if datarow not in seen:
+                        yield datarow
+                        seen[datarow] = None
+                else:
+                    yield datarow
+                continue
+            
+            # This row includes a dirty Unit; rebuild it from Units.
+            # Dummy (outer join) Units keep the values from storage.
+            units = []
+            for cls, id in zip(classes, ids):
+                unit = None
+                if cls.identifiers and cls.sequencer.valid_id(id):
+                    unit = self._cache(cls).get(id)
+                    if unit is None:
+                        unit = self.unit(cls, **dict(zip(cls.identifiers, id)))
+                units.append(unit)
+            if None not in units and not expr(*units):
+                continue
+            
+            datarow = []
+            for unit, names, (begin, end) in zip(units, attrs, spans):
+                if unit is None:
+                    datarow.extend(row[begin:end])
+                else:
+                    datarow.extend([getattr(unit, name) for name in names])
+            datarow = tuple(datarow)
+            if distinct:
+                if datarow not in seen:
+                    yield datarow
+                    seen[datarow] = None
+            else:
+                yield datarow
+    
     def view(self, query, distinct=False):
         """Return tuples of attrs for the given Query."""
         return [x for x in self.xview(query, distinct=distinct)]
     
+    def _aggregate(self, cls, expr=None):
+        """Return (expr, units) to aggregate over cls, or None.
+        
+        Every clean Unit in our cache holds the same values as storage
+        (Units are written on memorize and deleted on forget), so an
+        aggregate can be pushed down to storage, using the returned expr
+        to leave out our dirty Units; it is then corrected with the
+        returned units: those dirty Units which match the given expr.
+        
+        If storage cannot leave them out (because cls does not have
+        exactly one identifier, or more than self.max_excluded_units
+        Units are dirty), None is returned.
+        """
+        if expr is not None and not isinstance(expr, logic.Expression):
+            expr = logic.Expression(expr)
+        
+        dirty = [unit for unit in self._cache(cls).values() if unit.dirty()]
+        if not dirty:
+            return expr, []
+        if (len(cls.identifiers) != 1
+            or len(dirty) > self.max_excluded_units):
+            return None
+        
+        key = cls.identifiers[0]
+        ids = tuple([getattr(unit, key) for unit in dirty])
+        clean = logic.Expression(lambda x: getattr(x, key) not in ids)
+        if expr is not None:
+            dirty = [unit for unit in dirty if expr(unit)]
+        return clean + expr, dirty
+    
     def sum(self, cls, attr, expr=None):
         """Sum of all non-None values for the given cls.attr."""
         expr = logic.Expression(lambda x: getattr(x, attr) != None) + expr
-        return sum([row[0] for row in
-                    self.view(dejavu.Query(cls, (attr,), expr))])
+        agg = self._aggregate(cls, expr)
+        if agg is None:
+            return sum([row[0] for row in
+                        self.view(dejavu.Query(cls, (attr,), expr))])
+        
+        expr, units = agg
+        return (self.store.sum(cls, attr, expr) +
+                sum([getattr(unit, attr) for unit in units]))
     
     def count(self, cls, expr=None):
         """Number of Units of the given cls which match the given expr."""
-        if cls.identifiers:
-            uniq = cls.identifiers
-        else:
-            uniq = cls._properties.keys()
-        return len(self.view((cls, uniq, expr), distinct=True))
+        agg = self._aggregate(cls, expr)
+        if agg is None:
+            if cls.identifiers:
+                uniq = cls.identifiers
+            else:
+                uniq = cls.properties
+            return len(self.view((cls, uniq, expr), distinct=True))
+        
+        expr, units = agg
+        return self.store.count(cls, expr) + len(units)
+    
+    def aggregate(self, cls, group_by=(), aggregates=None, expr=None):
+        """Return {group key: {name: value}} for the Units which match expr.
+        
+        See StorageManager.aggregate. Storage aggregates all but our dirty
+        Units, which are then folded into its results. Aggregates whose
+        running values differ from their results (like analysis.AVG)
+        cannot be folded into, so if any Units are dirty, those are
+        computed from our own recall instead.
+        """
+        if aggregates is None:
+            aggregates = {'count': analysis.COUNT}
+        
+        agg = self._aggregate(cls, expr)
+        if agg is not None:
+            clean, units = agg
+            if not units:
+                return self.store.aggregate(cls, group_by, aggregates, clean)
+            
+            finishers = [aggfunc for aggfunc in aggregates.itervalues()
+                         if getattr(aggfunc, "finish", None)]
+            if not finishers:
+                aggregator = analysis.Aggregator(group_by, aggregates)
+                aggregator.groups = self.store.aggregate(
+                    cls, group_by, aggregates, clean)
+                for unit in units:
+                    aggregator.add(unit)
+                return aggregator.results()
+        
+        aggregator = analysis.Aggregator(group_by, aggregates)
+        for unit in self.xrecall(cls, expr):
+            aggregator.add(unit)
+        return aggregator.results()
     
     def range(self, cls, attr, expr=None):
         """Distinct, non-None attr values (ordered and continuous, if possible).
@@ -483,27 +1321,32 @@ class Sandbox(object):
         unicode, or float) then all distinct, non-None values are returned
         (sorted, if possible).
         """
-        query = dejavu.Query(cls, [attr], expr)
-        existing = [x[0] for x in self.view(query, distinct=True)
-                    if x is not None]
+        attr_type = getattr(cls, attr).type
+        agg = None
+        if issubclass(attr_type, (int, long, datetime.date)):
+            # Only the bounds are needed; let storage find them.
+            agg = self._aggregate(cls, expr)
+        if agg is None:
+            query = dejavu.Query(cls, [attr], expr)
+            existing = [x[0] for x in self.view(query, distinct=True)
+                        if x is not None]
+        else:
+            expr, units = agg
+            existing = list(self.store.bounds(cls, attr, expr))
+            existing.extend([getattr(unit, attr) for unit in units])
+            existing = [x for x in existing if x is not None]
         if not existing:
             return []
         
-        attr_type = getattr(cls, attr).type
         if issubclass(attr_type, (int, long)):
             return range(min(existing), max(existing) + 1)
         else:
-            try:
-                import datetime
-            except ImportError:
-                pass
-            else:
-                if issubclass(attr_type, datetime.date):
-                    def date_gen():
-                        start, end = min(existing), max(existing)
-                        for d in range((end + 1) - start):
-                            yield start + datetime.timedelta(d)
-                    return date_gen()
+            if issubclass(attr_type, datetime.date):
+                def date_gen():
+                    start, end = min(existing), max(existing)
+                    for d in range((end + 1) - start):
+                        yield start + datetime.timedelta(d)
+                return date_gen()
         
         try:
             existing.sort()
@@ -518,14 +1361,79 @@ class Sandbox(object):
         """Return the cache for the specified class.
         
         This base class creates a new cache for each cls per request.
+        If self.max_units is not None, the cache holds its units weakly.
         """
         if cls not in self._caches:
-            self._caches[cls] = {}
+            if self.max_units is None:
+                self._caches[cls] = {}
+            else:
+                self._caches[cls] = weakref.WeakValueDictionary()
         return self._caches[cls]
     
+    def _hold(self, unit):
+        """Mark the given unit as most recently used (if max_units is set).
+        
+        The max_units most recently used units are held strongly; when a
+        unit falls out of that set, it is held only by our (weak) cache,
+        unless it is dirty, in which case it is pinned until it is saved.
+        """
+        held = self._held
+        if held is None:
+            return
+        key = id(unit)
+        entry = held.get(key)
+        if entry is None:
+            held[key] = [unit, 1]
+        else:
+            entry[1] += 1
+        order = self._held_order
+        order.append(key)
+        
+        while len(held) > self.max_units:
+            key = order.popleft()
+            entry = held.get(key)
+            if entry is None:
+                # The unit was purged.
+                continue
+            entry[1] -= 1
+            if not entry[1]:
+                del held[key]
+                if entry[0].dirty():
+                    self._pinned[key] = entry[0]
+        
+        if len(order) > 4 * len(held) + 64:
+            # Keep only the most recent use of each unit in order.
+            keys = list(order)
+            keys.reverse()
+            seen = {}
+            recent = []
+            for key in keys:
+                if key in held and key not in seen:
+                    seen[key] = None
+                    recent.append(key)
+            recent.reverse()
+            order.clear()
+            order.extend(recent)
+            for entry in held.itervalues():
+                entry[1] = 1
+    
+    def _unpin(self, unit):
+        """Release the given unit, which has been saved or destroyed."""
+        if self._pinned:
+            self._pinned.pop(id(unit), None)
+    
     def purge(self, cls):
         """Drop all cached Units of class 'cls'. Do not save."""
         del self._caches[cls]
+        self._indexes.pop(cls, None)
+        self._invalidate_related(cls)
+        if self._held is not None:
+            for key, entry in self._held.items():
+                if entry[0].__class__ is cls:
+                    del self._held[key]
+            for key, unit in self._pinned.items():
+                if unit.__class__ is cls:
+                    del self._pinned[key]
     
     def repress(self, *units):
         """Remove units from cache (but don't destroy)."""
@@ -544,11 +1452,23 @@ class Sandbox(object):
             self.store.save(unit)
             
             del self._cache(cls)[uid]
+            self._index_remove(cls, uid, unit)
+            self._unpin(unit)
             
             unit.sandbox = None
     
-    def flush_all(self):
-        """Repress all units and commit any open transaction."""
+    def flush_all(self, background=False):
+        """Repress all units and commit any open transaction.
+        
+        If background is True, detached copies of the dirty units are
+        instead handed to the store's writer thread to be saved (see
+        StorageManager.save_in_background), and a FlushHandle is returned;
+        call its wait() method to block until they have been saved (and
+        re-raise any error). The on_repress methods are still called here.
+        The writer saves the copies in its own transaction, so changing
+        the units afterward does not affect what is saved, and the commit
+        of any open transaction here includes none of these writes.
+        """
         
         for cls in self._caches.keys():
             # Call all on_repress methods first! There are truly horrible
@@ -561,13 +1481,51 @@ class Sandbox(object):
                 if hasattr(unit, "on_repress"):
                     unit.on_repress()
         
+        self._related = {}
+        self._indexes = {}
+        pending = []
         for cls in self._caches.keys():
             cache = self._cache(cls)
             while cache:
-                unitid, unit = cache.popitem()
-                self.store.save(unit)
+                # Hand the store all of the units of cls at once
+                # (the store skips those which are not dirty).
+                items = cache.items()
+                units = [unit for key, unit in items]
+                if background:
+                    pending.extend([_detach(unit) for unit in units
+                                    if unit.dirty()])
+                else:
+                    self.store.save_many(units)
+                
+                # Only drop the units once they are saved (or copied),
+                # so that they are not lost if that fails.
+                for key, unit in items:
+                    if cache.get(key) is unit:
+                        del cache[key]
+        
+        if self._held is not None:
+            self._held = {}
+            self._held_order = deque()
+            self._pinned = {}
         
         self.commit()
+        if background:
+            return self.store.save_in_background(pending)
+    
+    def reset(self):
+        """Discard all units (without saving them) so self can be reused.
+        
+        Unlike rollback, this does not call purge (or on_forget), and does
+        not touch any open transaction; magic recallers are kept.
+        """
+        for cache in self._caches.itervalues():
+            cache.clear()
+        self._related = {}
+        self._indexes = {}
+        if self._held is not None:
+            self._held = {}
+            self._held_order = deque()
+            self._pinned = {}
     
     #                        Transaction Management                        #
     
@@ -606,3 +1564,460 @@ class Sandbox(object):
         else:
             self.rollback()
 
+
+class SandboxPool(object):
+    """Hands out one Sandbox per thread, and reuses it for each request.
+    
+    Creating a new Sandbox for every request discards its (warm) state,
+    such as its magic recallers. Instead, call get() at the start of each
+    request, and release() at the end:
+    
+    pool = store.new_sandbox_pool()
+    
+    def handle_request():
+        box = pool.get()
+        try:
+            ...
+        finally:
+            pool.release()
+    
+    release() flushes the Sandbox (or, if flush is False, rolls it back)
+    and then resets it, so that the next get() in the same thread returns
+    the same (empty) Sandbox. Since a Sandbox must not be shared across
+    threads, each thread gets its own.
+    """
+    
+    def __init__(self, store, max_units=None, coalesce=False):
+        self.store = store
+        self.max_units = max_units
+        self.coalesce = coalesce
+        self._local = threading.local()
+    
+    def get(self):
+        """Return the Sandbox for the current thread."""
+        box = getattr(self._local, 'sandbox', None)
+        if box is None:
+            box = Sandbox(self.store, max_units=self.max_units,
+                          coalesce=self.coalesce)
+            self._local.sandbox = box
+        return box
+    
+    def release(self, flush=True):
+        """Flush (or roll back) and reset the current thread's Sandbox.
+        
+        If the flush fails, the transaction is rolled back (so that the
+        thread's next request does not run inside it) before the error
+        is re-raised.
+        """
+        box = getattr(self._local, 'sandbox', None)
+        if box is None:
+            return
+        try:
+            if flush:
+                try:
+                    box.flush_all()
+                except:
+                    box.rollback()
+                    raise
+            else:
+                box.rollback()
+        finally:
+            box.reset()
+
+
+try:
+    from concurrent.futures import Future
+except ImportError:
+    class Future(object):
+        """A minimal stand-in for concurrent.futures.Future."""
+        
+        def __init__(self):
+            self._done = threading.Event()
+            self._lock = threading.Lock()
+            self._result = None
+            self._exception = None
+            self._callbacks = []
+        
+        def done(self):
+            return self._done.isSet()
+        
+        def result(self, timeout=None):
+            self._done.wait(timeout)
+            if not self._done.isSet():
+                raise errors.DejavuError("Timed out waiting for a result.")
+            if self._exception is not None:
+                raise self._exception
+            return self._result
+        
+        def exception(self, timeout=None):
+            self._done.wait(timeout)
+            if not self._done.isSet():
+                raise errors.DejavuError("Timed out waiting for a result.")
+            return self._exception
+        
+        def add_done_callback(self, fn):
+            self._lock.acquire()
+            try:
+                if not self._done.isSet():
+                    self._callbacks.append(fn)
+                    return
+            finally:
+                self._lock.release()
+            fn(self)
+        
+        def set_result(self, result):
+            self._result = result
+            self._finish()
+        
+        def set_exception(self, exception):
+            self._exception = exception
+            self._finish()
+        
+        def _finish(self):
+            self._lock.acquire()
+            try:
+                self._done.set()
+                callbacks, self._callbacks = self._callbacks, []
+            finally:
+                self._lock.release()
+            for fn in callbacks:
+                fn(self)
+
+
+class AsyncSandbox(object):
+    """A Sandbox whose methods run on a worker thread and return Futures.
+    
+    Each AsyncSandbox owns a (normal) Sandbox, which only its own worker
+    thread uses, so the Sandbox is never shared across threads. Calls are
+    run in the order they were made; each returns a Future (a
+    concurrent.futures.Future, if that module is available), so
+    event-driven code can wait on it without blocking; for example,
+    asyncio code may write:
+    
+    zoo = await asyncio.wrap_future(abox.unit(Zoo, ID=3))
+    
+    Calls to unit() by identifiers which are pending at the same time are
+    answered together, with a single call to Sandbox.units_by_id (and so
+    a single store.unit_many). The worker threads of all AsyncSandboxes
+    of a store share that store's async_slots, which bounds how many of
+    them may use the store at once.
+    
+    The worker thread is started by the first call, and lives until
+    close() is called (or the AsyncSandbox is used in a 'with' block),
+    so any connection or transaction which the Sandbox holds stays on
+    that one thread.
+    
+    Units must not be changed while a call which involves them is pending.
+    """
+    
+    def __init__(self, store, max_units=None, coalesce=False):
+        self.store = store
+        self.sandbox = Sandbox(store, max_units=max_units, coalesce=coalesce)
+        self._jobs = Queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+    
+    def _submit(self, func, args=(), kwargs={}, ident=None):
+        """Queue func(*args, **kwargs) for the worker; return a Future.
+        
+        If ident is not None, it must be a (cls, identity) pair, and func
+        is ignored: the job is answered with the unit of that identity.
+        """
+        future = Future()
+        self._lock.acquire()
+        try:
+            if self._closed:
+                raise ValueError("This AsyncSandbox has been closed.")
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work)
+                self._thread.setDaemon(True)
+                self._thread.start()
+            self._jobs.put((func, args, kwargs, ident, future))
+        finally:
+            self._lock.release()
+        return future
+    
+    def close(self):
+        """Stop the worker thread, once every call made so far has run."""
+        self._lock.acquire()
+        try:
+            if self._closed:
+                return
+            self._closed = True
+            thread = self._thread
+            if thread is not None:
+                # The sentinel which tells the worker to stop.
+                self._jobs.put(None)
+        finally:
+            self._lock.release()
+        if thread is not None and thread is not threading.currentThread():
+            thread.join()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, type, value, tb):
+        self.close()
+    
+    def _work(self):
+        queue = self._jobs
+        while True:
+            # Wait for a job, then take every other pending job with it.
+            jobs = [queue.get()]
+            while True:
+                try:
+                    jobs.append(queue.get_nowait())
+                except Queue.Empty:
+                    break
+            stop = None in jobs
+            if stop:
+                # No job is queued after the sentinel (see close).
+                jobs.remove(None)
+            
+            if jobs:
+                slots = self.store.async_slots
+                slots.acquire()
+                try:
+                    i = 0
+                    while i < len(jobs):
+                        if jobs[i][3] is None:
+                            self._run(jobs[i])
+                            i += 1
+                        else:
+                            # Answer a run of lookups by identity together.
+                            j = i + 1
+                            while j < len(jobs) and jobs[j][3] is not None:
+                                j += 1
+                            self._lookup(jobs[i:j])
+                            i = j
+                finally:
+                    slots.release()
+            
+            if stop:
+                return
+    
+    def _run(self, job):
+        func, args, kwargs, ident, future = job
+        try:
+            result = func(*args, **kwargs)
+        except Exception, x:
+            future.set_exception(x)
+        else:
+            future.set_result(result)
+    
+    def _lookup(self, jobs):
+        groups = {}
+        for job in jobs:
+            cls, id = job[3]
+            groups.setdefault(cls, []).append((id, job[4]))
+        for cls, pending in groups.iteritems():
+            try:
+                ids = [id for id, future in pending]
+                units = self.sandbox.units_by_id(cls, ids)
+            except Exception, x:
+                for id, future in pending:
+                    future.set_exception(x)
+                continue
+            found = dict([(unit.identity(), unit) for unit in units])
+            for id, future in pending:
+                future.set_result(found.get(id))
+    
+    def run(self, func, *args, **kwargs):
+        """Return a Future for func(sandbox, *args, **kwargs)."""
+        return self._submit(func, (self.sandbox,) + args, kwargs)
+    
+    def unit(self, cls, **kwargs):
+        """Return a Future for Sandbox.unit(cls, **kwargs)."""
+        if cls.identifiers and set(kwargs.keys()) == set(cls.identifiers):
+            id = tuple([kwargs[k] for k in cls.identifiers])
+            return self._submit(None, ident=(cls, id))
+        return self._submit(self.sandbox.unit, (cls,), kwargs)
+    
+    def recall(self, classes, expr=None, order=None, limit=None,
+               offset=None, defer=None, prefetch=None):
+        """Return a Future for Sandbox.recall(...)."""
+        return self._submit(self.sandbox.recall, (classes, expr),
+                            {'order': order, 'limit': limit,
+                             'offset': offset, 'defer': defer,
+                             'prefetch': prefetch})
+    
+    def xrecall(self, classes, expr=None, order=None, limit=None,
+                offset=None, defer=None, size=100):
+        """Return an AsyncStream over Sandbox.xrecall(...).
+        
+        The units are recalled on the worker thread, in batches of (at
+        most) size units, only as each batch is asked for.
+        """
+        return AsyncStream(self, classes, expr,
+                           {'order': order, 'limit': limit,
+                            'offset': offset, 'defer': defer}, size)
+    
+    def view(self, query, distinct=False):
+        """Return a Future for Sandbox.view(query, distinct)."""
+        return self._submit(self.sandbox.view, (query, distinct))
+    
+    def count(self, cls, expr=None):
+        """Return a Future for Sandbox.count(cls, expr)."""
+        return self._submit(self.sandbox.count, (cls, expr))
+    
+    def aggregate(self, cls, group_by=(), aggregates=None, expr=None):
+        """Return a Future for Sandbox.aggregate(cls, ...)."""
+        return self._submit(self.sandbox.aggregate,
+                            (cls, group_by, aggregates, expr))
+    
+    def memorize(self, *units):
+        """Return a Future for Sandbox.memorize(*units)."""
+        return self._submit(self.sandbox.memorize, units)
+    
+    def forget(self, *units):
+        """Return a Future for Sandbox.forget(*units)."""
+        return self._submit(self.sandbox.forget, units)
+    
+    def flush_all(self):
+        """Return a Future for Sandbox.flush_all()."""
+        return self._submit(self.sandbox.flush_all)
+
+
+class AsyncStream(object):
+    """Batches of the units of a Sandbox.xrecall, run on an AsyncSandbox.
+    
+    Each call to next() returns a Future for a list of the next (at most
+    'size') units; an empty list means that the recall is exhausted.
+    For example, asyncio code may write:
+    
+    stream = abox.xrecall(Animal, lambda a: a.Legs == 4)
+    while True:
+        animals = await asyncio.wrap_future(stream.next())
+        if not animals:
+            break
+        for animal in animals:
+            deal_with(animal)
+    """
+    
+    def __init__(self, abox, classes, expr, kwargs, size):
+        self.abox = abox
+        self.classes = classes
+        self.expr = expr
+        self.kwargs = kwargs
+        self.size = size
+        self._units = None
+    
+    def next(self):
+        """Return a Future for a list of the next batch of units."""
+        return self.abox._submit(self._fetch)
+    
+    def _fetch(self):
+        if self._units is None:
+            # Start the recall on the worker thread.
+            self._units = self.abox.sandbox.xrecall(self.classes, self.expr,
+                                                    **self.kwargs)
+        batch = []
+        for unit in self._units:
+            batch.append(unit)
+            if len(batch) >= self.size:
+                break
+        return batch
+
+
+class ReadOnlySandbox(Sandbox):
+    """A Sandbox which streams Units from storage without keeping them.
+    
+    Reports and exports often iterate over huge sets of Units which they
+    never change. A normal Sandbox places each of them in its identity map
+    (and indexes them, and reconciles every later query against them);
+    a ReadOnlySandbox instead passes each Unit straight through from
+    storage. Since no Unit is kept, recalling the same Unit twice
+    returns two distinct objects.
+    
+    Any attempt to memorize, forget, or change the value of a property
+    of a Unit of this Sandbox raises errors.ReadOnlyError.
+    """
+    
+    readonly = True
+    
+    def __init__(self, store):
+        Sandbox.__init__(self, store)
+    
+    def memorize(self, *units):
+        """Raise errors.ReadOnlyError."""
+        raise errors.ReadOnlyError("Units cannot be memorized in a "
+                                   "read-only Sandbox.")
+    
+    def forget(self, *units):
+        """Raise errors.ReadOnlyError."""
+        raise errors.ReadOnlyError("Units cannot be forgotten in a "
+                                   "read-only Sandbox.")
+    
+    def _stream(self, unit):
+        """Bind the given unit (from storage) to self; return False to skip."""
+        unit.sandbox = self
+        if hasattr(unit, 'on_recall'):
+            try:
+                unit.on_recall()
+            except errors.UnrecallableError:
+                return False
+        return True
+    
+    def xrecall(self, classes, expr=None, order=None, limit=None,
+                offset=None, defer=None):
+        """Iterator over units of the given class(es) which match expr.
+        
+        Units are yielded straight from storage and are not kept.
+        """
+        if isinstance(classes, dejavu.UnitJoin):
+            rows = self.store._xmultirecall(classes, expr, order=order,
+                                            limit=limit, offset=offset)
+            for unitrow in rows:
+                for unit in unitrow:
+                    if not self._stream(unit):
+                        break
+                else:
+                    yield unitrow
+            return
+        
+        for unit in self.store.xrecall(classes, expr, order=order,
+                                       limit=limit, offset=offset,
+                                       defer=defer):
+            if self._stream(unit):
+                yield unit
+    
+    def unit(self, cls, **kwargs):
+        """A single Unit which matches the given kwargs, else None.
+        
+        The first Unit matching the kwargs is returned; if no Units match,
+        None is returned.
+        """
+        u = self.store.unit(cls, **kwargs)
+        if u is not None and not self._stream(u):
+            return None
+        return u
+    
+    def units_by_id(self, cls, identities):
+        """List of Units of cls for the given identities, in the same order."""
+        identities = [tuple(id) for id in identities]
+        found = self.store.unit_many(cls, identities)
+        units = []
+        for id in identities:
+            u = found.get(id)
+            if u is not None and self._stream(u):
+                units.append(u)
+        return units
+    
+    def prefetch(self, units, paths):
+        """Do nothing; this Sandbox does not keep far Units to answer from."""
+        pass
+    
+    def _related_units(self, association, value, expr=None, order=None):
+        """Return None; far Units are never known without asking storage."""
+        return None
+    
+    def _remember_related(self, association, value, units,
+                          expr=None, order=None):
+        """Do nothing; without a cache, remembered groups are never used."""
+        pass
+    
+    def undefer(self, cls, keys, units=()):
+        """Load the given deferred properties for the given units of cls."""
+        if units:
+            self.store.undefer(cls, keys, units)
@@ -1,14 +1,24 @@
 """Storage Managers for Dejavu."""
 
+from compiler import misc, pycodegen
 import datetime
+import heapq
+import os
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 try:
     set
 except NameError:
     from sets import Set as set
+import sys
+import tempfile
+import threading
 import types
 
 import dejavu
-from dejavu import errors, logflags, recur, sandboxes, xray
+from dejavu import analysis, errors, logflags, recur, sandboxes, xray
 from dejavu.containers import Graph
 from geniusql import logic, astwalk
 
@@ -40,12 +50,35 @@ class StorageManager(object):
     
     def __init__(self, allOptions={}):
         self.classes = set()
+        self._classes_by_name = {}
         self.associations = Graph(directed=False)
         
         # TODO: move these somewhere else
         self.engine_functions = {}
         
         self.logflags = logflags.ERROR + logflags.IO
+        
+        # Number of identities to reserve at once (see _assign_identity).
+        self.id_block_size = int(allOptions.get('id_block_size', 1))
+        self._id_blocks = {}
+        self._id_marks = {}
+        self._id_locks = {}
+        self._id_locks_lock = threading.Lock()
+        
+        # Number of identities to ask for per query (see unit_many).
+        self.unit_many_chunk = int(allOptions.get('unit_many_chunk', 500))
+        
+        # Number of rows which _paginate sorts in memory; larger sorts
+        # are spilled to temporary files in sorted runs and then merged.
+        self.sort_buffer = int(allOptions.get('sort_buffer', 100000))
+        
+        # Created on first use (see save_in_background).
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        
+        # Bounds the worker threads of AsyncSandboxes using this store.
+        self.async_slots = threading.Semaphore(
+            int(allOptions.get('async_workers', 4)))
     
     def shutdown(self, conflicts='error'):
         """Shut down all connections to internal storage.
@@ -61,9 +94,24 @@ class StorageManager(object):
         else:
             print message
     
-    def new_sandbox(self):
-        """Return a new sandbox object bound to self."""
-        return sandboxes.Sandbox(self)
+    def new_sandbox(self, max_units=None, readonly=False, coalesce=False):
+        """Return a new sandbox object bound to self (see Sandbox).
+        
+        If readonly is True, return a ReadOnlySandbox instead.
+        """
+        if readonly:
+            return sandboxes.ReadOnlySandbox(self)
+        return sandboxes.Sandbox(self, max_units=max_units, coalesce=coalesce)
+    
+    def new_async_sandbox(self, max_units=None, coalesce=False):
+        """Return a new AsyncSandbox bound to self (see AsyncSandbox)."""
+        return sandboxes.AsyncSandbox(self, max_units=max_units,
+                                      coalesce=coalesce)
+    
+    def new_sandbox_pool(self, max_units=None, coalesce=False):
+        """Return a new SandboxPool bound to self (see SandboxPool)."""
+        return sandboxes.SandboxPool(self, max_units=max_units,
+                                     coalesce=coalesce)
     
     #                               Schemas                               #
     
@@ -95,10 +143,17 @@ class StorageManager(object):
     
     def class_by_name(self, classname):
         """Return the class object for the given classname."""
-        for cls in self.classes:
-            if cls.__name__ == classname:
-                return cls
-        raise KeyError("No registered class found for '%s'." % classname)
+        # The name table is rebuilt whenever it misses or is stale,
+        # since self.classes may be changed directly.
+        cls = self._classes_by_name.get(classname)
+        if cls is None or cls not in self.classes:
+            self._classes_by_name = dict([(c.__name__, c)
+                                          for c in self.classes])
+            cls = self._classes_by_name.get(classname)
+            if cls is None:
+                raise KeyError("No registered class found for '%s'."
+                               % classname)
+        return cls
     
     def map(self, classes, conflicts='error'):
         """Map classes to internal storage.
@@ -230,6 +285,99 @@ class StorageManager(object):
                                   % self.__class__)
     
     
+    #                             Identifiers                             #
+    
+    def _id_lock(self, cls):
+        """Acquire and return the (in-process) identity lock for cls."""
+        self._id_locks_lock.acquire()
+        try:
+            lock = self._id_locks.get(cls)
+            if lock is None:
+                lock = self._id_locks[cls] = threading.Lock()
+        finally:
+            self._id_locks_lock.release()
+        lock.acquire()
+        return lock
+    
+    def _assign_identity(self, unit, scan):
+        """Set a new identity on the given unit, without scanning storage.
+        
+        scan: a function which returns the identities of all existing
+            units of the unit's class. It is only called when no high-water
+            mark has yet been recorded for the class (see _load_mark).
+        
+        New identities are handed out from a per-class block of
+        self.id_block_size identities. Each block is reserved by moving
+        the class' high-water mark past it, so assigning an identity costs
+        O(1) instead of O(number of units). Stores which are shared between
+        processes should hold their own lock for the class while calling
+        this, and should persist marks by overriding _load_mark/_save_mark.
+        """
+        cls = unit.__class__
+        lock = self._id_lock(cls)
+        try:
+            block = self._id_blocks.get(cls)
+            if not block:
+                mark = self._load_mark(cls)
+                if mark is None:
+                    existing = scan()
+                else:
+                    existing = [mark]
+                # Run the sequencer on a throwaway (sandbox-less) unit,
+                # so the real one sees a single __set__ of its identity.
+                scratch = cls._from_row({}, coerce=False)
+                block = []
+                for i in xrange(max(self.id_block_size, 1)):
+                    unit.sequencer.assign(scratch, existing)
+                    existing = [scratch.identity()]
+                    block.append(existing[0])
+                self._save_mark(cls, existing[0])
+                self._id_blocks[cls] = block
+            identity = block.pop(0)
+        finally:
+            lock.release()
+        
+        for key, value in zip(cls.identifiers, identity):
+            setattr(unit, key, value)
+    
+    def _note_identity(self, unit):
+        """Record the (supplied, not assigned) identity of a new unit.
+        
+        If the identity is beyond the class' high-water mark, the mark is
+        moved up to it, and any block of identities which this process
+        had reserved is discarded, so that it cannot be handed out twice.
+        """
+        cls = unit.__class__
+        identity = unit.identity()
+        lock = self._id_lock(cls)
+        try:
+            block = self._id_blocks.get(cls)
+            if block and identity >= block[0]:
+                del self._id_blocks[cls]
+            mark = self._load_mark(cls)
+            if mark is not None and identity > mark:
+                self._save_mark(cls, identity)
+        finally:
+            lock.release()
+    
+    def _reset_identities(self, cls):
+        """Forget any high-water mark and reserved block for cls."""
+        self._id_blocks.pop(cls, None)
+        self._id_marks.pop(cls, None)
+    
+    def _load_mark(self, cls):
+        """Return the last identity handed out for cls (or None if unknown).
+        
+        This base implementation keeps marks in memory. Override this
+        (and _save_mark) to persist marks in storage.
+        """
+        return self._id_marks.get(cls)
+    
+    def _save_mark(self, cls, identity):
+        """Record the last identity handed out for cls."""
+        self._id_marks[cls] = tuple(identity)
+    
+    
     #                          Data Manipulation                          #
     
     def reserve(self, unit):
@@ -240,16 +388,64 @@ class StorageManager(object):
         """
         raise NotImplementedError
     
+    def reserve_many(self, units):
+        """Reserve storage space for each of the given Units.
+        
+        This base implementation calls reserve for each unit; stores
+        which can reserve many units at once should override it.
+        """
+        for unit in units:
+            self.reserve(unit)
+    
     def save(self, unit, forceSave=False):
         """Store the unit's property values."""
         raise NotImplementedError
     
+    def save_many(self, units, forceSave=False):
+        """Store the property values of each of the given units.
+        
+        This base implementation calls save for each unit; stores
+        which can save many units at once should override it.
+        """
+        for unit in units:
+            self.save(unit, forceSave)
+    
+    def save_in_background(self, units):
+        """Save the given units on a writer thread; return a FlushHandle.
+        
+        All calls for this store share a single BackgroundWriter.
+        """
+        self._writer_lock.acquire()
+        try:
+            if self._writer is None:
+                self._writer = BackgroundWriter(self)
+        finally:
+            self._writer_lock.release()
+        return self._writer.put(units)
+    
     def destroy(self, unit):
         """Delete the unit."""
         raise NotImplementedError
     
-    def xrecall(self, classes, expr=None, order=None, limit=None, offset=None):
-        """Return an iterable of Units."""
+    def destroy_many(self, units):
+        """Delete each of the given units.
+        
+        This base implementation calls destroy for each unit; stores
+        which can delete many units at once should override it.
+        """
+        for unit in units:
+            self.destroy(unit)
+    
+    def xrecall(self, classes, expr=None, order=None, limit=None,
+                offset=None, defer=None):
+        """Return an iterable of Units.
+        
+        defer: a sequence of names of properties which the store need not
+            fetch (see UnitProperty.deferred). If None (the default), the
+            class' own deferred properties are used. Stores which cannot
+            save any work by deferring simply return complete units.
+            This is ignored when recalling a UnitJoin.
+        """
         if limit == 0:
             return
         if offset and not order:
@@ -263,6 +459,20 @@ class StorageManager(object):
         
         raise NotImplementedError
     
+    def undefer(self, cls, keys, units):
+        """Load the given deferred properties into the given units.
+        
+        Each of the given units of cls must have deferred all of the given
+        keys. This base implementation recalls each unit in full; stores
+        which defer properties should override it to load all of the
+        units at once.
+        """
+        for unit in units:
+            expr = logic.filter(**dict(zip(cls.identifiers, unit.identity())))
+            for full in self.xrecall(cls, expr, limit=1, defer=()):
+                unit._set_deferred(dict([(key, full._properties[key])
+                                         for key in keys]))
+    
     def recall(self, classes, expr=None, order=None, limit=None, offset=None):
         """Return a sequence of Unit instances which satisfy the expression."""
         return [x for x in self.xrecall(classes, expr, order=order,
@@ -279,6 +489,30 @@ class StorageManager(object):
         except StopIteration:
             return None
     
+    def unit_many(self, cls, identities):
+        """Return a dict of {identity: Unit} for the given identities of cls.
+        
+        Each identity is a tuple of values, in the order of cls.identifiers;
+        identities which match no Unit are omitted from the result. This
+        base class recalls the Units with one query (an IN filter on the
+        identifiers) per self.unit_many_chunk identities.
+        """
+        if not cls.identifiers:
+            return {}
+        
+        identities = list(set(identities))
+        found = {}
+        size = max(self.unit_many_chunk, 1)
+        for i in xrange(0, len(identities), size):
+            chunk = identities[i:i + size]
+            wanted = set(chunk)
+            expr = sandboxes._identity_filter(cls.identifiers, chunk)
+            for unit in self.xrecall(cls, expr):
+                id = unit.identity()
+                if id in wanted:
+                    found[id] = unit
+        return found
+    
     def _sort_func(self, order):
         """Return a function (for use with list.sort) from the given order."""
         if order is None:
@@ -313,6 +547,32 @@ class StorageManager(object):
                             "types (list, lambda, None, or Expression)." %
                             order)
     
+    def _sort_key(self, order):
+        """Return a key function (for use with list.sort) from the given order.
+        
+        Rows are ordered as by _sort_func, but each row's key is computed
+        only once (see analysis.column_key).
+        """
+        if order is None:
+            return None
+        elif isinstance(order, types.FunctionType):
+            triples = OrderDeparser(logic.Expression(order)).triples()
+        elif isinstance(order, logic.Expression):
+            triples = OrderDeparser(order).triples()
+        elif isinstance(order, (list, tuple)):
+            triples = [(0, attr.split(" ", 1)[0], attr.endswith(" DESC"))
+                       for attr in order]
+        else:
+            raise TypeError("The 'order' value %r is not one of the allowed "
+                            "types (list, lambda, None, or Expression)." %
+                            order)
+        
+        column_key = analysis.column_key
+        def sort_key(row):
+            return tuple([column_key(getattr(row[index], attr), descending)
+                          for index, attr, descending in triples])
+        return sort_key
+    
     def _paginate(self, data, order=None, limit=None, offset=None, single=False):
         """Manually apply ORDER, LIMIT, and OFFSET operators to a unit stream.
         
@@ -324,12 +584,15 @@ class StorageManager(object):
         This is a helper function for those Storage Managers which must
         provide their own implementation of ORDER, LIMIT, and OFFSET
         operators. If possible, faster native backends should be used.
+        
+        Ordered data of more than self.sort_buffer rows is sorted using
+        temporary files, into which the class and properties of each unit
+        (not the units themselves) are pickled; units read back from them
+        are new, clean instances.
         """
         if order:
-            # Collapse data iterable into a list.
-            data = list(data)
-            data.sort(self._sort_func(order))
-            data = iter(data)
+            data = self._ordered(data, self._sort_key(order), limit, offset,
+                                 _UnitRowPickler())
         elif offset:
             raise TypeError("Order argument expected when offset is provided.")
         
@@ -352,6 +615,17 @@ class StorageManager(object):
         except StopIteration:
             return
     
+    def _ordered(self, data, key, limit=None, offset=None, pickler=None):
+        """Return an iterator over the given rows, sorted by key.
+        
+        If a limit is given, only the first offset + limit rows can be
+        yielded, so (if they fit in self.sort_buffer) no more than that
+        are kept or sorted. Otherwise, see _sorted.
+        """
+        if limit is not None and (offset or 0) + limit <= self.sort_buffer:
+            return iter(_smallest(data, key, (offset or 0) + limit))
+        return iter(_sorted(data, key, self.sort_buffer, pickler))
+    
     #                                Views                                #
     #
     # The _combine, view, xview, and _multirecall method given below use
@@ -361,19 +635,24 @@ class StorageManager(object):
     # here as a fallback mechanism only.
     
     def _combine(self, unitjoin, filters):
-        """Return (flat) rows of Unit objects for the given (recursive) join."""
+        """Return (flat) rows of Unit objects for the given (recursive) join.
+        
+        This is a hash join: the rows of one side are grouped by their
+        join key in a dict, and the rows of the other side look up their
+        matches in it, so the cost is linear in the size of each side.
+        """
         cls1, cls2 = unitjoin.class1, unitjoin.class2
         
         if isinstance(cls1, dejavu.UnitJoin):
-            table1 = self._combine(cls1, filters)
-            classlist1 = iter(cls1)
+            table1 = list(self._combine(cls1, filters))
+            classlist1 = list(cls1)
         else:
             table1 = [[x] for x in self.recall(cls1, filters[cls1])]
             classlist1 = [cls1]
         
         if isinstance(cls2, dejavu.UnitJoin):
-            table2 = self._combine(cls2, filters)
-            classlist2 = iter(cls2)
+            table2 = list(self._combine(cls2, filters))
+            classlist2 = list(cls2)
         else:
             table2 = [[x] for x in self.recall(cls2, filters[cls2])]
             classlist2 = [cls2]
@@ -400,57 +679,48 @@ class StorageManager(object):
         # Yield rows of Unit instances
         if unitjoin.leftbiased is None:
             # INNER JOIN
-            # Flatten the inner generator to iterate over it multiple times.
-            table2 = list(table2)
-            for row1 in table1:
-                nearVal = getattr(row1[indexA], nearKey)
+            # Build the hash table from the smaller side.
+            if len(table1) <= len(table2):
+                matches = _hash_rows(table1, indexA, nearKey)
                 for row2 in table2:
-                    # Test against join constraint
                     farVal = getattr(row2[indexB], farKey)
-                    if nearVal == farVal:
+                    for row1 in matches.get(farVal, ()):
+                        yield row1 + row2
+            else:
+                matches = _hash_rows(table2, indexB, farKey)
+                for row1 in table1:
+                    nearVal = getattr(row1[indexA], nearKey)
+                    for row2 in matches.get(nearVal, ()):
                         yield row1 + row2
         elif unitjoin.leftbiased is True:
             # LEFT JOIN
-            # Flatten the inner generator to iterate over it multiple times.
-            table2 = list(table2)
+            matches = _hash_rows(table2, indexB, farKey)
             for row1 in table1:
-                nearVal = getattr(row1[indexA], nearKey)
-                found = False
-                for row2 in table2:
-                    # Test against join constraint
-                    farVal = getattr(row2[indexB], farKey)
-                    if nearVal == farVal:
+                found = matches.get(getattr(row1[indexA], nearKey))
+                if found:
+                    for row2 in found:
                         yield row1 + row2
-                        found = True
-                if not found:
+                else:
                     # Yield dummy objects for table2
-                    yield row1 + [unit.__class__() for unit in row2]
+                    yield row1 + [cls() for cls in classlist2]
         else:
             # RIGHT JOIN
-            # Flatten the inner generator to iterate over it multiple times.
-            table1 = list(table1)
+            matches = _hash_rows(table1, indexA, nearKey)
             for row2 in table2:
-                unitB = row2[indexB]
-                farVal = getattr(unitB, farKey)
-                found = False
-                for row1 in table1:
-                    # Test against join constraint
-                    nearVal = getattr(row1[indexA], nearKey)
-                    if nearVal == farVal:
+                found = matches.get(getattr(row2[indexB], farKey))
+                if found:
+                    for row1 in found:
                         yield row1 + row2
-                        found = True
-                if not found:
+                else:
                     # Yield dummy objects for table1
-                    yield [unit.__class__() for unit in row1] + row2
+                    yield [cls() for cls in classlist1] + row2
     
     def _xmultirecall(self, classes, expr=None, order=None, limit=None, offset=None):
         """Yield lists of units of the given classes which match expr."""
         if not isinstance(expr, logic.Expression):
             expr = logic.Expression(expr)
         
-        # TODO: deconstruct expr into a set of subexpr's, one for
-        # each class in classes.
-        filters = dict([(cls, None) for cls in classes])
+        filters = join_filters(classes, expr)
         
         def _combine_inner():
             for unitrow in self._combine(classes, filters):
@@ -488,59 +758,70 @@ class StorageManager(object):
         
         seen = {}
         
+        # Only the first offset + limit rows need be sorted, unless
+        # duplicates are to be dropped (after sorting).
+        bound = limit
+        if distinct:
+            bound = None
+        
         if isinstance(query.relation, dejavu.UnitJoin):
-            # TODO: deconstruct expr into a set of subexpr's, one for
-            # each class in classes.
-            filters = dict([(cls, None) for cls in query.relation])
+            filters = join_filters(query.relation, expr)
             data = self._combine(query.relation, filters)
-            if order:
-                data = [unit for unit in data]
-                data.sort(dejavu.sort(order))
-                data = iter(data)
+            sort_key = self._sort_key(order)
             
-            def puller():
-                for unitrow in data:
-                    if expr is None or expr(*unitrow):
-                        if attr_is_expr:
-                            datarow = tuple(query.attributes(*unitrow))
-                        else:
-                            datarow = []
-                            for i, attrs in enumerate(query.attributes):
-                                unit = unitrow[i]
-                                if attrs is None:
-                                    # Return all attributes (TODO: what sort order?)
-                                    raise NotImplementedError("Attribute order is undefined.")
-                                else:
-                                    for attr in attrs:
-                                        datarow.append(getattr(unit, attr))
-                            datarow = tuple(datarow)
-                        if distinct:
-                            if datarow not in seen:
-                                yield datarow
-                                seen[datarow] = None
-                        else:
-                            yield datarow
+            def project(unitrow):
+                if expr is not None and not expr(*unitrow):
+                    return None
+                if attr_is_expr:
+                    return tuple(query.attributes(*unitrow))
+                datarow = []
+                for i, attrs in enumerate(query.attributes):
+                    unit = unitrow[i]
+                    if attrs is None:
+                        # Return all attributes (TODO: what sort order?)
+                        raise NotImplementedError("Attribute order is undefined.")
+                    else:
+                        for attr in attrs:
+                            datarow.append(getattr(unit, attr))
+                return tuple(datarow)
         else:
-            data = self.recall(query.relation, expr)
+            data = self.xrecall(query.relation, expr)
             if order:
-                data.sort(dejavu.sort(order))
-                data = iter(data)
+                sort_key = dejavu.sort_key(order)
             
-            def puller():
-                for unit in data:
-                    if expr is None or expr(unit):
-                        # Use tuples for hashability.
-                        if attr_is_expr:
-                            datarow = tuple(query.attributes(unit))
-                        else:
-                            datarow = tuple([getattr(unit, attr)
-                                             for attr in query.attributes])
-                        if distinct:
-                            if datarow not in seen:
-                                yield datarow
-                                seen[datarow] = None
-                        else:
-                            yield datarow
+            def project(unit):
+                if expr is not None and not expr(unit):
+                    return None
+                # Use tuples for hashability.
+                if attr_is_expr:
+                    return tuple(query.attributes(unit))
+                return tuple([getattr(unit, attr)
+                              for attr in query.attributes])
+        
+        def projected(rows):
+            for row in rows:
+                datarow = project(row)
+                if datarow is not None:
+                    if order:
+                        # Sort (key, datarow) pairs rather than units,
+                        # so that large results can be spilled to disk.
+                        yield (sort_key(row), datarow)
+                    else:
+                        yield datarow
+        data = projected(data)
+        if order:
+            data = self._ordered(data, _first, bound, offset)
+        
+        def puller():
+            for datarow in data:
+                if order:
+                    datarow = datarow[1]
+                if distinct:
+                    if datarow not in seen:
+                        yield datarow
+                        seen[datarow] = None
+                else:
+                    yield datarow
         
         ordered_data = puller()
         try:
@@ -566,7 +847,7 @@ class StorageManager(object):
         if cls.identifiers:
             uniq = cls.identifiers
         else:
-            uniq = cls._properties.keys()
+            uniq = cls.properties
         return len(self.view((cls, uniq, expr), distinct=True))
     
     def range(self, cls, attr, expr=None):
@@ -584,13 +865,18 @@ class StorageManager(object):
         unicode, or float) then all distinct, non-None values are returned
         (sorted, if possible).
         """
-        query = dejavu.Query(cls, [attr], expr)
-        existing = [x[0] for x in self.xview(query, distinct=True)
-                    if x is not None]
+        attr_type = getattr(cls, attr).type
+        if issubclass(attr_type, (int, long, datetime.date)):
+            # Only the bounds are needed; let storage find them.
+            existing = [x for x in self.bounds(cls, attr, expr)
+                        if x is not None]
+        else:
+            query = dejavu.Query(cls, [attr], expr)
+            existing = [x[0] for x in self.xview(query, distinct=True)
+                        if x is not None]
         if not existing:
             return []
         
-        attr_type = getattr(cls, attr).type
         if issubclass(attr_type, (int, long)):
             return range(min(existing), max(existing) + 1)
         else:
@@ -614,6 +900,34 @@ class StorageManager(object):
         return sum([row[0] for row in
                     self.xview(dejavu.Query(cls, (attr,), expr))])
     
+    def bounds(self, cls, attr, expr=None):
+        """(min, max) of all non-None values for cls.attr, or (None, None)."""
+        expr = logic.Expression(lambda x: getattr(x, attr) != None) + expr
+        existing = [row[0] for row in
+                    self.xview(dejavu.Query(cls, (attr,), expr),
+                               distinct=True)]
+        if not existing:
+            return None, None
+        return min(existing), max(existing)
+    
+    def aggregate(self, cls, group_by=(), aggregates=None, expr=None):
+        """Return {group key: {name: value}} for the Units which match expr.
+        
+        group_by: a sequence of attribute names of cls (or callables);
+            the key of each group is a tuple of their values.
+        aggregates: a dict of {name: aggregate function}, such as
+            {'n': analysis.COUNT, 'total': analysis.SUM('Price')}.
+            If None, {'count': analysis.COUNT} is used.
+        
+        This base method streams the matching Units through an
+        analysis.Aggregator, which keeps only one running value for
+        each aggregate of each group.
+        """
+        aggregator = analysis.Aggregator(group_by, aggregates)
+        for unit in self.xrecall(cls, expr):
+            aggregator.add(unit)
+        return aggregator.results()
+    
     #                            Transactions                             #
     
     # By default, stores do not support Transactions.
@@ -634,13 +948,17 @@ class OrderDeparser(astwalk.ASTDeparser):
         self.expr = expr
         astwalk.ASTDeparser.__init__(self, expr.ast)
     
-    def sort_func(self):
-        """Walk self and return a function (for use with list.sort)."""
+    def triples(self):
+        """Walk self and return a list of [index, attr, descending] lists."""
         root = self.ast.root
         if not isinstance(root, (astwalk.ast.Tuple, astwalk.ast.List)):
             raise ValueError("Attribute AST roots must be Tuple or List, "
                              "not %s" % root.__class__.__name__)
-        triples = [self.walk(term) for term in root.getChildren()]
+        return [self.walk(term) for term in root.getChildren()]
+    
+    def sort_func(self):
+        """Walk self and return a function (for use with list.sort)."""
+        triples = self.triples()
         
         def sort_func(x, y):
             for index, attr, descending in triples:
@@ -771,7 +1089,12 @@ class ProxyStorage(StorageManager):
         """
         return self.nextstore.unit(cls, **kwargs)
     
-    def xrecall(self, classes, expr=None, order=None, limit=None, offset=None):
+    def unit_many(self, cls, identities):
+        """Return a dict of {identity: Unit} for the given identities of cls."""
+        return self.nextstore.unit_many(cls, identities)
+    
+    def xrecall(self, classes, expr=None, order=None, limit=None,
+                offset=None, defer=None):
         """Return an iterable of Units."""
         if limit == 0:
             return
@@ -788,21 +1111,40 @@ class ProxyStorage(StorageManager):
         if self.logflags & logflags.RECALL:
             self.log(logflags.RECALL.message(cls, expr))
         for unit in self.nextstore.xrecall(cls, expr, order=order,
-                                           limit=limit, offset=offset):
+                                           limit=limit, offset=offset,
+                                           defer=defer):
             yield unit
     
+    def undefer(self, cls, keys, units):
+        """Load the given deferred properties into the given units."""
+        self.nextstore.undefer(cls, keys, units)
+    
     def save(self, unit, forceSave=False):
         """Store the unit."""
         if self.logflags & logflags.SAVE:
             self.log(logflags.SAVE.message(unit, forceSave))
         self.nextstore.save(unit, forceSave)
     
+    def save_many(self, units, forceSave=False):
+        """Store each of the given units."""
+        if self.logflags & logflags.SAVE:
+            for unit in units:
+                self.log(logflags.SAVE.message(unit, forceSave))
+        self.nextstore.save_many(units, forceSave)
+    
     def destroy(self, unit):
         """Delete the unit."""
         if self.logflags & logflags.DESTROY:
             self.log(logflags.DESTROY.message(unit))
         self.nextstore.destroy(unit)
     
+    def destroy_many(self, units):
+        """Delete each of the given units."""
+        if self.logflags & logflags.DESTROY:
+            for unit in units:
+                self.log(logflags.DESTROY.message(unit))
+        self.nextstore.destroy_many(units)
+    
     def reserve(self, unit):
         """Reserve storage space for the Unit."""
         self.nextstore.reserve(unit)
@@ -812,6 +1154,14 @@ class ProxyStorage(StorageManager):
         if self.logflags & logflags.RESERVE:
             self.log(logflags.RESERVE.message(unit))
     
+    def reserve_many(self, units):
+        """Reserve storage space for each of the given Units."""
+        self.nextstore.reserve_many(units)
+        
+        if self.logflags & logflags.RESERVE:
+            for unit in units:
+                self.log(logflags.RESERVE.message(unit))
+    
     def xview(self, query, order=None, limit=None, offset=None, distinct=False):
         """Yield property tuples for the given query."""
         if limit == 0:
@@ -827,6 +1177,22 @@ class ProxyStorage(StorageManager):
         return self.nextstore.xview(query, order=order, limit=limit,
                                     offset=offset, distinct=distinct)
     
+    def count(self, cls, expr=None):
+        """Number of Units of the given cls which match the given expr."""
+        return self.nextstore.count(cls, expr)
+    
+    def sum(self, cls, attr, expr=None):
+        """Sum of all non-None values for the given cls.attr."""
+        return self.nextstore.sum(cls, attr, expr)
+    
+    def bounds(self, cls, attr, expr=None):
+        """(min, max) of all non-None values for cls.attr, or (None, None)."""
+        return self.nextstore.bounds(cls, attr, expr)
+    
+    def aggregate(self, cls, group_by=(), aggregates=None, expr=None):
+        """Return {group key: {name: value}} for the Units which match expr."""
+        return self.nextstore.aggregate(cls, group_by, aggregates, expr)
+    
     def _xmultirecall(self, classes, expr=None, order=None, limit=None, offset=None):
         """Full inner join units from each class."""
         if self.logflags & logflags.RECALL:
@@ -968,6 +1334,63 @@ class ProxyStorage(StorageManager):
             self.nextstore.commit()
 
 
+class FileMarks(object):
+    """Mixin which keeps identity high-water marks in class.seq files.
+    
+    For stores which keep each class in its own directory, given by
+    self.shelf(cls). List this before StorageManager in the bases.
+    """
+    
+    def _load_mark(self, cls):
+        """Return the high-water mark for cls from its class.seq file.
+        
+        If the file is missing or cannot be read, return None, so that
+        the existing identities are scanned instead.
+        """
+        fname = os.path.join(self.shelf(cls), "class.seq")
+        try:
+            f = open(fname, 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                mark = pickle.loads(f.read())
+            except Exception:
+                return None
+        finally:
+            f.close()
+        if not isinstance(mark, tuple):
+            return None
+        return mark
+    
+    def _save_mark(self, cls, identity):
+        """Persist the high-water mark for cls in its class.seq file.
+        
+        The mark is written to a temporary file which then replaces
+        class.seq, so a crash cannot leave a partly-written mark.
+        This assumes we have a lock on the class.
+        """
+        path = self.shelf(cls)
+        fname = os.path.join(path, "class.seq")
+        fd, tmpname = tempfile.mkstemp(".tmp", "class.seq.", path)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(pickle.dumps(tuple(identity)))
+            finally:
+                f.close()
+            try:
+                os.rename(tmpname, fname)
+            except OSError:
+                # Windows won't rename over an existing file.
+                os.remove(fname)
+                os.rename(tmpname, fname)
+        except:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+            raise
+
+
 class Version(object):
     
     def __init__(self, atoms):
@@ -1056,3 +1479,412 @@ def resolve(store, options=None):
     
     return store
 
+
+def _preserved(unitjoin):
+    """Return (cls, preserved) for each class in the given (recursive) join.
+    
+    A class is not preserved if some outer join may pair its rows with
+    dummy units instead of dropping them.
+    """
+    sides = []
+    for side in (unitjoin.class1, unitjoin.class2):
+        if isinstance(side, dejavu.UnitJoin):
+            sides.append(_preserved(side))
+        else:
+            sides.append([(side, True)])
+    left, right = sides
+    if unitjoin.leftbiased is True:
+        right = [(cls, False) for cls, preserved in right]
+    elif unitjoin.leftbiased is False:
+        left = [(cls, False) for cls, preserved in left]
+    return left + right
+
+
+# Names which an Expression may hold without referring to any argument.
+_constant_names = ('None', 'True', 'False')
+
+def _arguments(node, args):
+    """Return the set of args to which the given AST node refers, or None.
+    
+    None is returned if node refers to any other name, or binds names
+    of its own (as a lambda or comprehension does).
+    """
+    if isinstance(node, astwalk.ast.Name):
+        if node.name in args:
+            return set([node.name])
+        elif node.name in _constant_names:
+            return set()
+        return None
+    if isinstance(node, (astwalk.ast.Lambda, astwalk.ast.GenExpr,
+                         astwalk.ast.ListComp)):
+        return None
+    found = set()
+    for child in node.getChildNodes():
+        names = _arguments(child, args)
+        if names is None:
+            return None
+        found.update(names)
+    return found
+
+def _lambda(arg, nodes):
+    """Return an Expression of one arg which requires every given AST node."""
+    if len(nodes) == 1:
+        body = nodes[0]
+    else:
+        body = astwalk.ast.And(nodes)
+    tree = astwalk.ast.Expression(astwalk.ast.Lambda([arg], [], 0, body))
+    misc.set_filename('<conjunct>', tree)
+    code = pycodegen.ExpressionCodeGenerator(tree).getCode()
+    return logic.Expression(eval(code, {}))
+
+def conjuncts(expr, count):
+    """Return a list of count Expressions (or None) which expr requires.
+    
+    The i'th Expression takes a single argument, and combines each operand
+    of expr's top-level 'and' which refers to no argument but the i'th
+    one; it is None if there are no such operands. Any row of arguments
+    which matches expr also matches each of the returned Expressions, so
+    they may be used to filter each argument before a join, but callers
+    must still test each row against the whole expr.
+    """
+    result = [None] * count
+    if (expr is None or getattr(expr, "kwargs", None)
+        or getattr(expr, "ast", None) is None):
+        return result
+    args = list(expr.ast.args)
+    if len(args) != count:
+        return result
+    
+    root = expr.ast.root
+    if isinstance(root, astwalk.ast.And):
+        operands = root.nodes
+    else:
+        operands = [root]
+    
+    parts = [[] for arg in args]
+    for operand in operands:
+        names = _arguments(operand, args)
+        if names and len(names) == 1:
+            parts[args.index(names.pop())].append(operand)
+    
+    for index, nodes in enumerate(parts):
+        if nodes:
+            result[index] = _lambda(args[index], nodes)
+    return result
+
+
+def join_filters(unitjoin, expr):
+    """Return a dict of {cls: Expression or None} for the given join.
+    
+    Each Expression is formed from those operands of expr's top-level
+    'and' which refer to that class alone, so it can be used to filter
+    the units of that class before they are joined. The whole expr must
+    still be applied to each joined row. Classes which appear more than
+    once in the join, or which an outer join may pair with dummy units,
+    are not filtered.
+    """
+    classes = _preserved(unitjoin)
+    filters = dict([(cls, None) for cls, preserved in classes])
+    if expr is None or getattr(expr, "func", None) is None:
+        return filters
+    
+    counts = {}
+    for cls, preserved in classes:
+        counts[cls] = counts.get(cls, 0) + 1
+    parts = conjuncts(expr, len(classes))
+    for (cls, preserved), part in zip(classes, parts):
+        if preserved and counts[cls] == 1:
+            filters[cls] = part
+    return filters
+
+
+def _first(row):
+    """Return row[0] (the sort key of a decorated row)."""
+    return row[0]
+
+
+def _hash_rows(rows, index, key):
+    """Return a dict of {value: [rows]} for the key attr of each row[index]."""
+    table = {}
+    for row in rows:
+        value = getattr(row[index], key)
+        group = table.get(value)
+        if group is None:
+            table[value] = [row]
+        else:
+            group.append(row)
+    return table
+
+
+def _smallest(rows, key, n):
+    """Return a list of the n smallest rows (by key), in order.
+    
+    Only n rows are kept in memory at a time. Rows with equal keys
+    keep their original order.
+    """
+    if n <= 0:
+        return []
+    # A heap of the n smallest rows so far, greatest first (by key and
+    # then position, so the rows themselves are never compared).
+    heap = []
+    for i, row in enumerate(rows):
+        entry = (analysis.Descending((key(row), i)), row)
+        if len(heap) < n:
+            heapq.heappush(heap, entry)
+        elif entry[0] > heap[0][0]:
+            heapq.heapreplace(heap, entry)
+    heap.sort()
+    heap.reverse()
+    return [row for k, row in heap]
+
+
+def _sorted(rows, key, buffer_size, pickler=None):
+    """Return an iterable of the given rows, sorted by key.
+    
+    If there are more than buffer_size rows, they are written (pickled)
+    to temporary files in sorted runs of buffer_size rows, and the runs
+    are then merged, so that only one row per run is held in memory.
+    Rows with equal keys keep their original order.
+    
+    pickler: if given, an object with dump(row) and load(state) methods;
+        each row is written as pickler.dump(row), and read back with
+        pickler.load. If None, rows are pickled as they are.
+    """
+    runs = []
+    run = []
+    for i, row in enumerate(rows):
+        # Decorate with the position, so the rows are never compared.
+        run.append(((key(row), i), row))
+        if buffer_size and len(run) >= buffer_size:
+            runs.append(_spill(run, pickler))
+            run = []
+    
+    if not runs:
+        run.sort()
+        return [row for k, row in run]
+    if run:
+        runs.append(_spill(run, pickler))
+    return _merge_runs(runs, key, pickler)
+
+
+def _spill(run, pickler=None):
+    """Sort the given decorated rows into a new temporary file; return it."""
+    run.sort()
+    f = tempfile.TemporaryFile()
+    for (k, i), row in run:
+        if pickler is not None:
+            row = pickler.dump(row)
+        pickle.dump((i, row), f, -1)
+    f.seek(0)
+    return f
+
+
+def _read_run(f, pickler=None):
+    """Yield (position, row) pairs from a file written by _spill."""
+    while True:
+        try:
+            i, row = pickle.load(f)
+        except EOFError:
+            f.close()
+            return
+        if pickler is not None:
+            row = pickler.load(row)
+        yield i, row
+
+
+def _merge_runs(runs, key, pickler=None):
+    """Yield the rows of the given sorted runs (files), merged by key.
+    
+    The files are closed when the merge finishes, or when the caller
+    stops iterating (and the generator is closed or collected).
+    """
+    try:
+        readers = [_read_run(f, pickler) for f in runs]
+        heap = []
+        for n, reader in enumerate(readers):
+            try:
+                i, row = reader.next()
+            except StopIteration:
+                continue
+            heap.append(((key(row), i), n, row))
+        heapq.heapify(heap)
+        
+        while heap:
+            k, n, row = heap[0]
+            yield row
+            try:
+                i, row = readers[n].next()
+            except StopIteration:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, ((key(row), i), n, row))
+    finally:
+        for f in runs:
+            f.close()
+
+
+class _UnitRowPickler(object):
+    """Convert rows of units to and from picklable (class, properties) states.
+    
+    Units themselves are not pickled, since Unit.__getstate__ must load
+    any deferred properties (which store-level units cannot do). Classes
+    are written as positions in self.classes, so they need not be
+    importable by name.
+    """
+    
+    def __init__(self):
+        self.classes = []
+    
+    def dump(self, row):
+        state = []
+        for unit in row:
+            cls = unit.__class__
+            try:
+                n = self.classes.index(cls)
+            except ValueError:
+                n = len(self.classes)
+                self.classes.append(cls)
+            props = unit._properties
+            if isinstance(props, dejavu.CompactProperties):
+                props = props.copy()
+            state.append((n, props, tuple(unit._deferred or ())))
+        return tuple(state)
+    
+    def load(self, state):
+        row = []
+        for n, props, deferred in state:
+            cls = self.classes[n]
+            row.append(cls._loader(coerce=False, deferred=deferred)(props))
+        return tuple(row)
+
+
+def group_units(units, key=None):
+    """Return a list of (key, [units]) pairs for the given units.
+    
+    key: a function of one unit. If None (the default), units are
+        grouped by their class. Groups are returned in the order in
+        which their first unit appears.
+    """
+    keys = []
+    groups = {}
+    for unit in units:
+        if key is None:
+            k = unit.__class__
+        else:
+            k = key(unit)
+        group = groups.get(k)
+        if group is None:
+            group = groups[k] = []
+            keys.append(k)
+        group.append(unit)
+    return [(k, groups[k]) for k in keys]
+
+
+class FlushHandle(object):
+    """The pending result of a background save (see BackgroundWriter).
+    
+    error: None while pending or on success; otherwise, the sys.exc_info()
+        of the exception which the save raised.
+    """
+    
+    def __init__(self):
+        self.error = None
+        self._done = threading.Event()
+    
+    def done(self):
+        """Return True if the save has completed (or failed)."""
+        return self._done.isSet()
+    
+    def wait(self, timeout=None):
+        """Block until the save completes, re-raising any error it raised.
+        
+        If a timeout (in seconds) is given and expires first, return False.
+        """
+        self._done.wait(timeout)
+        if not self._done.isSet():
+            return False
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return True
+    
+    def _finish(self, error=None):
+        self.error = error
+        self._done.set()
+
+
+class BackgroundWriter(object):
+    """Saves Units for a StorageManager on a separate thread.
+    
+    Each call to put() queues a batch of Units and returns a FlushHandle.
+    Only the Units which are dirty when they are put are queued. The writer
+    thread saves every batch which is pending when it wakes with a single
+    call to store.save_many (inside a transaction, if the store supports
+    them), so Units of each class are saved in the order in which they
+    were put. If that fails, each batch is saved again on its own, so that
+    each handle reports only its own error. Since the failed call may have
+    cleansed some Units before its transaction was rolled back, every
+    save is forced. The thread exits when there is nothing left to save.
+    """
+    
+    def __init__(self, store):
+        self.store = store
+        self.pending = []
+        self.thread = None
+        self.lock = threading.Lock()
+    
+    def put(self, units):
+        """Queue the given units to be saved, and return a FlushHandle."""
+        handle = FlushHandle()
+        units = [unit for unit in units if unit.dirty()]
+        self.lock.acquire()
+        try:
+            self.pending.append((units, handle))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run)
+                self.thread.setDaemon(True)
+                self.thread.start()
+        finally:
+            self.lock.release()
+        return handle
+    
+    def run(self):
+        while True:
+            self.lock.acquire()
+            try:
+                batches = self.pending
+                self.pending = []
+                if not batches:
+                    self.thread = None
+                    return
+            finally:
+                self.lock.release()
+            
+            units = []
+            for batch, handle in batches:
+                units.extend(batch)
+            try:
+                self._save(units)
+            except:
+                for batch, handle in batches:
+                    try:
+                        self._save(batch)
+                    except:
+                        handle._finish(sys.exc_info())
+                    else:
+                        handle._finish()
+            else:
+                for batch, handle in batches:
+                    handle._finish()
+    
+    def _save(self, units):
+        store = self.store
+        if store.start:
+            store.start()
+        try:
+            store.save_many(units, forceSave=True)
+            if store.commit:
+                store.commit()
+        except:
+            if store.rollback:
+                store.rollback()
+            raise
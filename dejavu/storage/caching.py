@@ -68,7 +68,31 @@ class ObjectCache(ProxyStorage):
         
         return u
     
-    def xrecall(self, classes, expr=None, order=None, limit=None, offset=None):
+    def unit_many(self, cls, identities):
+        """Return a dict of {identity: Unit} for the given identities of cls.
+        
+        Units which are not in the cache are fetched from the next store
+        all at once, and then cached.
+        """
+        identities = list(identities)
+        found = {}
+        if cls in self.cache.classes:
+            found = self.cache.unit_many(cls, identities)
+        
+        missing = [id for id in identities if id not in found]
+        if missing:
+            fetched = self.nextstore.unit_many(cls, missing)
+            if fetched:
+                try:
+                    self.cache.save_many(fetched.values(), forceSave=True)
+                except KeyError:
+                    # The cache refused to save the units (possibly full).
+                    pass
+                found.update(fetched)
+        return found
+    
+    def xrecall(self, classes, expr=None, order=None, limit=None,
+                offset=None, defer=None):
         """Return a Unit iterator."""
         if isinstance(classes, dejavu.UnitJoin):
             for unitrow in self._xmultirecall(classes, expr, order=order,
@@ -122,8 +146,11 @@ class ObjectCache(ProxyStorage):
                     seen[id] = None
                     yield unit
         else:
+            # Uncached classes may defer properties; cached ones may not,
+            # since the cache must hold complete units.
             for unit in self.nextstore.xrecall(cls, expr, order=order,
-                                               limit=limit, offset=offset):
+                                               limit=limit, offset=offset,
+                                               defer=defer):
                 yield unit
     
     def _xmultirecall(self, classes, expr=None, order=None, limit=None, offset=None):
@@ -186,6 +213,35 @@ class ObjectCache(ProxyStorage):
         self.nextstore.destroy(unit)
         self.invalidate(unit)
     
+    def save_many(self, units, forceSave=False):
+        """Store each of the given units."""
+        if self.logflags & logflags.SAVE:
+            for unit in units:
+                self.log(logflags.SAVE.message(unit, forceSave))
+        
+        # nextstore might call unit.cleanse()
+        update_cache = [unit for unit in units
+                        if unit.identifiers
+                        and unit.__class__ in self.cache.classes
+                        and (forceSave or unit.dirty())]
+        self.nextstore.save_many(units, forceSave)
+        for unit in update_cache:
+            try:
+                self.cache.save(unit, forceSave=True)
+            except KeyError:
+                # The cache refused to save the unit (possibly full).
+                pass
+    
+    def destroy_many(self, units):
+        """Delete each of the given units."""
+        if self.logflags & logflags.DESTROY:
+            for unit in units:
+                self.log(logflags.DESTROY.message(unit))
+        
+        self.nextstore.destroy_many(units)
+        for unit in units:
+            self.invalidate(unit)
+    
     def reserve(self, unit):
         """Reserve storage space for the Unit."""
         if not unit.identifiers:
@@ -204,6 +260,23 @@ class ObjectCache(ProxyStorage):
         if self.logflags & logflags.RESERVE:
             self.log(logflags.RESERVE.message(unit))
     
+    def reserve_many(self, units):
+        """Reserve storage space for each of the given Units."""
+        # Allow the proxied store to set any auto-ID's
+        self.nextstore.reserve_many(units)
+        
+        for unit in units:
+            if (unit.identifiers and unit.__class__ in self.cache.classes
+                    and not unit.dirty()):
+                try:
+                    self.cache.reserve(unit)
+                except KeyError:
+                    # The cache refused to save the unit (possibly full).
+                    pass
+            
+            if self.logflags & logflags.RESERVE:
+                self.log(logflags.RESERVE.message(unit))
+    
     def invalidate(self, unit):
         if unit.identifiers and unit.__class__ in self.cache.classes:
             self.cache.destroy(unit)
@@ -371,7 +444,8 @@ class AgedCache(ObjectCache):
             for cls in classes:
                 self._recallTimes.setdefault(cls, {})
     
-    def xrecall(self, classes, expr=None, order=None, limit=None, offset=None):
+    def xrecall(self, classes, expr=None, order=None, limit=None,
+                offset=None, defer=None):
         """Return a Unit iterator."""
         if isinstance(classes, dejavu.UnitJoin):
             for unitrow in self._xmultirecall(classes, expr, order=order,
@@ -400,6 +474,15 @@ class AgedCache(ObjectCache):
             recallTimes = self._recallTimes[cls]
             recallTimes[unit.identity()] = datetime.datetime.now()
     
+    def reserve_many(self, units):
+        """Reserve storage space for each of the given Units."""
+        ObjectCache.reserve_many(self, units)
+        now = datetime.datetime.now()
+        for unit in units:
+            cls = unit.__class__
+            if cls in self.cache.classes:
+                self._recallTimes[cls][unit.identity()] = now
+    
     def invalidate(self, unit):
         if unit.identifiers:
             cls = unit.__class__
@@ -440,7 +523,8 @@ class BurnedCache(ObjectCache):
     depends on always having a complete cache of a given class.
     """
     
-    def xrecall(self, classes, expr=None, order=None, limit=None, offset=None):
+    def xrecall(self, classes, expr=None, order=None, limit=None,
+                offset=None, defer=None):
         """Return a Unit iterator."""
         if isinstance(classes, dejavu.UnitJoin):
             return self._xmultirecall(classes, expr, order=order,
@@ -28,6 +28,7 @@ them into an SQL statement string.
 
 """
 
+import ast
 import threading
 import warnings
 
@@ -36,10 +37,37 @@ import geniusql
 from geniusql import logic, logicfuncs
 
 import dejavu
-from dejavu import storage, logflags, xray
+from dejavu import analysis, logflags, sandboxes, storage, xray
 from dejavu.errors import StorageWarning, MappingError, conflict
 
 
+def _columns_expression(columns):
+    """Return an Expression lambda x: [...] of the given (function, attr) pairs.
+    
+    Each list entry is x.attr, passed to the named aggregate function
+    ('count' for logicfuncs.count, or 'sum', 'min' or 'max') if one is
+    given. geniusql reads the bytecode of attribute functions rather than
+    calling them, so the lambda is compiled (by the running interpreter)
+    from the same syntax tree which such a lambda written by hand has.
+    """
+    load = ast.Load()
+    x = ast.Name('x', load)
+    items = []
+    for function, attr in columns:
+        node = ast.Attribute(x, attr, load)
+        if function == 'count':
+            func = ast.Attribute(ast.Name('logicfuncs', load), 'count', load)
+            node = ast.Call(func, [node], [], None, None)
+        elif function is not None:
+            node = ast.Call(ast.Name(function, load), [node], [], None, None)
+        items.append(node)
+    
+    args = ast.arguments([ast.Name('x', ast.Param())], None, None, [])
+    tree = ast.Expression(ast.Lambda(args, ast.List(items, load)))
+    code = compile(ast.fix_missing_locations(tree), '<aggregate>', 'eval')
+    return logic.Expression(eval(code, {'logicfuncs': logicfuncs}))
+
+
 # --------------------------- Storage Manager --------------------------- #
 
 
@@ -50,7 +78,8 @@ class StorageManagerDB(storage.StorageManager):
     
     def __init__(self, allOptions={}):
         storage.StorageManager.__init__(self, allOptions)
-        self.reserve_lock = threading.Lock()
+        # Per-thread record of whether start() has opened a transaction.
+        self._transaction = threading.local()
         
         # Config Overrides
         def get_option(name):
@@ -86,7 +115,8 @@ class StorageManagerDB(storage.StorageManager):
         """
         self.db.connections.shutdown()
     
-    def xrecall(self, classes, expr=None, order=None, limit=None, offset=None):
+    def xrecall(self, classes, expr=None, order=None, limit=None,
+                offset=None, defer=None):
         """Yield a sequence of Unit instances which satisfy the expression."""
         if limit == 0:
             return
@@ -109,27 +139,30 @@ class StorageManagerDB(storage.StorageManager):
         # Put the identifier properties first, in case other fields
         # depend upon them.
         idnames = list(cls.identifiers)
-        attrs = idnames + [x for x in cls.properties if x not in idnames]
-        coercers = [getattr(cls, key).coerce for key in attrs]
+        if defer is None:
+            defer = cls._deferred_properties
+        if idnames:
+            deferred = [x for x in defer
+                        if x in cls.properties and x not in idnames]
+        else:
+            # Units with no identifiers cannot be loaded later.
+            deferred = []
+        attrs = idnames + [x for x in cls.properties
+                           if x not in idnames and x not in deferred]
         
         data = self.select((cls, attrs, expr), order=order,
                            limit=limit, offset=offset)
+        if deferred and expr and data.statement.imperfect:
+            # Imperfect SQL means we must evaluate expr(unit) ourselves,
+            # which may need any property. Fetch them all instead.
+            attrs = idnames + [x for x in cls.properties if x not in idnames]
+            deferred = []
+            data = self.select((cls, attrs, expr), order=order,
+                               limit=limit, offset=offset)
+        load = cls._loader(attrs, deferred=deferred)
+        
         for row in data:
-            unit = cls.__new__(cls)
-            unit._zombie = True
-            unit.__init__()
-            
-            for key, value, propcoerce in zip(attrs, row, coercers):
-                try:
-                    if propcoerce:
-                        value = propcoerce(unit, value)
-                    unit._properties[key] = value
-                except UnicodeDecodeError, x:
-                    x.reason += " [%r: %r]" % (key, value)
-                    raise
-                except Exception, x:
-                    x.args += (key, value)
-                    raise
+            unit = load(row)
             
             # If our SQL is imperfect, don't yield it to the
             # caller unless it passes expr(unit).
@@ -137,29 +170,87 @@ class StorageManagerDB(storage.StorageManager):
                 if not expr(unit):
                     continue
             
-            unit.cleanse()
             yield unit
     
+    def undefer(self, cls, keys, units):
+        """Load the given deferred properties into the given units.
+        
+        The units are fetched with one "WHERE ID IN (...)" query per
+        self.unit_many_chunk units (as in unit_many).
+        """
+        idnames = list(cls.identifiers)
+        if not idnames:
+            return storage.StorageManager.undefer(self, cls, keys, units)
+        
+        idprops = [getattr(cls, key) for key in idnames]
+        keys = list(keys)
+        props = [getattr(cls, key) for key in keys]
+        n = len(idnames)
+        
+        byid = {}
+        for unit in units:
+            byid[unit.identity()] = unit
+        
+        identities = byid.keys()
+        size = max(self.unit_many_chunk, 1)
+        for i in xrange(0, len(identities), size):
+            expr = sandboxes._identity_filter(idnames, identities[i:i + size])
+            for row in self.select((cls, idnames + keys, expr)):
+                ident = []
+                for prop, value in zip(idprops, row[:n]):
+                    if prop.coerce:
+                        value = prop.coerce(None, value)
+                    ident.append(value)
+                # The filter may match other rows when n > 1.
+                unit = byid.get(tuple(ident))
+                if unit is None:
+                    continue
+                values = {}
+                for key, prop, value in zip(keys, props, row[n:]):
+                    if prop.coerce:
+                        value = prop.coerce(unit, value)
+                    values[key] = value
+                unit._set_deferred(values)
+    
     def reserve(self, unit):
         """Reserve a persistent slot for unit."""
-        self.reserve_lock.acquire()
-        try:
-            # First, see if our db subclass has a handler that
-            # uses the DB to generate the appropriate identifier(s).
-            seqclass = unit.sequencer.__class__.__name__
-            seq_handler = getattr(self, "_seq_%s" % seqclass, None)
-            if seq_handler:
-                seq_handler(unit)
-            else:
-                self._manual_reserve(unit)
-            unit.cleanse()
-        finally:
-            self.reserve_lock.release()
+        self.reserve_many([unit])
+    
+    def reserve_many(self, units):
+        """Reserve persistent slots for the given units.
         
-        # Usually we log ASAP, but here we log after
-        # the unit has had a chance to get an auto ID.
-        if self.logflags & logflags.RESERVE:
-            self.log(logflags.RESERVE.message(unit))
+        Units are reserved one class at a time, so each class' reserve
+        lock is acquired once per call. For classes whose identifiers
+        the database does not generate, the greatest existing identity
+        is also fetched once per call rather than once per unit.
+        """
+        for cls, group in storage.group_units(units):
+            # Reserves of different classes need not wait for each other.
+            lock = self._id_lock(cls)
+            try:
+                # First, see if our db subclass has a handler that
+                # uses the DB to generate the appropriate identifier(s).
+                seq_handler = self._seq_handler(cls)
+                if seq_handler:
+                    for unit in group:
+                        seq_handler(unit)
+                else:
+                    self._manual_reserve_many(cls, group)
+                for unit in group:
+                    unit.cleanse()
+            finally:
+                lock.release()
+            
+            # Usually we log ASAP, but here we log after
+            # the units have had a chance to get an auto ID.
+            if self.logflags & logflags.RESERVE:
+                for unit in group:
+                    self.log(logflags.RESERVE.message(unit))
+    
+    def _seq_handler(self, cls):
+        """Return a method which reserves a unit of cls using the DB, or None."""
+        seqclass = cls.sequencer.__class__.__name__
+        return getattr(self, "_seq_%s" % seqclass, None)
     
     def _seq_UnitSequencerDynamic(self, unit):
         """Reserve a unit (using the table's autoincrement fields)."""
@@ -175,13 +266,29 @@ class StorageManagerDB(storage.StorageManager):
         """Use when the DB cannot automatically generate an identifier.
         The identifiers will be supplied by UnitSequencer.assign().
         """
-        cls = unit.__class__
-        t = self.schema[cls.__name__]
-        if not unit.sequencer.valid_id(unit.identity()):
-            # Examine all existing IDs and grant the "next" one.
-            data = list(self.db.select((t, cls.identifiers)))
-            cls.sequencer.assign(unit, data)
-        t.insert(**unit._properties)
+        self._manual_reserve_many(unit.__class__, [unit])
+    
+    def _manual_reserve_many(self, cls, units):
+        """Use when the DB cannot automatically generate identifiers.
+        The identifiers will be supplied by UnitSequencer.assign().
+        """
+        t = self._table(cls)
+        greatest = None
+        for unit in units:
+            if not unit.sequencer.valid_id(unit.identity()):
+                if greatest is None:
+                    # Fetch only the greatest existing ID (once for all
+                    # of the units) and grant the "next" ones.
+                    order = ["%s DESC" % key for key in cls.identifiers]
+                    greatest = [tuple(row) for row in
+                                self.db.select((t, cls.identifiers),
+                                               order=order, limit=1)]
+                cls.sequencer.assign(unit, greatest)
+            t.insert(**unit._properties)
+            if greatest is not None:
+                ident = unit.identity()
+                if not greatest or ident > greatest[0]:
+                    greatest = [ident]
     
     def save(self, unit, forceSave=False):
         """Update storage from unit's data (if unit.dirty())."""
@@ -189,16 +296,78 @@ class StorageManagerDB(storage.StorageManager):
             self.log(logflags.SAVE.message(unit, forceSave))
         
         if forceSave or unit.dirty():
-            self.schema[unit.__class__.__name__].save(**unit._properties)
+            props = self._loaded_properties(unit)
+            self.schema[unit.__class__.__name__].save(**props)
             unit.cleanse()
     
+    def _loaded_properties(self, unit):
+        """Return the unit's properties, less any deferred (unloaded) ones.
+        
+        Saving the None placeholders of deferred properties would
+        overwrite values which we never loaded.
+        """
+        props = unit._properties
+        if unit._deferred:
+            props = props.copy()
+            for key in unit._deferred:
+                del props[key]
+        return props
+    
     def destroy(self, unit):
         """Delete the unit."""
         if self.logflags & logflags.DESTROY:
             self.log(logflags.DESTROY.message(unit))
         
         table = self.schema[unit.__class__.__name__]
-        table.delete(**unit._properties)
+        table.delete(**self._loaded_properties(unit))
+    
+    def destroy_many(self, units):
+        """Delete each of the given units.
+        
+        Units of classes with a single identifier are deleted with one
+        "DELETE ... WHERE ID IN (...)" statement per unit_many_chunk units.
+        Unless a transaction is already open (see start), each statement
+        runs in a transaction of its own.
+        """
+        for cls, group in storage.group_units(units):
+            if self.logflags & logflags.DESTROY:
+                for unit in group:
+                    self.log(logflags.DESTROY.message(unit))
+            
+            table = self._table(cls)
+            delete_all = getattr(table, "delete_all", None)
+            if len(group) == 1 or len(cls.identifiers) != 1 or not delete_all:
+                # An IN filter on several identifiers would match more
+                # rows than the given units, so delete them one by one.
+                for unit in group:
+                    table.delete(**self._loaded_properties(unit))
+                continue
+            
+            identities = [unit.identity() for unit in group]
+            size = max(self.unit_many_chunk, 1)
+            for i in xrange(0, len(identities), size):
+                expr = sandboxes._identity_filter(cls.identifiers,
+                                                  identities[i:i + size])
+                self._in_transaction(delete_all, expr)
+    
+    def _table(self, cls):
+        """Return the geniusql Table for the given Unit class."""
+        return self.schema[cls.__name__]
+    
+    def _in_transaction(self, func, *args):
+        """Return func(*args), inside a transaction if none is open."""
+        if (getattr(self._transaction, "open", False)
+            or getattr(self.db.connections, "implicit_trans", False)):
+            return func(*args)
+        
+        self.start()
+        try:
+            result = func(*args)
+        except:
+            self.rollback()
+            raise
+        self.commit()
+        return result
     
     
     #                                Views                                #
@@ -297,12 +466,128 @@ class StorageManagerDB(storage.StorageManager):
         if cls.identifiers:
             uniq = cls.identifiers
         else:
-            uniq = cls._properties.keys()
+            uniq = cls.properties
         # TODO: handle multiple args to count()
         counter = lambda x: [logicfuncs.count(getattr(x, uniq[0]))]
         
         query = dejavu.Query(cls, counter, expr)
         
+        data = self._select_aggregate(query)
+        if data is None:
+            return storage.StorageManager.count(self, cls, expr)
+        else:
+            return data.scalar()
+    
+    def sum(self, cls, attr, expr=None):
+        """Sum of all non-None values for the given cls.attr."""
+        query = dejavu.Query(cls, lambda x: [sum(getattr(x, attr))], expr)
+        
+        data = self._select_aggregate(query)
+        if data is None:
+            return storage.StorageManager.sum(self, cls, attr, expr)
+        
+        total = data.scalar()
+        if total is None:
+            # SUM() over no rows is NULL.
+            total = 0
+        return total
+    
+    def bounds(self, cls, attr, expr=None):
+        """(min, max) of all non-None values for cls.attr, or (None, None)."""
+        query = dejavu.Query(cls, lambda x: [min(getattr(x, attr)),
+                                             max(getattr(x, attr))], expr)
+        
+        data = self._select_aggregate(query)
+        if data is None:
+            return storage.StorageManager.bounds(self, cls, attr, expr)
+        
+        for row in data:
+            return tuple(row)
+        return None, None
+    
+    def aggregate(self, cls, group_by=(), aggregates=None, expr=None):
+        """Return {group key: {name: value}} for the Units which match expr.
+        
+        This selects the group_by columns along with one SQL aggregate
+        function for each of the given aggregates, so the database
+        performs the GROUP BY. Aggregates (or group_by entries) which
+        cannot be expressed in SQL fall back to the base method.
+        """
+        if aggregates is None:
+            aggregates = {'count': analysis.COUNT}
+        
+        props = cls.properties
+        for attr in group_by:
+            if not isinstance(attr, basestring) or attr not in props:
+                return storage.StorageManager.aggregate(
+                    self, cls, group_by, aggregates, expr)
+        
+        if cls.identifiers:
+            uniq = cls.identifiers[0]
+        else:
+            uniq = props[0]
+        columns = [(None, attr) for attr in group_by]
+        columns.append(('count', uniq))
+        
+        # A list of (name, column index, coerce, finish) for each aggregate.
+        plan = []
+        for name, aggfunc in aggregates.items():
+            function = getattr(aggfunc, "function", None)
+            attr = getattr(aggfunc, "attribute", None)
+            if function == 'count':
+                plan.append((name, len(group_by), None, None))
+            elif function in ('min', 'max') and attr in props:
+                # The result is one of the stored values of attr.
+                plan.append((name, len(columns),
+                             getattr(cls, attr).coerce, None))
+                columns.append((function, attr))
+            elif function == 'sum' and attr in props:
+                plan.append((name, len(columns), None, None))
+                columns.append((function, attr))
+            elif function == 'avg' and attr in props:
+                plan.append((name, len(columns), None, aggfunc.finish))
+                columns.append(('sum', attr))
+                columns.append(('count', attr))
+            else:
+                return storage.StorageManager.aggregate(
+                    self, cls, group_by, aggregates, expr)
+        
+        query = dejavu.Query(cls, _columns_expression(columns), expr)
+        data = self._select_aggregate(query)
+        if data is None:
+            return storage.StorageManager.aggregate(
+                self, cls, group_by, aggregates, expr)
+        
+        groupers = [getattr(cls, attr).coerce for attr in group_by]
+        results = {}
+        for row in data:
+            row = tuple(row)
+            if not row[len(group_by)]:
+                # Without a GROUP BY, an empty table still yields a row.
+                continue
+            key = []
+            for coerce, value in zip(groupers, row):
+                if coerce:
+                    value = coerce(None, value)
+                key.append(value)
+            values = {}
+            for name, index, coerce, finish in plan:
+                value = row[index]
+                if finish is not None:
+                    value = finish((value, row[index + 1]))
+                elif coerce and value is not None:
+                    value = coerce(None, value)
+                values[name] = value
+            results[tuple(key)] = values
+        return results
+    
+    def _select_aggregate(self, query):
+        """Return the result of the given aggregate query, or None.
+        
+        None is returned (with a StorageWarning) if the query cannot
+        produce perfect SQL; callers should then fall back to the
+        base StorageManager methods.
+        """
         if self.logflags & logflags.VIEW:
             self.log(logflags.VIEW.message(query, False))
         
@@ -316,53 +601,30 @@ class StorageManagerDB(storage.StorageManager):
                           "with a %s datasource. It may take an absurdly "
                           "long time to run, since each unit must be fully-"
                           "formed. %s" % (clsname, query), StorageWarning)
-            return storage.StorageManager.count(self, cls, expr)
-        else:
-            return data.scalar()
+            return None
+        return data
     
     def _xmultirecall(self, classes, expr=None, order=None, limit=None, offset=None):
         """Yield Unit instance sets which satisfy the expression."""
         if self.logflags & logflags.RECALL:
             self.log(logflags.RECALL.message(classes, expr))
         
-        # Gather attribute list.
+        # Gather attribute list, and a (loader, start, end) slice
+        # of each row for each class.
         allattrs = []
-        props = []
+        loaders = []
+        start = 0
         for cls in classes:
-            attrs = []
-            for key in cls.properties:
-                attrs.append(key)
-                props.append((cls, key, getattr(cls, key).coerce))
+            attrs = list(cls.properties)
             allattrs.append(attrs)
+            end = start + len(attrs)
+            loaders.append((cls._loader(attrs), start, end))
+            start = end
         
         data = self.select((classes, allattrs, expr), order=order,
                            limit=limit, offset=offset)
         for row in data:
-            # TODO: This is broken; won't work if same cls appears twice.
-            units = {}
-            for i, (cls, key, propcoerce) in enumerate(props):
-                if cls in units:
-                    unit = units[cls]
-                else:
-                    unit = cls.__new__(cls)
-                    unit._zombie = True
-                    unit.__init__()
-                    units[cls] = unit
-                
-                value = row[i]
-                try:
-                    if propcoerce:
-                        value = propcoerce(unit, value)
-                    unit._properties[key] = value
-                except Exception, x:
-                    x.args += (cls, key)
-                    raise
-            
-            unitset = []
-            for cls in classes:
-                unit = units[cls]
-                unit.cleanse()
-                unitset.append(unit)
+            unitset = [load(row[start:end]) for load, start, end in loaders]
             
             # If our SQL is imperfect, don't yield units to the
             # caller unless they pass expr(unit).
@@ -775,13 +1037,16 @@ class StorageManagerDB(storage.StorageManager):
     def start(self, isolation=None):
         "Start a transaction (not needed if db.connections.implicit_trans)."
         self.db.connections.start(isolation)
+        self._transaction.open = True
     
     def rollback(self):
         """Roll back the current transaction."""
+        self._transaction.open = False
         self.db.connections.rollback()
     
     def commit(self):
         """Commit the current transaction."""
+        self._transaction.open = False
         self.db.connections.commit()
 
 
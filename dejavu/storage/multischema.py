@@ -21,7 +21,8 @@ class MultiSchemaStorageManagerDB(db.StorageManagerDB):
     
     def __init__(self, allOptions={}):
         storage.StorageManager.__init__(self, allOptions)
-        self.reserve_lock = threading.Lock()
+        # Per-thread record of whether start() has opened a transaction.
+        self._transaction = threading.local()
         
         # Config Overrides
         def get_option(name):
@@ -62,31 +63,26 @@ class MultiSchemaStorageManagerDB(db.StorageManagerDB):
             setattr(unit, k, v)
     _seq_UnitSequencerInteger = _seq_UnitSequencerDynamic
     
-    def _manual_reserve(self, unit):
-        """Use when the DB cannot automatically generate an identifier.
-        The identifiers will be supplied by UnitSequencer.assign().
-        """
-        t = self._table_map[unit.__class__]
-        if not unit.sequencer.valid_id(unit.identity()):
-            # Examine all existing IDs and grant the "next" one.
-            data = list(self.db.select((t, unit.identifiers)))
-            unit.sequencer.assign(unit, data)
-        t.insert(**unit._properties)
-    
     def save(self, unit, forceSave=False):
         """Update storage from unit's data (if unit.dirty())."""
         if self.logflags & logflags.SAVE:
             self.log(logflags.SAVE.message(unit, forceSave))
         
         if forceSave or unit.dirty():
-            self._table_map[unit.__class__].save(**unit._properties)
+            props = self._loaded_properties(unit)
+            self._table_map[unit.__class__].save(**props)
             unit.cleanse()
     
     def destroy(self, unit):
         """Delete the unit."""
         if self.logflags & logflags.DESTROY:
             self.log(logflags.DESTROY.message(unit))
-        self._table_map[unit.__class__].delete(**unit._properties)
+        self._table_map[unit.__class__].delete(
+            **self._loaded_properties(unit))
+    
+    def _table(self, cls):
+        """Return the geniusql Table for the given Unit class."""
+        return self._table_map[cls]
     
     
     #                                Views                                #
@@ -280,18 +280,42 @@ class VerticalPartitioner(storage.StorageManager):
         """Reserve storage space for the Unit."""
         self.classmap[unit.__class__][0].reserve(unit)
     
+    def _store_of(self, unit):
+        """Return the store which reserves, saves and destroys the unit."""
+        return self.classmap[unit.__class__][0]
+    
+    def reserve_many(self, units):
+        """Reserve storage space for each of the given Units."""
+        # Pass each store all of its units at once.
+        for store, group in storage.group_units(units, self._store_of):
+            store.reserve_many(group)
+    
     def save(self, unit, forceSave=False):
         """Store the unit's property values."""
         self.classmap[unit.__class__][0].save(unit, forceSave)
     
+    def save_many(self, units, forceSave=False):
+        """Store the property values of each of the given units."""
+        for store, group in storage.group_units(units, self._store_of):
+            store.save_many(group, forceSave)
+    
     def destroy(self, unit):
         """Delete the unit."""
         self.classmap[unit.__class__][0].destroy(unit)
     
+    def destroy_many(self, units):
+        """Delete each of the given units."""
+        for store, group in storage.group_units(units, self._store_of):
+            store.destroy_many(group)
+    
     def unit(self, cls, **kwargs):
         return self.classmap[cls][0].unit(cls, **kwargs)
     
-    def xrecall(self, classes, expr=None, order=None, limit=None, offset=None):
+    def unit_many(self, cls, identities):
+        return self.classmap[cls][0].unit_many(cls, identities)
+    
+    def xrecall(self, classes, expr=None, order=None, limit=None,
+                offset=None, defer=None):
         """Yield a sequence of Unit instances which satisfy the expression."""
         if isinstance(classes, dejavu.UnitJoin):
             for unitrow in self._xmultirecall(classes, expr, order=order,
@@ -301,9 +325,14 @@ class VerticalPartitioner(storage.StorageManager):
             store = self.classmap[classes][0]
             if self.logflags & logflags.RECALL:
                 self.log(logflags.RECALL.message(classes, expr))
-            for unit in store.xrecall(classes, expr, order, limit, offset):
+            for unit in store.xrecall(classes, expr, order, limit, offset,
+                                      defer):
                 yield unit
     
+    def undefer(self, cls, keys, units):
+        """Load the given deferred properties into the given units."""
+        self.classmap[cls][0].undefer(cls, keys, units)
+    
     def _xmultirecall(self, classes, expr=None,
                       order=None, limit=None, offset=None):
         """Yield lists of units of the given classes which match expr.
@@ -363,6 +392,23 @@ class VerticalPartitioner(storage.StorageManager):
                                offset=offset, distinct=distinct):
             yield row
     
+    def count(self, cls, expr=None):
+        """Number of Units of the given cls which match the given expr."""
+        return self._single_store(cls).count(cls, expr)
+    
+    def sum(self, cls, attr, expr=None):
+        """Sum of all non-None values for the given cls.attr."""
+        return self._single_store(cls).sum(cls, attr, expr)
+    
+    def bounds(self, cls, attr, expr=None):
+        """(min, max) of all non-None values for cls.attr, or (None, None)."""
+        return self._single_store(cls).bounds(cls, attr, expr)
+    
+    def aggregate(self, cls, group_by=(), aggregates=None, expr=None):
+        """Return {group key: {name: value}} for the Units which match expr."""
+        return self._single_store(cls).aggregate(cls, group_by,
+                                                 aggregates, expr)
+    
     def insert_into(self, name, query, distinct=False):
         """INSERT matching data INTO a new class and return the class."""
         if not isinstance(query, dejavu.Query):
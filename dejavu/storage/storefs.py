@@ -14,7 +14,7 @@ from dejavu import errors, logflags, storage
 from geniusql import logic
 
 
-class StorageManagerFolders(storage.StorageManager):
+class StorageManagerFolders(storage.FileMarks, storage.StorageManager):
     """StoreManager to save and retrieve Units in flat files.
     
     This is slightly different from shelve, in that this saves
@@ -116,16 +116,15 @@ class StorageManagerFolders(storage.StorageManager):
                 folder = "__blank__"
             
             if os.path.exists(os.path.join(classdir, folder)):
-                unit = cls()
-                unit._properties = self._pull(cls, classdir, folder)
-                unit.cleanse()
-                return unit
+                return cls._from_row(self._pull(cls, classdir, folder),
+                                     coerce=False)
             else:
                 return None
         
         return storage.StorageManager.unit(self, cls, **kwargs)
     
-    def xrecall(self, classes, expr=None, order=None, limit=None, offset=None):
+    def xrecall(self, classes, expr=None, order=None, limit=None,
+                offset=None, defer=None):
         if isinstance(classes, dejavu.UnitJoin):
             return self._xmultirecall(classes, expr, order=order,
                                       limit=limit, offset=offset)
@@ -149,11 +148,10 @@ class StorageManagerFolders(storage.StorageManager):
     
     def _xrecall_inner(self, cls, expr, root, dirs):
         """Private helper for self.xrecall."""
+        load = cls._loader(coerce=False)
         for idset in dirs:
-            unit = cls()
-            unit._properties = self._pull(cls, root, idset)
+            unit = load(self._pull(cls, root, idset))
             if expr is None or expr(unit):
-                unit.cleanse()
                 # Must yield a sequence for use in _paginate.
                 yield (unit,)
     
@@ -216,11 +214,14 @@ class StorageManagerFolders(storage.StorageManager):
         path = self.shelf(cls)
         self.get_lock(cls)
         try:
-            if not unit.sequencer.valid_id(unit.identity()):
-                root, dirs, _ = os.walk(path).next()
-                ids = [[v for k, v in self.ids_from_folder(cls, dirname)]
-                       for dirname in dirs]
-                unit.sequencer.assign(unit, ids)
+            if unit.sequencer.valid_id(unit.identity()):
+                self._note_identity(unit)
+            else:
+                def scan():
+                    root, dirs, _ = os.walk(path).next()
+                    return [[v for k, v in self.ids_from_folder(cls, dirname)]
+                            for dirname in dirs]
+                self._assign_identity(unit, scan)
             
             fname = self.folder_from_unit(unit)
             fname = os.path.join(path, fname)
@@ -329,6 +330,7 @@ class StorageManagerFolders(storage.StorageManager):
             shutil.rmtree(self.shelf(cls))
         except Exception, x:
             errors.conflict(conflicts, str(x))
+        self._reset_identities(cls)
     
     def add_property(self, cls, name, conflicts='error'):
         """Add internal structures for the given property.
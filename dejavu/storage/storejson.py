@@ -14,7 +14,7 @@ from dejavu import errors, json, logflags, storage
 from geniusql import logic
 
 
-class StorageManagerJSON(storage.StorageManager):
+class StorageManagerJSON(storage.FileMarks, storage.StorageManager):
     """StoreManager to save and retrieve Units in flat files as JSON.
     
     This is slightly different from fs, in that this saves each Unit class
@@ -26,6 +26,9 @@ class StorageManagerJSON(storage.StorageManager):
     of classes) grows large.
     """
     
+    # Files in each class folder which do not hold units.
+    reserved_files = ("class.lock", "class.seq")
+    
     def __init__(self, allOptions={}):
         storage.StorageManager.__init__(self, allOptions)
         
@@ -110,16 +113,14 @@ class StorageManagerJSON(storage.StorageManager):
             
             try:
                 data = self._pull(classdir, fname)
-                unit = json.dict_to_unit(data, cls=cls)
+                return json.dict_to_unit(data, cls=cls)
             except IOError:
                 return None
-            
-            unit.cleanse()
-            return unit
         
         return storage.StorageManager.unit(self, cls, **kwargs)
     
-    def xrecall(self, classes, expr=None, order=None, limit=None, offset=None):
+    def xrecall(self, classes, expr=None, order=None, limit=None,
+                offset=None, defer=None):
         if isinstance(classes, dejavu.UnitJoin):
             return self._xmultirecall(classes, expr, order=order,
                                       limit=limit, offset=offset)
@@ -141,13 +142,12 @@ class StorageManagerJSON(storage.StorageManager):
     def _xrecall_inner(self, cls, expr, root, files):
         """Private helper for self.xrecall."""
         for fname in files:
-            if fname == "class.lock":
+            if fname in self.reserved_files:
                 continue
             
             data = self._pull(root, fname)
             unit = json.dict_to_unit(data, cls=cls)
             if expr is None or expr(unit):
-                unit.cleanse()
                 # Must yield a sequence for use in _paginate.
                 yield (unit,)
     
@@ -187,11 +187,14 @@ class StorageManagerJSON(storage.StorageManager):
         path = self.shelf(cls)
         self.get_lock(cls)
         try:
-            if not unit.sequencer.valid_id(unit.identity()):
-                files = os.listdir(path)
-                ids = [[v for k, v in self.ids_from_file(cls, fname)]
-                       for fname in files if fname != 'class.lock']
-                unit.sequencer.assign(unit, ids)
+            if unit.sequencer.valid_id(unit.identity()):
+                self._note_identity(unit)
+            else:
+                def scan():
+                    return [[v for k, v in self.ids_from_file(cls, fname)]
+                            for fname in os.listdir(path)
+                            if fname not in self.reserved_files]
+                self._assign_identity(unit, scan)
             
             fname = self.filename_from_unit(unit)
             self._push(path, fname, json.unit_to_dict(unit))
@@ -297,6 +300,7 @@ class StorageManagerJSON(storage.StorageManager):
             shutil.rmtree(self.shelf(cls))
         except Exception, x:
             errors.conflict(conflicts, str(x))
+        self._reset_identities(cls)
     
     def add_property(self, cls, name, conflicts='error'):
         """Add internal structures for the given property.
@@ -311,7 +315,7 @@ class StorageManagerJSON(storage.StorageManager):
         self.get_lock(cls)
         try:
             for fname in os.listdir(path):
-                if fname == "class.lock":
+                if fname in self.reserved_files:
                     continue
                 try:
                     data = self._pull(path, fname)
@@ -328,7 +332,7 @@ class StorageManagerJSON(storage.StorageManager):
         self.get_lock(cls)
         try:
             for fname in os.listdir(path):
-                if fname == "class.lock":
+                if fname in self.reserved_files:
                     continue
                 return name in self._pull(path, fname)
         finally:
@@ -347,7 +351,7 @@ class StorageManagerJSON(storage.StorageManager):
         self.get_lock(cls)
         try:
             for fname in os.listdir(path):
-                if fname == "class.lock":
+                if fname in self.reserved_files:
                     continue
                 try:
                     data = self._pull(path, fname)
@@ -372,7 +376,7 @@ class StorageManagerJSON(storage.StorageManager):
         self.get_lock(cls)
         try:
             for fname in os.listdir(path):
-                if fname == "class.lock":
+                if fname in self.reserved_files:
                     continue
                 try:
                     data = self._pull(path, fname)
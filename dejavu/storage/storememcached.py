@@ -92,6 +92,18 @@ class MemcachedStorageManager(storage.StorageManager):
         self._keyattrs[cls] = tuple(cls.identifiers or cls.properties)
         storage.StorageManager.register(self, cls)
     
+    def _mark_key(self, cls):
+        """Return the key for the identity high-water mark of cls."""
+        return "%s:%s:mark" % (self.name, cls.__name__)
+    
+    def _load_mark(self, cls):
+        """Return the last identity handed out for cls (or None)."""
+        return self.client.get(self._mark_key(cls))
+    
+    def _save_mark(self, cls, identity):
+        """Record the last identity handed out for cls."""
+        self.client.set(self._mark_key(cls), tuple(identity))
+    
     def _unit_key(self, unit):
         """Return the memcached key for the given unit."""
         cls = unit.__class__
@@ -147,7 +159,31 @@ class MemcachedStorageManager(storage.StorageManager):
                 self.log(logflags.RECALL.message(cls, ('DEFER', kwargs)))
             return None
     
-    def xrecall(self, classes, expr=None, order=None, limit=None, offset=None):
+    def unit_many(self, cls, identities):
+        """Return a dict of {identity: Unit} for the given identities of cls.
+        
+        All of the Units are fetched with a single get_multi call.
+        """
+        if not cls.identifiers:
+            return {}
+        if self.logflags & logflags.RECALL:
+            self.log(logflags.RECALL.message(cls, ('MULTI', identities)))
+        
+        keys = {}
+        for id in identities:
+            key = "%s:%s:%s" % (self.name, cls.__name__, self.hash(id))
+            keys[key] = id
+        units = self.client.get_multi(keys.keys())
+        
+        found = {}
+        for key, unit in units.iteritems():
+            if unit is not None:
+                unit.cleanse()
+                found[keys[key]] = unit
+        return found
+    
+    def xrecall(self, classes, expr=None, order=None, limit=None,
+                offset=None, defer=None):
         """Yield units of the given cls which match the given expr."""
         if not self.indexed:
             return iter([])
@@ -220,13 +256,17 @@ class MemcachedStorageManager(storage.StorageManager):
             if self.indexed:
                 ci = self.client.get(self._index_key(cls)) or set()
                 
-                if not unit.sequencer.valid_id(unit.identity()):
-                    ids = []
-                    for key in ci:
-                        otherunit = self.client.get(key)
-                        if otherunit is not None:
-                            ids.append(otherunit.identity())
-                    unit.sequencer.assign(unit, ids)
+                if unit.sequencer.valid_id(unit.identity()):
+                    self._note_identity(unit)
+                else:
+                    def scan():
+                        ids = []
+                        for key in ci:
+                            otherunit = self.client.get(key)
+                            if otherunit is not None:
+                                ids.append(otherunit.identity())
+                        return ids
+                    self._assign_identity(unit, scan)
                 unit.cleanse()
                 
                 key = self._unit_key(unit)
@@ -412,6 +452,8 @@ class MemcachedStorageManager(storage.StorageManager):
             
             # Delete the class index.
             self.client.delete(self._index_key(cls))
+            self.client.delete(self._mark_key(cls))
+            self._reset_identities(cls)
         # TODO:
         # else:
         #     self.increment_generation(cls)
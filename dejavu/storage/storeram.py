@@ -56,7 +56,30 @@ class RAMStorage(storage.StorageManager):
         finally:
             lock.release()
     
-    def xrecall(self, classes, expr=None, order=None, limit=None, offset=None):
+    def unit_many(self, cls, identities):
+        """Return a dict of {identity: Unit} for the given identities of cls.
+        
+        The lock for cls is acquired once for all of the identities.
+        """
+        if self.logflags & logflags.RECALL:
+            self.log(logflags.RECALL.message(cls, identities))
+        
+        found = {}
+        lock = self._get_lock(cls)
+        try:
+            cache = self._caches[cls]
+            for id in identities:
+                pickledUnit = cache.get(id)
+                if pickledUnit is not None:
+                    u = pickle.loads(pickledUnit)
+                    u.cleanse()
+                    found[id] = u
+        finally:
+            lock.release()
+        return found
+    
+    def xrecall(self, classes, expr=None, order=None, limit=None,
+                offset=None, defer=None):
         """Yield units of the given cls which match the given expr."""
         if isinstance(classes, dejavu.UnitJoin):
             return self._xmultirecall(classes, expr, order=order,
@@ -92,49 +115,71 @@ class RAMStorage(storage.StorageManager):
     
     def save(self, unit, forceSave=False):
         """save(unit, forceSave=False). -> Update storage from unit's data."""
-        if self.logflags & logflags.SAVE:
-            self.log(logflags.SAVE.message(unit, forceSave))
+        self.save_many([unit], forceSave)
+    
+    def save_many(self, units, forceSave=False):
+        """Update storage from the data of each of the given units.
         
-        if forceSave or unit.dirty():
-            lock = self._get_lock(unit.__class__)
+        The lock for each class is acquired once for all of its units.
+        """
+        for cls, group in storage.group_units(units):
+            if self.logflags & logflags.SAVE:
+                for unit in group:
+                    self.log(logflags.SAVE.message(unit, forceSave))
+            
+            group = [unit for unit in group if forceSave or unit.dirty()]
+            if not group:
+                continue
+            
+            lock = self._get_lock(cls)
             try:
-                cache = self._caches[unit.__class__]
-                if unit.identifiers:
-                    # Replace the entire value to get around writeback issues.
-                    # See the docs on "shelve" for more info.
-                    key = unit.identity()
-                else:
-                    # This class has no identifiers, so hash the whole dict.
-                    key = pickle.dumps(unit._properties)
-                
-                # Cleanse first because pickle state
-                # includes _initial_property_hash.
-                unit.cleanse()
-                cache[key] = pickle.dumps(unit)
+                cache = self._caches[cls]
+                for unit in group:
+                    if unit.identifiers:
+                        # Replace the entire value to get around writeback
+                        # issues. See the docs on "shelve" for more info.
+                        key = unit.identity()
+                    else:
+                        # This class has no identifiers; hash the whole dict.
+                        key = pickle.dumps(unit._properties)
+                    
+                    # Cleanse first because pickle state
+                    # includes _initial_property_hash.
+                    unit.cleanse()
+                    cache[key] = pickle.dumps(unit)
             finally:
                 lock.release()
     
     def destroy(self, unit):
         """Delete the unit."""
-        if self.logflags & logflags.DESTROY:
-            self.log(logflags.DESTROY.message(unit))
+        self.destroy_many([unit])
+    
+    def destroy_many(self, units):
+        """Delete each of the given units.
         
-        cls = unit.__class__
-        lock = self._get_lock(cls)
-        try:
-            cache = self._caches[cls]
-            if unit.identifiers:
-                id = unit.identity()
-            else:
-                # This class has no identifiers, so hash the whole dict.
-                id = pickle.dumps(unit._properties)
+        The lock for each class is acquired once for all of its units.
+        """
+        for cls, group in storage.group_units(units):
+            if self.logflags & logflags.DESTROY:
+                for unit in group:
+                    self.log(logflags.DESTROY.message(unit))
             
+            lock = self._get_lock(cls)
             try:
-                del cache[id]
-            except KeyError:
-                pass
-        finally:
-            lock.release()
+                cache = self._caches[cls]
+                for unit in group:
+                    if unit.identifiers:
+                        id = unit.identity()
+                    else:
+                        # This class has no identifiers; hash the whole dict.
+                        id = pickle.dumps(unit._properties)
+                    
+                    try:
+                        del cache[id]
+                    except KeyError:
+                        pass
+            finally:
+                lock.release()
     
     def reserve(self, unit):
         """Reserve storage space for the Unit."""
@@ -143,8 +188,10 @@ class RAMStorage(storage.StorageManager):
             lock = self._get_lock(cls)
             try:
                 cache = self._caches[cls]
-                if not unit.sequencer.valid_id(unit.identity()):
-                    unit.sequencer.assign(unit, cache.keys())
+                if unit.sequencer.valid_id(unit.identity()):
+                    self._note_identity(unit)
+                else:
+                    self._assign_identity(unit, cache.keys)
                 # Pickle the Unit to discard extraneous attributes,
                 # and avoid identity issues.
                 # Cleanse first because pickle state
@@ -169,6 +216,8 @@ class RAMStorage(storage.StorageManager):
         """
         self._caches = {}
         self._cache_locks = {}
+        self._id_blocks = {}
+        self._id_marks = {}
     
     def create_database(self, conflicts='error'):
         """Create internal structures for the entire database.
@@ -219,6 +268,7 @@ class RAMStorage(storage.StorageManager):
             del self._cache_locks[cls]
         except KeyError, x:
             errors.conflict(conflicts, str(x))
+        self._reset_identities(cls)
     
     def add_property(self, cls, name, conflicts='error'):
         """Add internal structures for the given property.
@@ -18,6 +18,11 @@ import dejavu
 from dejavu import errors, logic, logflags, storage
 
 
+# The shelf key under which each class' identity high-water mark is kept.
+# Unit keys are pickled tuples or dicts (see key), so cannot collide with it.
+_mark_key = "id_mark"
+
+
 class StorageManagerShelve(storage.StorageManager):
     """StoreManager to save and retrieve Units via stdlib shelve."""
     
@@ -78,18 +83,13 @@ class StorageManagerShelve(storage.StorageManager):
             if unitdict is None:
                 return None
             else:
-                # Set props directly to avoid __set__ and default overhead.
-                unit = cls.__new__(cls)
-                unit._zombie = True
-                unit.__init__()
-                unit._properties = unitdict
-                unit.cleanse()
-                return unit
+                # Shelved values are already of the correct types.
+                return cls._from_row(unitdict, coerce=False)
         
         lock = self.get_lock(cls)
         try:
             data = self.shelves[cls] or {}
-            keys = data.keys()
+            keys = self._unit_keys(data)
         finally:
             lock.release()
         
@@ -99,7 +99,31 @@ class StorageManagerShelve(storage.StorageManager):
         except StopIteration:
             return None
     
-    def xrecall(self, classes, expr=None, order=None, limit=None, offset=None):
+    def unit_many(self, cls, identities):
+        """Return a dict of {identity: Unit} for the given identities of cls.
+        
+        The lock for cls is acquired once for all of the identities.
+        """
+        if self.logflags & logflags.RECALL:
+            self.log(logflags.RECALL.message(cls, identities))
+        
+        rows = []
+        lock = self.get_lock(cls)
+        try:
+            data = self.shelves[cls] or {}
+            for id in identities:
+                unitdict = data.get(self.key(id), None)
+                if unitdict is not None:
+                    rows.append((id, unitdict))
+        finally:
+            lock.release()
+        
+        # Shelved values are already of the correct types.
+        return dict([(id, cls._from_row(unitdict, coerce=False))
+                     for id, unitdict in rows])
+    
+    def xrecall(self, classes, expr=None, order=None, limit=None,
+                offset=None, defer=None):
         """Yield units of the given cls which match the given expr."""
         if isinstance(classes, dejavu.UnitJoin):
             return self._xmultirecall(classes, expr, order=order,
@@ -112,7 +136,7 @@ class StorageManagerShelve(storage.StorageManager):
         lock = self.get_lock(cls)
         try:
             data = self.shelves[cls] or {}
-            keys = data.keys()
+            keys = self._unit_keys(data)
         finally:
             lock.release()
         
@@ -129,13 +153,14 @@ class StorageManagerShelve(storage.StorageManager):
             keyset = keys[cursor:cursor+stride]
             for unit in self._xrecall_inner_inner(cls, keyset):
                 if expr is None or expr(unit):
-                    unit.cleanse()
                     # Must yield a sequence for use in _paginate.
                     yield (unit,)
     
     def _xrecall_inner_inner(self, cls, keyset):
         """Grab a chunk of units."""
         units = []
+        # Shelved values are already of the correct types.
+        load = cls._loader(coerce=False)
         lock = self.get_lock(cls)
         try:
             data = self.shelves[cls]
@@ -143,12 +168,7 @@ class StorageManagerShelve(storage.StorageManager):
                 for key in keyset:
                     unitdict = data.get(key, None)
                     if unitdict is not None:
-                        # Set props directly to avoid __set__ and default overhead.
-                        unit = cls.__new__(cls)
-                        unit._zombie = True
-                        unit.__init__()
-                        unit._properties = unitdict
-                        units.append(unit)
+                        units.append(load(unitdict))
         finally:
             lock.release()
         return units
@@ -156,6 +176,27 @@ class StorageManagerShelve(storage.StorageManager):
     def key(self, arg):
         return pickle.dumps(arg)
     
+    def _unit_keys(self, data):
+        """Return the keys of the units in the given shelf."""
+        return [key for key in data.keys() if key != _mark_key]
+    
+    def _load_mark(self, cls):
+        """Return the high-water mark for cls from its shelf (or None).
+        
+        This assumes we have a lock on the class.
+        """
+        data = self.shelves.get(cls)
+        if data is None:
+            return None
+        return data.get(_mark_key)
+    
+    def _save_mark(self, cls, identity):
+        """Persist the high-water mark for cls in its shelf.
+        
+        This assumes we have a lock on the class.
+        """
+        self.shelves[cls][_mark_key] = tuple(identity)
+    
     def reserve(self, unit):
         """Reserve a persistent slot for unit."""
         if unit.identifiers:
@@ -163,10 +204,14 @@ class StorageManagerShelve(storage.StorageManager):
             lock = self.get_lock(cls)
             try:
                 data = self.shelves[cls]
-                if not unit.sequencer.valid_id(unit.identity()):
-                    ids = [[row[key] for key in unit.identifiers]
-                           for row in data.itervalues()]
-                    unit.sequencer.assign(unit, ids)
+                if unit.sequencer.valid_id(unit.identity()):
+                    self._note_identity(unit)
+                else:
+                    def scan():
+                        rows = [data[k] for k in self._unit_keys(data)]
+                        return [[row[key] for key in unit.identifiers]
+                                for row in rows]
+                    self._assign_identity(unit, scan)
                 data[self.key(unit.identity())] = unit._properties
                 unit.cleanse()
             finally:
@@ -182,42 +227,63 @@ class StorageManagerShelve(storage.StorageManager):
     
     def save(self, unit, forceSave=False):
         """Update storage from unit's data."""
-        if self.logflags & logflags.SAVE:
-            self.log(logflags.SAVE.message(unit, forceSave))
+        self.save_many([unit], forceSave)
+    
+    def save_many(self, units, forceSave=False):
+        """Update storage from the data of each of the given units.
         
-        if forceSave or unit.dirty():
-            cls = unit.__class__
+        The lock for each class is acquired once for all of its units.
+        """
+        for cls, group in storage.group_units(units):
+            if self.logflags & logflags.SAVE:
+                for unit in group:
+                    self.log(logflags.SAVE.message(unit, forceSave))
+            
+            group = [unit for unit in group if forceSave or unit.dirty()]
+            if not group:
+                continue
+            
             lock = self.get_lock(cls)
             try:
                 data = self.shelves[cls]
-                if unit.identifiers:
-                    key = self.key(unit.identity())
-                else:
-                    # This class has no identifiers, so hash the whole dict.
-                    key = self.key(unit._properties)
-                # Replace the entire value to get around writeback issues.
-                # See the docs on "shelve" for more info.
-                data[key] = unit._properties
-                unit.cleanse()
+                for unit in group:
+                    if unit.identifiers:
+                        key = self.key(unit.identity())
+                    else:
+                        # This class has no identifiers; hash the whole dict.
+                        key = self.key(unit._properties)
+                    # Replace the entire value to get around writeback issues.
+                    # See the docs on "shelve" for more info.
+                    data[key] = unit._properties
+                    unit.cleanse()
             finally:
                 lock.release()
     
     def destroy(self, unit):
         """Delete the unit."""
-        if self.logflags & logflags.DESTROY:
-            self.log(logflags.DESTROY.message(unit))
+        self.destroy_many([unit])
+    
+    def destroy_many(self, units):
+        """Delete each of the given units.
         
-        cls = unit.__class__
-        lock = self.get_lock(cls)
-        try:
-            data = self.shelves[cls]
-            if unit.identifiers:
-                del data[self.key(unit.identity())]
-            else:
-                # This class has no identifiers, so hash the whole dict.
-                del data[self.key(unit._properties)]
-        finally:
-            lock.release()
+        The lock for each class is acquired once for all of its units.
+        """
+        for cls, group in storage.group_units(units):
+            if self.logflags & logflags.DESTROY:
+                for unit in group:
+                    self.log(logflags.DESTROY.message(unit))
+            
+            lock = self.get_lock(cls)
+            try:
+                data = self.shelves[cls]
+                for unit in group:
+                    if unit.identifiers:
+                        del data[self.key(unit.identity())]
+                    else:
+                        # This class has no identifiers; hash the whole dict.
+                        del data[self.key(unit._properties)]
+            finally:
+                lock.release()
     
     def version(self):
         import sys
@@ -343,6 +409,7 @@ class StorageManagerShelve(storage.StorageManager):
                 os.remove(self.filename(cls))
             except Exception, x:
                 errors.conflict(conflicts, str(x))
+            self._reset_identities(cls)
         finally:
             lock.release()
     
@@ -361,7 +428,8 @@ class StorageManagerShelve(storage.StorageManager):
             except KeyError, x:
                 errors.conflict(conflicts, str(x))
             
-            for id, props in data.items():
+            for id in self._unit_keys(data):
+                props = data[id]
                 props[name] = None
                 data[id] = props
         finally:
@@ -382,7 +450,8 @@ class StorageManagerShelve(storage.StorageManager):
             except KeyError, x:
                 errors.conflict(conflicts, str(x))
             
-            for id, props in data.items():
+            for id in self._unit_keys(data):
+                props = data[id]
                 del props[name]
                 data[id] = props
         finally:
@@ -404,7 +473,8 @@ class StorageManagerShelve(storage.StorageManager):
             except KeyError, x:
                 errors.conflict(conflicts, str(x))
             
-            for id, props in data.items():
+            for id in self._unit_keys(data):
+                props = data[id]
                 props[newname] = props[oldname]
                 del props[oldname]
                 data[id] = props
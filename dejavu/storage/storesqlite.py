@@ -18,23 +18,13 @@ class StorageManagerSQLite(db.StorageManagerDB):
         
         db.StorageManagerDB.__init__(self, allOptions)
     
-    def reserve(self, unit):
-        """Reserve a persistent slot for unit."""
-        self.reserve_lock.acquire()
-        try:
-            # First, see if our db subclass has a handler that
-            # uses the DB to generate the appropriate identifier(s).
-            seqclass = unit.sequencer.__class__.__name__
-            seq_handler = getattr(self, "_seq_%s" % seqclass, None)
-            if (seq_handler and
-                   (seqclass != "UnitSequencerInteger" or
-                    sqlite._autoincrement_support)):
-                seq_handler(unit)
-            else:
-                self._manual_reserve(unit)
-            unit.cleanse()
-        finally:
-            self.reserve_lock.release()
+    def _seq_handler(self, cls):
+        """Return a method which reserves a unit of cls using the DB, or None."""
+        seqclass = cls.sequencer.__class__.__name__
+        if (seqclass == "UnitSequencerInteger" and
+                not sqlite._autoincrement_support):
+            return None
+        return db.StorageManagerDB._seq_handler(self, cls)
     
     #                               Schemas                               #
     
@@ -1,9 +1,21 @@
 import datetime
+import os
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+try:
+    from hashlib import sha1 as sha
+except ImportError:
+    from sha import new as sha
+import shutil
+import tempfile
 import unittest
 import warnings
 
 import dejavu
-from dejavu import errors, storage
+from dejavu import engines, errors, storage
+from dejavu.storage import storeram
 from dejavu.test.zoo_fixture import *
 
 
@@ -61,6 +73,87 @@ class UnitTests(unittest.TestCase):
         self.assertEqual(z.LastEscape, d)
         self.assertEqual(z.dirty(), True)
     
+    def test_dirty_tracking(self):
+        z = Zoo(Name='Wild Animal Park')
+        self.assertEqual(z.changed(), set(['Name']))
+        z.cleanse()
+        self.assertEqual(z.dirty(), False)
+        self.assertEqual(z.changed(), set())
+        
+        # Setting an equal value should not dirty the unit.
+        z.Name = 'Wild Animal Park'
+        self.assertEqual(z.dirty(), False)
+        z.Founded = datetime.date(1972, 5, 10)
+        self.assertEqual(z.dirty(), True)
+        self.assertEqual(z.changed(), set(['Founded']))
+        
+        # List properties are mutable, and must fall back to hashing.
+        self.assertEqual(Animal.PreviousZoos.mutable, True)
+        self.assertEqual(Animal.Species.mutable, False)
+        a = Animal(Species='Emu', PreviousZoos=[])
+        a.cleanse()
+        a.PreviousZoos.append(u'San Diego Zoo')
+        self.assertEqual(a.dirty(), True)
+        self.assert_('PreviousZoos' in a.changed())
+        self.assert_('Species' not in a.changed())
+    
+    def test_legacy_pickle(self):
+        # Units pickled by Dejavu 1.x hold a hash of the whole dict.
+        def legacy_state(unit):
+            props = unit._properties.copy()
+            return (props, sha(pickle.dumps(props)).digest())
+        
+        for cls, kwargs in ((Zoo, {'Name': u'Wild Animal Park'}),
+                            (Animal, {'Species': u'Emu',
+                                      'PreviousZoos': [u'Perth']})):
+            unit = cls(**kwargs)
+            unit.cleanse()
+            state = legacy_state(unit)
+            
+            clean = cls.__new__(cls)
+            clean.__setstate__(state)
+            self.assertEqual(clean.dirty(), False)
+            self.assertEqual(clean.changed(), set())
+            
+            # A unit which was dirty when pickled must stay dirty.
+            props, oldhash = state
+            props = props.copy()
+            props['ID'] = 42
+            dirty = cls.__new__(cls)
+            dirty.__setstate__((props, oldhash))
+            self.assertEqual(dirty.dirty(), True)
+            self.assert_('ID' in dirty.changed())
+            dirty.cleanse()
+            self.assertEqual(dirty.dirty(), False)
+    
+    def test_compact_slots(self):
+        class Seat(dejavu.Unit):
+            compact = True
+            Row = UnitProperty(int)
+            Number = UnitProperty(int)
+        s = Seat(Row=3, Number=7)
+        
+        # A new property must not reuse the slot of a removed one.
+        Seat.remove_property('Number')
+        Seat.set_property('Section')
+        self.assertEqual(s.Section, None)
+        self.assertEqual(s.Row, 3)
+        self.assertEqual(len(Seat()._properties._values), 4)
+    
+    def test_from_row(self):
+        a = Animal._from_row(("3", "Emu", "42"),
+                             attrs=("ID", "Species", "Legs"))
+        self.assertEqual(a.ID, 3)
+        self.assertEqual(a.Species, u"Emu")
+        self.assertEqual(a.Legs, 42)
+        self.assertEqual(a.ZooID, None)
+        self.assertEqual(a.sandbox, None)
+        self.assertEqual(a.dirty(), False)
+        
+        a = Animal._from_row({'Species': u'Emu'}, coerce=False)
+        self.assertEqual(a._properties['Lifespan'], None)
+        self.assertEqual(a.dirty(), False)
+    
     def test_associations(self):
         # Test for ticket #35.
         box = store.new_sandbox()
@@ -135,6 +228,28 @@ class UnitTests(unittest.TestCase):
         self.assert_(bat3 is not bat)
         self.assertEqual(bat3.Legs, 4)
     
+    def test_loader_setstate(self):
+        class Badge(dejavu.Unit):
+            Number = UnitProperty(int)
+            def __setstate__(self, state):
+                # Written for the Dejavu 1.x (properties, hash) state.
+                self._properties, self._initial_property_hash = state
+                self.sandbox = None
+                self.printed = False
+        
+        b = Badge._from_row({'ID': 1, 'Number': '7'})
+        self.assertEqual(b.Number, 7)
+        self.assertEqual(b.printed, False)
+        self.assertEqual(b.dirty(), False)
+        
+        # Coercion errors name the offending key and value.
+        try:
+            Badge._from_row({'ID': 1, 'Number': 'seven'})
+        except ValueError, x:
+            self.assertEqual(x.args[-2:], ('Number', 'seven'))
+        else:
+            self.fail("ValueError not raised")
+    
     def test_UnitJoin(self):
         box = store.new_sandbox()
         tree = Animal & Zoo
@@ -264,6 +379,356 @@ class UnitTests(unittest.TestCase):
         except ImportError:
             print "Skipping decimal test."
         
+
+
+class TransactionalRAMStorage(storeram.RAMStorage):
+    """A RAMStorage which can roll back to the start of a transaction."""
+    
+    def __init__(self, allOptions={}):
+        storeram.RAMStorage.__init__(self, allOptions)
+        self.snapshot = None
+        self.rollbacks = 0
+    
+    def start(self, isolation=None):
+        self.snapshot = dict([(cls, cache.copy())
+                              for cls, cache in self._caches.iteritems()])
+    
+    def rollback(self):
+        self.rollbacks += 1
+        if self.snapshot is not None:
+            self._caches, self.snapshot = self.snapshot, None
+    
+    def commit(self):
+        self.snapshot = None
+
+
+class StorageTests(unittest.TestCase):
+    
+    def test_compact_units(self):
+        class Pass(dejavu.Unit):
+            compact = True
+            Price = UnitProperty(int)
+            Holder = UnitProperty()
+        store.register(Pass)
+        store.create_storage(Pass)
+        try:
+            t = Pass(Price=12, Holder=u'Ann')
+            self.assert_(isinstance(t._properties, dejavu.CompactProperties))
+            self.assertEqual(t.dirty(), True)
+            box = store.new_sandbox()
+            box.memorize(t)
+            box.flush_all()
+            
+            t = store.new_sandbox().unit(Pass, Price=12)
+            self.assert_(isinstance(t._properties, dejavu.CompactProperties))
+            self.assertEqual(t.Holder, u'Ann')
+            self.assertEqual(t._properties['Price'], 12)
+            self.assertEqual(t._properties.copy(),
+                             {'ID': t.ID, 'Price': 12, 'Holder': u'Ann'})
+            t.Holder = u'Bob'
+            self.assertEqual(t.changed(), set(['Holder']))
+        finally:
+            store.drop_storage(Pass)
+    
+    def test_id_blocks(self):
+        ramstore = storage.resolve("ram", {'id_block_size': 3})
+        ramstore.register(Animal)
+        ramstore.create_storage(Animal)
+        box = ramstore.new_sandbox()
+        
+        ape = Animal(Species='Ape')
+        box.memorize(ape)
+        bee = Animal(Species='Bee')
+        box.memorize(bee)
+        self.assertEqual(bee.ID, ape.ID + 1)
+        
+        # A supplied ID inside the reserved block must not be handed out.
+        cat = Animal(ID=bee.ID + 1, Species='Cat')
+        box.memorize(cat)
+        dog = Animal(Species='Dog')
+        box.memorize(dog)
+        self.assertEqual(dog.ID, cat.ID + 1)
+        
+        # Identities are not reused after their units are destroyed.
+        dog.forget()
+        eel = Animal(Species='Eel')
+        box.memorize(eel)
+        self.assertEqual(eel.ID, dog.ID + 1)
+    
+    def test_file_marks(self):
+        root = tempfile.mkdtemp()
+        try:
+            fstore = storage.resolve("folders", {'root': root,
+                                                 'id_block_size': 1})
+            fstore.register(Animal)
+            fstore.create_storage(Animal)
+            for species in ('Ape', 'Bee'):
+                fstore.reserve(Animal(Species=species))
+            seq = os.path.join(fstore.shelf(Animal), "class.seq")
+            self.assert_(os.path.exists(seq))
+            
+            # An unreadable mark falls back to scanning the identities.
+            f = open(seq, 'wb')
+            f.write("\x80\x02(")
+            f.close()
+            cat = Animal(Species='Cat')
+            fstore.reserve(cat)
+            self.assertEqual(cat.ID, 3)
+            
+            # ...and the rewritten mark is read back.
+            dog = Animal(Species='Dog')
+            fstore.reserve(dog)
+            self.assertEqual(dog.ID, 4)
+            self.assertEqual([name for name in os.listdir(fstore.shelf(Animal))
+                              if name.endswith(".tmp")], [])
+        finally:
+            shutil.rmtree(root)
+    
+    def test_shelve_marks(self):
+        root = tempfile.mkdtemp()
+        try:
+            opts = {'Path': root, 'id_block_size': 1}
+            sstore = storage.resolve("shelve", opts)
+            sstore.register(Animal)
+            sstore.create_storage(Animal)
+            sstore.map_all()
+            ape, bee = Animal(Species='Ape'), Animal(Species='Bee')
+            sstore.reserve(ape)
+            sstore.reserve(bee)
+            sstore.destroy(bee)
+            sstore.shutdown()
+            
+            # The mark outlives the store, so bee's ID is not reused.
+            sstore = storage.resolve("shelve", opts)
+            sstore.register(Animal)
+            sstore.map_all()
+            cat = Animal(Species='Cat')
+            sstore.reserve(cat)
+            self.assertEqual(cat.ID, bee.ID + 1)
+            animals = sstore.recall(Animal, order=['ID'])
+            self.assertEqual([a.Species for a in animals], ['Ape', 'Cat'])
+            sstore.shutdown()
+        finally:
+            shutil.rmtree(root)
+    
+    def test_join_filters(self):
+        expr = dejavu.logic.Expression(lambda a, z: a.Legs == 6 and
+                                       z.Name == 'Zoo 0' and a.ZooID == z.ID)
+        filters = storage.join_filters(Animal & Zoo, expr)
+        self.assertEqual(filters[Animal](Animal(Legs=6)), True)
+        self.assertEqual(filters[Animal](Animal(Legs=4)), False)
+        self.assertEqual(filters[Zoo](Zoo(Name='Zoo 0')), True)
+        self.assertEqual(filters[Zoo](Zoo(Name='Zoo 1')), False)
+        
+        # The optional side of an outer join must not be filtered.
+        filters = storage.join_filters(Animal << Zoo, expr)
+        self.assertEqual(filters[Zoo], None)
+        self.assertEqual(filters[Animal](Animal(Legs=4)), False)
+        
+        # An 'or' inside an operand stays whole.
+        expr = dejavu.logic.Expression(lambda a, z: (a.Legs == 6 or
+                                                     a.Legs == 8) and
+                                       (a.ZooID == z.ID or z.Name == None))
+        parts = storage.conjuncts(expr, 2)
+        self.assertEqual(parts[1], None)
+        self.assertEqual(parts[0](Animal(Legs=8)), True)
+        self.assertEqual(parts[0](Animal(Legs=4)), False)
+    
+    def test_background_flush_failure(self):
+        class Stray(dejavu.Unit):
+            # Not registered with the store, so saving one fails.
+            pass
+        
+        tstore = TransactionalRAMStorage()
+        tstore.register(Animal)
+        tstore.create_storage(Animal)
+        writer = storage.BackgroundWriter(tstore)
+        good = writer.put([Animal(Species='Ant', ID=1)])
+        bad = writer.put([Stray(ID=1)])
+        
+        self.assertEqual(good.wait(), True)
+        self.assertRaises(KeyError, bad.wait)
+        self.assertEqual(tstore.new_sandbox().Animal(1).Species, 'Ant')
+        
+        class UncommittableRAMStorage(TransactionalRAMStorage):
+            def commit(self):
+                raise IOError("The commit failed.")
+        
+        # A failed commit also rolls back the writer's transaction.
+        ustore = UncommittableRAMStorage()
+        ustore.register(Animal)
+        ustore.create_storage(Animal)
+        writer = storage.BackgroundWriter(ustore)
+        self.assertRaises(IOError, writer.put([Animal(ID=1)]).wait)
+        self.assertEqual(ustore.rollbacks, 1)
+        self.assertEqual(ustore.new_sandbox().Animal(1), None)
+    
+    def test_sandbox_pool_failure(self):
+        class Grumpy(dejavu.Unit):
+            def on_repress(self):
+                raise ValueError("Grumpy units cannot be flushed.")
+        
+        tstore = TransactionalRAMStorage()
+        tstore.register(Grumpy)
+        tstore.create_storage(Grumpy)
+        pool = tstore.new_sandbox_pool()
+        box = pool.get()
+        grumpy = Grumpy()
+        box.memorize(grumpy)
+        self.assertRaises(ValueError, pool.release)
+        
+        # The failed flush rolled back the transaction,
+        # and the Sandbox was emptied for its next request.
+        self.assertEqual(tstore.rollbacks, 1)
+        self.assert_(pool.get() is box)
+        self.assert_(box.unit(Grumpy, ID=grumpy.ID) is not grumpy)
+    
+    def test_flush_failure(self):
+        class Fragile(dejavu.Unit):
+            Size = UnitProperty(int)
+        
+        class FailingRAMStorage(storeram.RAMStorage):
+            fail = True
+            def save_many(self, units, forceSave=False):
+                if self.fail:
+                    raise IOError("The disk is full.")
+                storeram.RAMStorage.save_many(self, units, forceSave)
+        
+        fstore = FailingRAMStorage()
+        fstore.register(Fragile)
+        fstore.create_storage(Fragile)
+        box = fstore.new_sandbox()
+        fragile = Fragile(Size=3)
+        box.memorize(fragile)
+        fragile.Size = 4
+        self.assertRaises(IOError, box.flush_all)
+        
+        # The unsaved unit was kept, and is saved by the next flush.
+        self.assert_(box.unit(Fragile, ID=fragile.ID) is fragile)
+        fstore.fail = False
+        box.flush_all()
+        saved = fstore.new_sandbox().unit(Fragile, ID=fragile.ID)
+        self.assertEqual(saved.Size, 4)
+    
+    def test_loader_init(self):
+        # Units formed by the loader (as the JSON and folder stores do)
+        # still get the state which their class' __init__ sets up.
+        coll = engines.UnitCollection._from_row({'Members': [1, 2]},
+                                                coerce=False)
+        coll.acquire()
+        coll.release()
+        self.assertEqual(coll.Members, [1, 2])
+        self.assertEqual(coll.dirty(), False)
+        
+        root = tempfile.mkdtemp()
+        try:
+            fstore = storage.resolve("folders", {'root': root})
+            fstore.register(engines.UnitCollection)
+            fstore.create_storage(engines.UnitCollection)
+            fstore.reserve(engines.UnitCollection(Members=[3]))
+            
+            coll = fstore.recall(engines.UnitCollection)[0]
+            coll.acquire()
+            coll.release()
+            self.assertEqual(coll.Members, [3])
+        finally:
+            shutil.rmtree(root)
+
+
+try:
+    import _sqlite3
+except ImportError:
+    _sqlite3 = None
+
+
+class SQLiteTests(unittest.TestCase):
+    """Tests of the database store, using an in-memory SQLite database."""
+    
+    def setUp(self):
+        self.store = storage.resolve("sqlite", {'Database': ':memory:'})
+        for cls in (Animal, Zoo):
+            self.store.register(cls)
+            self.store.create_storage(cls)
+    
+    def tearDown(self):
+        self.store.shutdown()
+    
+    def statements(self, func, *args):
+        """Return the SQL statements which func(*args) executes."""
+        messages = []
+        self.store.log = messages.append
+        self.store.logflags = dejavu.logflags.SQL
+        try:
+            func(*args)
+        finally:
+            self.store.logflags = 0
+        return messages
+    
+    def test_destroy_many(self):
+        box = self.store.new_sandbox()
+        ants = [Animal(Species='Ant %s' % i) for i in range(3)]
+        box.memorize(*ants)
+        box.flush_all()
+        
+        sql = self.statements(self.store.destroy_many, ants[:2])
+        self.assertEqual(len([s for s in sql if 'DELETE' in s]), 1)
+        self.assertEqual([a.Species for a in self.store.recall(Animal)],
+                         ['Ant 2'])
+    
+    def test_deferred(self):
+        box = self.store.new_sandbox()
+        box.memorize(Animal(Species='Emu', Legs=2, PreviousZoos=[u'Perth']))
+        box.flush_all()
+        
+        box = self.store.new_sandbox()
+        emu = box.recall(Animal, defer=['PreviousZoos'])[0]
+        self.assertEqual(emu._deferred, set(['PreviousZoos']))
+        self.assertEqual(emu._properties['PreviousZoos'], None)
+        
+        # Saving must not write the None placeholder.
+        emu.Legs = 3
+        self.store.save(emu)
+        full = self.store.recall(Animal)[0]
+        self.assertEqual((full.Legs, full.PreviousZoos), (3, [u'Perth']))
+        
+        # The first access loads the value.
+        self.assertEqual(emu.PreviousZoos, [u'Perth'])
+        self.assertEqual(emu._deferred, None)
+        
+        # Nor must destroy match on the None placeholder.
+        emu = list(self.store.xrecall(Animal, defer=['PreviousZoos']))[0]
+        self.store.destroy(emu)
+        self.assertEqual(self.store.recall(Animal), [])
+    
+    def test_aggregate(self):
+        box = self.store.new_sandbox()
+        box.memorize(*[Animal(Species='Beetle', Legs=legs, Lifespan=life)
+                       for legs, life in ((6, 1.0), (6, 3.0), (4, 2.0))])
+        box.flush_all()
+        
+        aggregates = {'n': dejavu.analysis.COUNT,
+                      'least': dejavu.analysis.MIN('Lifespan'),
+                      'most': dejavu.analysis.MAX('Lifespan'),
+                      'mean': dejavu.analysis.AVG('Lifespan')}
+        results = []
+        def aggregate():
+            results.append(self.store.aggregate(Animal, ['Legs'], aggregates))
+        sql = self.statements(aggregate)
+        
+        # A single GROUP BY statement, not a scan of every unit.
+        self.assertEqual(len(sql), 1)
+        self.assert_('GROUP BY' in sql[0])
+        self.assertEqual(results[0],
+                         {(6,): {'n': 2, 'least': 1.0, 'most': 3.0,
+                                 'mean': 2.0},
+                          (4,): {'n': 1, 'least': 2.0, 'most': 2.0,
+                                 'mean': 2.0}})
+
+if _sqlite3 is None:
+    print "The _sqlite3 module could not be imported. SQLiteTests skipped."
+    del SQLiteTests
+
+
 if __name__ == "__main__":
     unittest.main(__name__)
 
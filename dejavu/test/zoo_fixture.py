@@ -1187,6 +1187,66 @@ class ConcurrencyTests(unittest.TestCase):
             print "'with ... as' not supported (skipped) ",
         else:
             test_context.test_with_context(root)
+    
+    def test_AsyncSandbox(self):
+        abox = root.new_async_sandbox()
+        try:
+            ants = [Animal(Family='Ant %s' % i) for i in range(3)]
+            abox.memorize(*ants).result(5)
+            
+            futures = [abox.unit(Animal, ID=ant.ID) for ant in ants]
+            missing = abox.unit(Animal, ID=-1)
+            self.assertEqual([f.result(5) for f in futures], ants)
+            self.assertEqual(missing.result(5), None)
+            self.assertEqual(abox.count(Animal, ant_filter).result(5), 3)
+            f = abox.run(lambda box: box.recall(Animal, lambda a: a.ID < 0)[0])
+            self.assertRaises(IndexError, f.result, 5)
+            
+            stream = abox.xrecall(Animal, ant_filter, size=2)
+            batches = [stream.next().result(5) for i in range(3)]
+            self.assertEqual(map(len, batches), [2, 1, 0])
+            self.assertEqual(sorted([a.ID for b in batches for a in b]),
+                             sorted([a.ID for a in ants]))
+            
+            # Every call runs on the same worker thread.
+            current = lambda box: threading.currentThread()
+            worker = abox.run(current).result(5)
+            self.assert_(worker is not threading.currentThread())
+            self.assert_(abox.run(current).result(5) is worker)
+            abox.flush_all().result(5)
+            abox.close()
+            self.assertEqual(worker.isAlive(), False)
+            self.assertRaises(ValueError, abox.flush_all)
+        finally:
+            forget_ants()
+    
+    def test_BackgroundFlush(self):
+        try:
+            box = root.new_sandbox()
+            box.memorize(*[Animal(Family='Ant %s' % i, PreviousZoos=[u'Perth'])
+                           for i in range(3)])
+            box.flush_all()
+            
+            # Stores which defer properties should not have to load
+            # them in order to copy the units for the writer.
+            ants = box.recall(Animal, ant_filter, defer=['PreviousZoos'])
+            deferred = [ant._deferred for ant in ants]
+            for ant in ants:
+                ant.Legs = 6
+            handle = box.flush_all(background=True)
+            self.assertEqual([ant._deferred for ant in ants], deferred)
+            self.assertEqual(handle.wait(), True)
+            self.assertEqual(handle.done(), True)
+            self.assertEqual(handle.error, None)
+            
+            # The sandbox let go of its units when the flush was queued.
+            self.assert_(box.unit(Animal, ID=ants[0].ID) is not ants[0])
+            box = root.new_sandbox()
+            self.assertEqual(box.sum(Animal, 'Legs', ant_filter), 18)
+            self.assertEqual(box.recall(Animal, ant_filter)[0].PreviousZoos,
+                             [u'Perth'])
+        finally:
+            forget_ants()
 
 
 class NumericTests(unittest.TestCase):
@@ -1409,6 +1469,494 @@ class NumericTests(unittest.TestCase):
             box.flush_all()
 
 
+ant_filter = lambda a: a.Family.startswith('Ant')
+farm_filter = lambda z: z.Name.startswith('Ant Farm')
+
+def forget_ants():
+    """Forget the Animals and Zoos made by SandboxTests."""
+    box = root.new_sandbox()
+    try:
+        for ant in box.recall(Animal, ant_filter):
+            ant.forget()
+        for farm in box.recall(Zoo, farm_filter):
+            farm.forget()
+    finally:
+        box.flush_all()
+
+
+class SandboxTests(unittest.TestCase):
+    
+    def tearDown(self):
+        forget_ants()
+    
+    def test_deferred(self):
+        box = root.new_sandbox()
+        try:
+            box.memorize(Animal(Family='Ant', PreviousZoos=[u'Perth']))
+        finally:
+            box.flush_all()
+        
+        box = root.new_sandbox()
+        try:
+            ant = box.recall(Animal, ant_filter, defer=['PreviousZoos'])[0]
+            self.assertEqual(ant.PreviousZoos, [u'Perth'])
+            self.assertEqual(ant.dirty(), False)
+        finally:
+            box.flush_all()
+    
+    def test_prefetch(self):
+        box = root.new_sandbox()
+        try:
+            farms = [Zoo(Name='Ant Farm %s' % i) for i in range(2)]
+            box.memorize(*farms)
+            for family in ('Ant', 'Antlion'):
+                ant = Animal(Family=family)
+                box.memorize(ant)
+                farms[0].add(ant)
+        finally:
+            box.flush_all()
+        
+        box = root.new_sandbox()
+        try:
+            farms = box.recall(Zoo, farm_filter, order=['Name'],
+                               prefetch=['Animal'])
+            self.assertEqual(len(farms), 2)
+            ants = farms[0].Animal()
+            self.assertEqual(sorted([a.Family for a in ants]),
+                             [u'Ant', u'Antlion'])
+            self.assertEqual(farms[1].Animal(), [])
+            self.assert_(box.unit(Animal, ID=ants[0].ID) is ants[0])
+            
+            # Changing a far key must discard the prefetched groups.
+            ant = box.unit(Animal, Family='Ant')
+            ant.ZooID = farms[1].ID
+            self.assertEqual(len(farms[0].Animal()), 1)
+            self.assertEqual(farms[1].Animal(), [ant])
+        finally:
+            box.flush_all()
+    
+    def test_related_cache(self):
+        box = root.new_sandbox()
+        try:
+            farm = Zoo(Name='Ant Farm')
+            ant = Animal(Family='Ant', Legs=6)
+            box.memorize(farm, ant)
+            farm.add(ant)
+            self.assertEqual(farm.Animal(), [ant])
+            
+            # Memorizing a far unit must discard the remembered results.
+            lion = Animal(Family='Antlion', Legs=6, ZooID=farm.ID)
+            box.memorize(lion)
+            self.assertEqual(len(farm.Animal()), 2)
+            
+            # Filtered results are discarded when any far property changes.
+            f = lambda a: a.Legs == 6
+            self.assertEqual(len(farm.Animal(f)), 2)
+            lion.Legs = 3
+            self.assertEqual(farm.Animal(f), [ant])
+            self.assertEqual(len(farm.Animal()), 2)
+        finally:
+            box.flush_all()
+    
+    def test_sandbox_indexes(self):
+        box = root.new_sandbox()
+        try:
+            farms = [Zoo(Name='Ant Farm %s' % i) for i in range(2)]
+            box.memorize(*farms)
+            for i in range(4):
+                box.memorize(Animal(Family='Ant %s' % i,
+                                    ZooID=farms[i % 2].ID))
+            
+            ant = box.unit(Animal, ZooID=farms[0].ID)
+            self.assertEqual(ant.ZooID, farms[0].ID)
+            
+            # Setting an indexed property moves the unit in the index,
+            # and recall sees the change before it is saved.
+            ant.ZooID = farms[1].ID
+            in_farm = logic.filter(ZooID=farms[1].ID)
+            self.assertEqual(len(box.recall(Animal, in_farm)), 3)
+            self.assert_(box.unit(Animal, ZooID=farms[1].ID,
+                                  Family=ant.Family) is ant)
+            
+            ant.forget()
+            self.assertEqual(len(box.recall(Animal, in_farm)), 2)
+        finally:
+            box.flush_all()
+    
+    def test_identity_recall(self):
+        box = root.new_sandbox()
+        try:
+            ant, lion = Animal(Family='Ant'), Animal(Family='Antlion')
+            box.memorize(ant, lion)
+        finally:
+            box.flush_all()
+        antID, ids = ant.ID, (ant.ID, lion.ID)
+        
+        # The Ant is served from the cache (with its unsaved change),
+        # and only the Antlion is fetched from storage.
+        box = root.new_sandbox()
+        try:
+            ant = box.unit(Animal, ID=antID)
+            ant.Family = 'Anteater'
+            found = box.recall(Animal, lambda a: a.ID in ids)
+            self.assertEqual(len(found), 2)
+            self.assert_(ant in found)
+            self.assertEqual(box.recall(Animal, lambda a: a.ID == antID and
+                                        a.Family == 'Ant'), [])
+            self.assertEqual(box.recall(Animal, lambda a: a.ID == antID and
+                                        a.Family == 'Anteater'), [ant])
+        finally:
+            box.flush_all()
+    
+    def test_memorize_many(self):
+        box = root.new_sandbox()
+        try:
+            ants = [Animal(Family='Ant %s' % i) for i in range(5)]
+            box.memorize(*ants)
+            ids = [ant.ID for ant in ants]
+            self.assert_(None not in ids)
+            self.assertEqual(len(set(ids)), 5)
+            self.assert_(box.unit(Animal, ID=ids[2]) is ants[2])
+            self.assertEqual(root.new_sandbox().unit(Animal, ID=ids[4]).Family,
+                             'Ant 4')
+        finally:
+            box.flush_all()
+    
+    def test_batched_writes(self):
+        box = root.new_sandbox()
+        try:
+            ants = [Animal(Family='Ant %s' % i) for i in range(4)]
+            box.memorize(*ants)
+            for ant in ants:
+                ant.Legs = 6
+        finally:
+            box.flush_all()
+        
+        box = root.new_sandbox()
+        try:
+            ants = box.recall(Animal, ant_filter)
+            self.assertEqual([ant.Legs for ant in ants], [6] * 4)
+            box.forget(*ants)
+            self.assertEqual([ant.sandbox for ant in ants], [None] * 4)
+        finally:
+            box.flush_all()
+        self.assertEqual(root.new_sandbox().recall(Animal, ant_filter), [])
+    
+    def test_bounded_sandbox(self):
+        box = root.new_sandbox()
+        try:
+            box.memorize(*[Animal(Family='Ant %s' % i) for i in range(10)])
+        finally:
+            box.flush_all()
+        
+        box = root.new_sandbox(max_units=3)
+        try:
+            ants = box.recall(Animal, ant_filter)
+            first = ants[0]
+            ants[1].Legs = 5
+            changedID = ants[1].ID
+            del ants
+            
+            # Only the 3 most recent units are held strongly, plus the
+            # dirty unit; the rest are left to the garbage collector,
+            # unless (like first) we still reference them.
+            self.assertEqual(len(box._held), 3)
+            self.assertEqual([unit.ID for unit in box._pinned.values()],
+                             [changedID])
+            self.assert_(box.unit(Animal, ID=first.ID) is first)
+        finally:
+            box.flush_all()
+        self.assertEqual(root.new_sandbox().unit(Animal, ID=changedID).Legs, 5)
+    
+    def test_join_view(self):
+        box = root.new_sandbox()
+        try:
+            farm = Zoo(Name='Ant Farm')
+            box.memorize(farm)
+            ant = Animal(Family='Ant', Legs=6)
+            box.memorize(ant)
+            farm.add(ant)
+        finally:
+            box.flush_all()
+        
+        box = root.new_sandbox()
+        try:
+            ants = lambda a, z: a.Family == 'Ant'
+            q = dejavu.Query(Animal & Zoo, [['Family'], ['Name']], ants)
+            self.assertEqual(box.view(q), [('Ant', 'Ant Farm')])
+            q = dejavu.Query(Animal, lambda a: (a.Family, a.Legs * 2),
+                             ant_filter)
+            self.assertEqual(box.view(q), [('Ant', 12)])
+            
+            # Dirty units in the identity map win over storage.
+            box.unit(Zoo, ID=farm.ID).Name = 'Ant Farm (renamed)'
+            box.unit(Animal, ID=ant.ID).Legs = 8
+            q = dejavu.Query(Animal & Zoo, [['Family'], ['Name']], ants)
+            self.assertEqual(box.view(q), [('Ant', 'Ant Farm (renamed)')])
+            q = dejavu.Query(Animal, lambda a: (a.Family, a.Legs * 2),
+                             ant_filter)
+            self.assertEqual(box.view(q), [('Ant', 16)])
+            q = dejavu.Query(Animal & Zoo, [['Family'], ['Name']],
+                             lambda a, z: z.Name == 'Ant Farm')
+            self.assertEqual(box.view(q), [])
+        finally:
+            box.flush_all()
+    
+    def test_aggregates(self):
+        box = root.new_sandbox()
+        try:
+            box.memorize(*[Animal(Family='Ant', Legs=6) for i in range(3)])
+        finally:
+            box.flush_all()
+        
+        sixes = lambda a: a.Family == 'Ant' and a.Legs == 6
+        box = root.new_sandbox()
+        try:
+            ants = box.recall(Animal, ant_filter)
+            self.assertEqual(box.count(Animal, sixes), 3)
+            self.assertEqual(box.sum(Animal, 'Legs', ant_filter), 18)
+            
+            # Dirty units are counted from the cache, the rest from storage.
+            ants[0].Legs = 8
+            self.assertEqual(box.count(Animal, sixes), 2)
+            self.assertEqual(box.sum(Animal, 'Legs', ant_filter), 20)
+            self.assertEqual(box.range(Animal, 'Legs', ant_filter), [6, 7, 8])
+            
+            # Past max_excluded_units dirty units, storage is not asked
+            # to leave them out; the aggregate is taken over a view.
+            ants[1].Legs = 8
+            box.max_excluded_units = 1
+            self.assertEqual(box.count(Animal, sixes), 1)
+            self.assertEqual(box.sum(Animal, 'Legs', ant_filter), 22)
+            self.assertEqual(box.range(Animal, 'Legs', ant_filter), [6, 7, 8])
+        finally:
+            box.flush_all()
+    
+    def test_readonly_sandbox(self):
+        box = root.new_sandbox()
+        try:
+            box.memorize(Animal(Family='Ant', Legs=6))
+        finally:
+            box.flush_all()
+        
+        box = root.new_sandbox(readonly=True)
+        ants = box.recall(Animal, ant_filter)
+        self.assertEqual([ant.Family for ant in ants], ['Ant'])
+        self.assert_(box.unit(Animal, ID=ants[0].ID) is not ants[0])
+        self.assertRaises(errors.ReadOnlyError, setattr, ants[0], 'Legs', 8)
+        self.assertRaises(errors.ReadOnlyError, box.memorize, Animal())
+        self.assertRaises(errors.ReadOnlyError, ants[0].forget)
+        
+        # Far units are streamed afresh, not remembered.
+        box = root.new_sandbox()
+        try:
+            farm = Zoo(Name='Ant Farm')
+            box.memorize(farm)
+            farm.add(box.unit(Animal, Family='Ant'))
+        finally:
+            box.flush_all()
+        box = root.new_sandbox(readonly=True)
+        farm = box.unit(Zoo, Name='Ant Farm')
+        first = farm.Animal()
+        self.assertEqual([ant.Family for ant in first], ['Ant'])
+        self.assert_(farm.Animal()[0] is not first[0])
+    
+    def test_units_by_id(self):
+        box = root.new_sandbox()
+        try:
+            box.memorize(*[Animal(Family='Ant %s' % i) for i in range(3)])
+            ids = [ant.identity() for ant in box.recall(Animal, ant_filter)]
+        finally:
+            box.flush_all()
+        
+        found = root.unit_many(Animal, ids[:2] + [(-1,)])
+        self.assertEqual(len(found), 2)
+        
+        box = root.new_sandbox()
+        try:
+            first = box.unit(Animal, ID=ids[0][0])
+            ants = box.units_by_id(Animal, [ids[2], (-1,), ids[0]])
+            self.assertEqual([ant.identity() for ant in ants],
+                             [ids[2], ids[0]])
+            self.assert_(ants[1] is first)
+        finally:
+            box.flush_all()
+    
+    def test_coalesce(self):
+        box = root.new_sandbox()
+        try:
+            farms = [Zoo(Name='Ant Farm %s' % i) for i in range(3)]
+            box.memorize(*farms)
+            for farm in farms:
+                ant = Animal(Family='Ant')
+                box.memorize(ant)
+                farm.add(ant)
+        finally:
+            box.flush_all()
+        
+        box = root.new_sandbox(coalesce=True)
+        try:
+            ants = box.recall(Animal, ant_filter)
+            ants[0].Zoo()
+            
+            # One miss loaded the Zoo of every Animal in the sandbox,
+            # so the others no longer need storage at all.
+            for farm in root.recall(Zoo, farm_filter):
+                root.destroy(farm)
+            self.assertEqual(sorted([ant.Zoo().Name for ant in ants]),
+                             ['Ant Farm 0', 'Ant Farm 1', 'Ant Farm 2'])
+        finally:
+            box.flush_all()
+    
+    def test_sandbox_pool(self):
+        pool = root.new_sandbox_pool()
+        box = pool.get()
+        self.assert_(pool.get() is box)
+        ant = Animal(Family='Ant')
+        box.memorize(ant)
+        self.assert_(box.Animal(ant.ID) is ant)
+        pool.release()
+        
+        # The same, now empty, Sandbox is reused.
+        self.assert_(pool.get() is box)
+        again = box.Animal(ant.ID)
+        self.assert_(again is not ant)
+        self.assertEqual(again.Family, 'Ant')
+        pool.release()
+    
+    def memorize_legs(self):
+        box = root.new_sandbox()
+        try:
+            legs = [3, 1, 2, 8, 6, 2]
+            box.memorize(*[Animal(Family='Ant %s' % i, Legs=n,
+                                  PreviousZoos=[u'Perth'])
+                           for i, n in enumerate(legs)])
+        finally:
+            box.flush_all()
+    
+    def families(self, order, limit=None, offset=None):
+        return [ant.Family for ant in
+                root.recall(Animal, ant_filter, order=order,
+                            limit=limit, offset=offset)]
+    
+    def test_ordered_limit(self):
+        self.memorize_legs()
+        self.assertEqual(self.families(['Legs DESC', 'Family'], limit=3),
+                         ['Ant 3', 'Ant 4', 'Ant 0'])
+        self.assertEqual(self.families(['Legs', 'Family DESC'],
+                                       limit=2, offset=1),
+                         ['Ant 5', 'Ant 2'])
+        
+        # xview keeps only the rows it may yield.
+        query = dejavu.Query(Animal, ['Family'],
+                             lambda a: a.Family.startswith('Ant') and
+                             a.Legs != 8)
+        self.assertEqual(root.view(query, order=['Legs DESC', 'Family'],
+                                   limit=2, offset=1),
+                         [(u'Ant 0',), (u'Ant 2',)])
+    
+    def test_spilled_sort(self):
+        self.memorize_legs()
+        
+        # Stores which sort in Python do so in runs of 2 rows,
+        # spilled to temp files and then merged.
+        store = leaf_store()
+        sort_buffer, store.sort_buffer = store.sort_buffer, 2
+        try:
+            self.assertEqual(self.families(['Legs DESC', 'Family']),
+                             ['Ant 3', 'Ant 4', 'Ant 0', 'Ant 2', 'Ant 5',
+                              'Ant 1'])
+            
+            box = root.new_sandbox()
+            try:
+                ants = box.recall(Animal, ant_filter, order=['Legs', 'Family'],
+                                  defer=['PreviousZoos'])
+                self.assertEqual([ant.Family for ant in ants],
+                                 ['Ant 1', 'Ant 2', 'Ant 5', 'Ant 0', 'Ant 4',
+                                  'Ant 3'])
+                self.assertEqual(ants[0].PreviousZoos, [u'Perth'])
+            finally:
+                box.flush_all()
+            
+            query = dejavu.Query(Animal, ['Family'], ant_filter)
+            self.assertEqual(root.view(query, order=['Legs', 'Family']),
+                             [(u'Ant 1',), (u'Ant 2',), (u'Ant 5',),
+                              (u'Ant 0',), (u'Ant 4',), (u'Ant 3',)])
+        finally:
+            store.sort_buffer = sort_buffer
+    
+    def test_hash_join(self):
+        box = root.new_sandbox()
+        try:
+            farms = [Zoo(Name='Ant Farm %s' % i) for i in range(2)]
+            ants = [Animal(Family='Ant %s' % i) for i in range(3)]
+            box.memorize(*(farms + ants))
+            farms[0].add(ants[0])
+            farms[0].add(ants[1])
+        finally:
+            box.flush_all()
+        
+        def pairs(join, expr):
+            rows = [(a.Family, z.Name) for a, z in root.recall(join, expr)]
+            rows.sort()
+            return rows
+        
+        self.assertEqual(pairs(Animal & Zoo, lambda a, z:
+                               a.Family.startswith('Ant') and
+                               z.Name.startswith('Ant Farm')),
+                         [('Ant 0', 'Ant Farm 0'), ('Ant 1', 'Ant Farm 0')])
+        self.assertEqual(pairs(Animal << Zoo, lambda a, z:
+                               a.Family.startswith('Ant')),
+                         [('Ant 0', 'Ant Farm 0'), ('Ant 1', 'Ant Farm 0'),
+                          ('Ant 2', None)])
+        self.assertEqual(pairs(Animal >> Zoo, lambda a, z:
+                               z.Name.startswith('Ant Farm')),
+                         [(None, 'Ant Farm 1'), ('Ant 0', 'Ant Farm 0'),
+                          ('Ant 1', 'Ant Farm 0')])
+        
+        # Each unmatched row gets dummy units of its own.
+        box = root.new_sandbox()
+        try:
+            box.memorize(Animal(Family='Ant 3'))
+        finally:
+            box.flush_all()
+        dummies = [z for a, z in root.recall(Animal << Zoo, lambda a, z:
+                                             a.Family.startswith('Ant'))
+                   if z.Name is None]
+        self.assertEqual(len(dummies), 2)
+        self.assert_(dummies[0] is not dummies[1])
+    
+    def test_grouped_aggregate(self):
+        box = root.new_sandbox()
+        try:
+            box.memorize(*[Animal(Family='Antlion', Legs=legs, Lifespan=life)
+                           for legs, life in ((6, 1), (6, 3), (4, 2))])
+        finally:
+            box.flush_all()
+        
+        lions = lambda a: a.Family == 'Antlion'
+        aggregates = {'n': dejavu.analysis.COUNT,
+                      'most': dejavu.analysis.MAX('Lifespan')}
+        self.assertEqual(root.aggregate(Animal, ['Legs'], aggregates, lions),
+                         {(6,): {'n': 2, 'most': 3},
+                          (4,): {'n': 1, 'most': 2}})
+        
+        # Dirty units are folded into the results from storage.
+        box = root.new_sandbox()
+        try:
+            lion = box.unit(Animal, Family='Antlion', Legs=4)
+            lion.Legs = 6
+            self.assertEqual(box.aggregate(Animal, ['Legs'], aggregates,
+                                           lions),
+                             {(6,): {'n': 3, 'most': 3}})
+            self.assertEqual(box.aggregate(Animal, (),
+                                           {'avg': dejavu.analysis.AVG('Legs')},
+                                           lions),
+                             {(): {'avg': 6.0}})
+        finally:
+            box.flush_all()
+
+
 class DiscoveryTests(unittest.TestCase):
     
     def assertIn(self, first, second, msg=None):
@@ -1632,6 +2180,7 @@ def run(store, mediated=False):
             # Run the other cases.
             tools.djvTestRunner.run(loader(KeyStoreTests))
             tools.djvTestRunner.run(loader(NumericTests))
+            tools.djvTestRunner.run(loader(SandboxTests))
             
             # Each thread opens a new SQLite :memory: database,
             # so the concept of "concurrency" is pretty meaningless.
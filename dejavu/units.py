@@ -12,6 +12,12 @@ try:
     from hashlib import sha1 as sha
 except ImportError:
     from sha import new as sha
+
+try:
+    set
+except NameError:
+    from sets import Set as set
+
 import types
 import warnings
 
@@ -20,6 +26,7 @@ from dejavu import errors, logic
 
 __all__ = ['UnitAssociation', 'ToMany', 'ToOne', 'UnitJoin',
            'Unit', 'UnitProperty', 'TriggerProperty', 'MetaUnit',
+           'CompactProperties',
            'UnitSequencerInteger', 'UnitSequencer',
            'UnitSequencerUnicode',
 ##           '_define_fixedpoint_states', '_fix_fixedpoint_cmp',
@@ -97,6 +104,16 @@ class ToOne(UnitAssociation):
             return None
         
         if expr is None:
+            # Use far units which the sandbox has prefetched, if any.
+            sandbox = unit.sandbox
+            units = sandbox._related_units(self, value)
+            if units is None and sandbox._coalesced_related(self, unit):
+                units = sandbox._related_units(self, value)
+            if units is not None:
+                if units:
+                    return units[0]
+                return None
+            
             # Optimize with a unit() call so key-value stores can be hit.
             return unit.sandbox.unit(self.farClass, **{self.farKey: value})
         else:
@@ -120,9 +137,20 @@ class ToMany(UnitAssociation):
         if value is None:
             return []
         
-        expr = logic.combine(expr, {self.farKey: value})
-        return unit.sandbox.recall(self.farClass, expr, order=order,
-                                   limit=limit, offset=offset)
+        sandbox = unit.sandbox
+        memoize = (limit is None and not offset)
+        if memoize:
+            # Use far units which the sandbox has prefetched or remembered.
+            units = sandbox._related_units(self, value, expr, order)
+            if units is not None:
+                return units
+        
+        farexpr = logic.combine(expr, {self.farKey: value})
+        units = sandbox.recall(self.farClass, farexpr, order=order,
+                               limit=limit, offset=offset)
+        if memoize:
+            sandbox._remember_related(self, value, units, expr, order)
+        return units
 
 
 class UnitJoin(object):
@@ -261,7 +289,8 @@ class UnitSequencer(object):
         """Set a valid identifier on the given unit.
         
         The given sequence may be used to determine the 'next' valid id.
-        If provided, it should be the entire set of existing identifiers.
+        If provided, it should contain the greatest existing identifier
+        (stores may pass the entire set of existing identifiers).
         """
         raise StopIteration("No sequence defined.")
 
@@ -281,7 +310,8 @@ class UnitSequencerInteger(UnitSequencer):
         """Set a valid identifier on the given unit.
         
         The given sequence may be used to determine the 'next' valid id.
-        If provided, it should be the entire set of existing identifiers.
+        If provided, it should contain the greatest existing identifier
+        (stores may pass the entire set of existing identifiers).
         """
         newvalue = self.initial
         if sequence:
@@ -308,7 +338,8 @@ class UnitSequencerUnicode(UnitSequencer):
         """Set a valid identifier on the given unit.
         
         The given sequence may be used to determine the 'next' valid id.
-        If provided, it should be the entire set of existing identifiers.
+        If provided, it should contain the greatest existing identifier
+        (stores may pass the entire set of existing identifiers).
         """
         r = self.range
         newvalue = r[0] * self.width
@@ -344,9 +375,15 @@ class UnitSequencerDynamic(UnitSequencer):
 
 
 class UnitProperty(object):
-    """UnitProperty(type=unicode, index=False, hints={}, key=None, default=None)
+    """UnitProperty(type=unicode, index=False, hints={}, key=None,
+                    default=None, mutable=None, deferred=False)
     Data descriptor for Unit data which will persist in storage.
     
+    index: if True, Storage Managers may index values of this property,
+        and each Sandbox keeps an in-memory index of its cached units by
+        their values of this property, so that equality lookups (see
+        Sandbox.unit and Sandbox.xrecall) need not examine every unit.
+    
     hints: A dictionary which provides named hints to Storage Managers
         concerning the nature of the data. A common use, for example,
         is to inform Managers that would usually store unicode strings
@@ -355,9 +392,28 @@ class UnitProperty(object):
         hints = {u'bytes': 0}, where 0 implies no limit. Canonical storage
         hint names and implementation details may be found in /storage
         documentation.
+    
+    mutable: if True, values of this property may be modified in place
+        (e.g. list.append), which __set__ cannot see. Such properties
+        fall back to hashing in Unit.dirty(). If None (the default),
+        this is True for list, dict and set types and False otherwise.
+    
+    association_key: True if this property is the near or far key of
+        any UnitAssociation (set by Unit.associate). Changing the value
+        of such a property discards all groupings of related units which
+        the unit's sandbox has prefetched or remembered; changing any
+        other property discards only those remembered for an expr or order.
+    
+    deferred: if True, Storage Managers which support it will not fetch
+        values of this property when recalling units; instead, each value
+        is loaded from storage when the property is first read (see
+        Sandbox.undefer). This is useful for large values (such as those
+        with hints = {u'bytes': 0}) which most consumers never inspect.
+        Identifiers are never deferred.
     """
     
-    def __init__(self, type=unicode, index=False, hints=None, key=None, default=None):
+    def __init__(self, type=unicode, index=False, hints=None, key=None,
+                 default=None, mutable=None, deferred=False):
         if type.__name__ == 'FixedPoint':
             # fixedpoint can't handle "FixedPoint() != None" in Python 2.4
             _fix_fixedpoint_cmp()
@@ -372,6 +428,14 @@ class UnitProperty(object):
         self.hints = hints
         self.key = key
         self.default = default
+        
+        if mutable is None:
+            try:
+                mutable = issubclass(type, (list, dict, set))
+            except TypeError:
+                mutable = False
+        self.mutable = mutable
+        self.deferred = deferred
     
     def _get_default(self):
         return self._default
@@ -382,11 +446,15 @@ class UnitProperty(object):
     default = property(_get_default, _set_default,
                        doc="""Default value of this property for new units.""")
     
+    association_key = False
+    
     def __get__(self, unit, unitclass=None):
         if unit is None:
             # When calling on the class instead of an instance...
             return self
         else:
+            if unit._deferred and self.key in unit._deferred:
+                unit._undefer(self.key)
             return unit._properties[self.key]
     
     def __set__(self, unit, value):
@@ -400,9 +468,38 @@ class UnitProperty(object):
         """
         if self.coerce:
             value = self.coerce(unit, value)
+        self._store(unit, value)
+    
+    def _store(self, unit, value):
+        """Write the (coerced) value to the unit and do the bookkeeping.
+        
+        If the value differs from the current one, this marks the property
+        as changed and tells the unit's sandbox (if any), which may need to
+        discard remembered associations, update its indexes, or keep the
+        now-dirty unit alive. Return a (changed, oldvalue) tuple.
+        """
+        if unit._deferred and self.key in unit._deferred:
+            unit._undefer(self.key)
         oldvalue = unit._properties[self.key]
-        if oldvalue != value:
-            unit._properties[self.key] = value
+        if oldvalue == value:
+            return False, oldvalue
+        
+        sandbox = unit.sandbox
+        if sandbox is not None and sandbox.readonly:
+            raise errors.ReadOnlyError("%r cannot be changed in a "
+                                       "read-only Sandbox." % unit)
+        unit._properties[self.key] = value
+        unit._mark_changed(self.key)
+        if sandbox is not None:
+            if sandbox._related:
+                sandbox._invalidate_related(unit.__class__,
+                                            not self.association_key)
+            if self.index:
+                sandbox._reindex(unit, self.key, oldvalue, value)
+            if sandbox._pinned is not None:
+                # Keep the (now dirty) unit alive until it is saved.
+                sandbox._pinned[id(unit)] = unit
+        return True, oldvalue
     
     def coerce(self, unit, value):
         """Coerce the given value to the proper type for this property.
@@ -458,17 +555,162 @@ class TriggerProperty(UnitProperty):
     def __set__(self, unit, value):
         if self.coerce:
             value = self.coerce(unit, value)
-        oldvalue = unit._properties[self.key]
-        if oldvalue != value:
-            unit._properties[self.key] = value
-            if unit.sandbox:
-                self.on_set(unit, oldvalue)
+        changed, oldvalue = self._store(unit, value)
+        if changed and unit.sandbox:
+            self.on_set(unit, oldvalue)
     
     def on_set(self, unit, oldvalue):
         """Overridable hook for when this property is __set__."""
         pass
 
 
+class CompactProperties(object):
+    """A dict-like view of Unit property values which are kept in a list.
+    
+    Units of classes which set 'compact = True' hold one of these in
+    unit._properties instead of a dict. The values are kept in a list,
+    in the order given by the class' _property_index (a {key: position}
+    dict shared by all instances of the class), which takes far less
+    memory per unit than a dict. Keys which are not in the class layout
+    (for example, during a rename_property migration) are kept in an
+    overflow dict.
+    """
+    
+    __slots__ = ('_index', '_values', '_extra')
+    
+    def __init__(self, index, values, extra=None):
+        self._index = index
+        self._values = values
+        self._extra = extra
+    
+    def from_dict(cls, index, d, size=0):
+        """Return a CompactProperties instance for the given index and dict.
+        
+        size: the number of positions which the index has assigned
+            (the owning class' _property_next).
+        """
+        values = [None] * size
+        extra = None
+        for key, value in d.iteritems():
+            pos = index.get(key)
+            if pos is None:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+            else:
+                values[pos] = value
+        return cls(index, values, extra)
+    from_dict = classmethod(from_dict)
+    
+    def __getitem__(self, key):
+        pos = self._index.get(key)
+        if pos is None:
+            if self._extra is None:
+                raise KeyError(key)
+            return self._extra[key]
+        try:
+            return self._values[pos]
+        except IndexError:
+            # The property was added to the class after this unit was made.
+            return None
+    
+    def __setitem__(self, key, value):
+        pos = self._index.get(key)
+        if pos is None:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+        else:
+            values = self._values
+            if pos >= len(values):
+                values.extend([None] * (pos + 1 - len(values)))
+            values[pos] = value
+    
+    def __delitem__(self, key):
+        if self._extra is not None and key in self._extra:
+            del self._extra[key]
+        elif key in self._index:
+            # Positions are fixed by the class, so just clear the value.
+            self[key] = None
+        else:
+            raise KeyError(key)
+    
+    def __contains__(self, key):
+        return key in self._index or (self._extra is not None
+                                     and key in self._extra)
+    has_key = __contains__
+    
+    def __len__(self):
+        return len(self.keys())
+    
+    def __iter__(self):
+        return iter(self.keys())
+    
+    def __eq__(self, other):
+        if isinstance(other, CompactProperties):
+            other = other.copy()
+        return self.copy() == other
+    
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    
+    def __reduce__(self):
+        # Pickle as a plain dict, so pickles do not depend on the layout.
+        return (dict, (self.items(),))
+    
+    def __repr__(self):
+        return repr(self.copy())
+    
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+    
+    def keys(self):
+        keys = self._index.keys()
+        if self._extra:
+            keys.extend(self._extra.keys())
+        return keys
+    
+    def values(self):
+        return [self[k] for k in self.keys()]
+    
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+    
+    def iterkeys(self):
+        return iter(self.keys())
+    
+    def itervalues(self):
+        return iter(self.values())
+    
+    def iteritems(self):
+        return iter(self.items())
+    
+    def copy(self):
+        """Return a plain dict of these properties."""
+        return dict(self.items())
+    
+    def update(self, other):
+        for key, value in other.items():
+            self[key] = value
+
+
+class _CompactPropertiesSetter(object):
+    """Data descriptor which converts dicts assigned to unit._properties.
+    
+    This deliberately has no __get__ method, so that reading
+    unit._properties is a plain (fast) instance __dict__ lookup.
+    """
+    
+    def __set__(self, unit, value):
+        if not isinstance(value, CompactProperties):
+            value = CompactProperties.from_dict(unit._property_index, value,
+                                                unit._property_next)
+        unit.__dict__['_properties'] = value
+
+
 class MetaUnit(type):
     
     def __init__(cls, name, bases, dct):
@@ -514,6 +756,18 @@ class MetaUnit(type):
         cls.properties = props
         cls._associations = assocs
         
+        if getattr(cls, "compact", False):
+            if not isinstance(cls.__dict__.get("_properties"),
+                              _CompactPropertiesSetter):
+                cls._properties = _CompactPropertiesSetter()
+                cls._property_index = {}
+                cls._property_next = 0
+        elif isinstance(getattr(cls, "_properties", None),
+                        _CompactPropertiesSetter):
+            # A non-compact subclass of a compact class.
+            cls._properties = {}
+        cls._compile_properties()
+        
         # Keep backward compatibility from 1.4 to 1.5. See ticket #48.
         ident = dct.get('identifiers', ())
         if ident:
@@ -525,6 +779,173 @@ class MetaUnit(type):
                 newident.append(val)
             cls.identifiers = tuple(newident)
     
+    def _compile_properties(cls):
+        """Recompute per-class metadata which depends on cls.properties.
+        
+        This sets cls._hashed_properties (the keys which dirty() must hash),
+        cls._deferred_properties (the keys declared 'deferred'),
+        cls._indexed_properties (the keys declared 'index'),
+        and, for compact classes, cls._property_index. Positions in the
+        index never move or get reused once assigned (cls._property_next
+        is the next free one), so that units which already exist keep
+        working when properties are added or removed.
+        """
+        if getattr(cls, "track_changes", True):
+            keys = [k for k in cls.properties
+                    if getattr(getattr(cls, k, None), "mutable", False)]
+        else:
+            keys = list(cls.properties)
+        cls._hashed_properties = tuple(keys)
+        
+        cls._deferred_properties = tuple(
+            [k for k in cls.properties
+             if getattr(getattr(cls, k, None), "deferred", False)])
+        cls._indexed_properties = tuple(
+            [k for k in cls.properties
+             if getattr(getattr(cls, k, None), "index", False)])
+        
+        # Loaders are compiled from the current property set.
+        cls._loaders = {}
+        
+        if getattr(cls, "compact", False):
+            index = cls._property_index
+            for key in index.keys():
+                if key not in cls.properties:
+                    del index[key]
+            for key in cls.properties:
+                if key not in index:
+                    index[key] = cls._property_next
+                    cls._property_next += 1
+    
+    def _loader(cls, attrs=None, coerce=True, deferred=()):
+        """Return a function which forms clean units of cls from raw rows.
+        
+        attrs: a sequence of property names. The returned function takes
+            a single 'row' argument: either a sequence of values in the
+            same order as attrs, or a dict of {key: value} pairs. If None
+            (the default), cls.properties is used.
+        coerce: if True (the default), coerce each value to the type of
+            its UnitProperty, as StorageManagers MUST do when reading raw
+            values from storage. Pass False when the row values were
+            saved as fully-formed Python objects (e.g. pickles).
+        deferred: a sequence of property names which were not fetched.
+            Each unit will load these on first access (see Unit._undefer).
+        
+        Units produced by the loader are fully-populated (any properties
+        missing from the row are None), are not dirty, and are formed
+        without calling Unit.__init__ or UnitProperty.__set__. Subclasses
+        which override __init__ have it called in the '_zombie' fashion
+        (see Unit.__init__), and subclasses which override __setstate__
+        (but not __init__) have it called with a (properties, None) state,
+        as in Dejavu 1.x, so that any other state they set up is still
+        present. Coercion errors name the key and value at fault. The base
+        UnitProperty.coerce is inlined: values which are already of the
+        right type are not touched, and the Decimal quantizer for
+        hints['scale'] is computed once. Overridden coerce methods are
+        called as usual (with the new unit).
+        
+        Loaders are cached per class (and per attrs/coerce pair), and
+        are discarded whenever the set of properties changes.
+        """
+        if attrs is None:
+            attrs = cls.properties
+        attrs = tuple(attrs)
+        deferred = tuple(deferred)
+        
+        cachekey = (attrs, coerce, deferred)
+        try:
+            return cls._loaders[cachekey]
+        except KeyError:
+            pass
+        
+        template = dict.fromkeys(cls.properties)
+        
+        # Each coercer is a tuple of (key, type, quantizer, custom func).
+        coercers = []
+        if coerce:
+            basecoerce = UnitProperty.coerce.im_func
+            for key in attrs:
+                prop = getattr(cls, key)
+                propcoerce = prop.coerce
+                if not propcoerce:
+                    continue
+                if getattr(propcoerce, "im_func", None) is basecoerce:
+                    quantizer = None
+                    if decimal and prop.type is decimal:
+                        scale = prop.hints.get('scale', None)
+                        if scale:
+                            quantizer = decimal("." + ("0" * scale))
+                    coercers.append((key, prop.type, quantizer, None))
+                else:
+                    coercers.append((key, None, None, propcoerce))
+        
+        hashed = bool(cls._hashed_properties)
+        new = cls.__new__
+        custom_init = cls.__init__.im_func is not Unit.__init__.im_func
+        custom_setstate = (not custom_init and cls.__setstate__.im_func
+                           is not Unit.__setstate__.im_func)
+        
+        def load(row):
+            if isinstance(row, dict):
+                props = template.copy()
+                props.update(row)
+            else:
+                props = template.copy()
+                props.update(zip(attrs, row))
+            
+            unit = new(cls)
+            if custom_init:
+                unit._zombie = True
+                unit.__init__()
+            else:
+                unit.sandbox = None
+            if deferred:
+                unit._deferred = set(deferred)
+            
+            for key, selftype, quantizer, custom in coercers:
+                value = props[key]
+                try:
+                    if custom is not None:
+                        value = custom(unit, value)
+                    elif value is not None:
+                        if not isinstance(value, selftype):
+                            # Try to cast the value to selftype.
+                            try:
+                                value = selftype(value)
+                            except Exception, x:
+                                msg = ("%r is type %r (expected %r)" %
+                                       (value, type(value), selftype))
+                                x.args += (msg,)
+                                raise
+                        if quantizer is not None:
+                            value = value.quantize(quantizer)
+                except UnicodeDecodeError, x:
+                    x.reason += " [%r: %r]" % (key, value)
+                    raise
+                except Exception, x:
+                    x.args += (key, value)
+                    raise
+                props[key] = value
+            
+            if custom_setstate:
+                # Overrides were written for the (properties, hash) state.
+                unit.__setstate__((props, None))
+            else:
+                unit._properties = props
+            if custom_init or custom_setstate:
+                # Discard any changes which __init__ or __setstate__ made.
+                unit._changed = None
+            if hashed:
+                unit._initial_property_hash = unit._property_hash()
+            return unit
+        
+        cls._loaders[cachekey] = load
+        return load
+    
+    def _from_row(cls, row, attrs=None, coerce=True, deferred=()):
+        """Return a clean unit of cls for the given row (see _loader)."""
+        return cls._loader(attrs, coerce, deferred)(row)
+    
     def __lshift__(self, other):
         if isinstance(other, (MetaUnit, UnitJoin)):
             return UnitJoin(self, other, leftbiased=True)
@@ -585,6 +1006,23 @@ class Unit(object):
         which have not been modified. Because SM's may cache Units, no code
         should set this flag other than UnitProperty.__set__ and SM's.
     
+    track_changes: if True (the default), UnitProperty.__set__ records
+        the key of each modified property, so that dirty() and cleanse()
+        need not pickle the whole _properties dict; only properties which
+        are declared 'mutable' are hashed. Set this to False for classes
+        whose code writes to unit._properties directly, to make dirty()
+        hash every property (as in Dejavu 1.x).
+    
+    compact: if True, each unit keeps its property values in a list
+        (see CompactProperties) instead of a dict, which greatly reduces
+        resident memory when many units are held at once. Access through
+        UnitProperty descriptors and unit._properties works as usual,
+        although it is slightly slower. The default is False.
+    
+    _deferred: None, or the set of keys of deferred UnitProperties whose
+        values have not yet been loaded from storage. Until they are,
+        unit._properties holds None for those keys.
+    
     ID: the default ID type is int. If you wish to use a different type for
         the ID's of a subclass of Unit, just overwrite ID. For example:
             ID = UnitProperty(unicode, index=True)
@@ -596,6 +1034,11 @@ class Unit(object):
     _properties = {}
     _zombie = False
     _associations = {}
+    _initial_property_hash = None
+    _changed = None
+    _deferred = None
+    track_changes = True
+    compact = False
     
     ID = UnitProperty(int, index=True)
     sequencer = UnitSequencerInteger()
@@ -644,6 +1087,8 @@ class Unit(object):
         self.sandbox.forget(self)
     
     def __copy__(self):
+        if self._deferred:
+            self._undefer(*self._deferred)
         newUnit = self.__class__()
         for key in self.properties:
             if key in self.identifiers:
@@ -651,17 +1096,39 @@ class Unit(object):
                 newUnit._properties[key] = prop.default
             else:
                 newUnit._properties[key] = self._properties[key]
+                newUnit._mark_changed(key)
         newUnit.sandbox = None
         return newUnit
     
     #                        Pickle data                         #
     
     def __getstate__(self):
-        return (self._properties, self._initial_property_hash)
+        if self._deferred:
+            self._undefer(*self._deferred)
+        return (self._properties, self._initial_property_hash,
+                tuple(self._changed or ()))
     
     def __setstate__(self, state):
         self.sandbox = None
-        self._properties, self._initial_property_hash = state
+        if len(state) == 2:
+            # Units pickled before track_changes was added. Their hash
+            # covers the whole _properties dict; if that no longer matches,
+            # the unit was dirty when pickled, and we can't tell which
+            # properties changed.
+            self._properties, oldhash = state
+            data = self._properties
+            if isinstance(data, CompactProperties):
+                data = data.copy()
+            if oldhash != sha(pickle.dumps(data)).digest():
+                self._changed = set(data.keys())
+            if self._hashed_properties:
+                self._initial_property_hash = self._property_hash()
+            else:
+                self._initial_property_hash = None
+        else:
+            self._properties, self._initial_property_hash, changed = state
+            if changed:
+                self._changed = set(changed)
     
     
     #                         Properties                         #
@@ -674,18 +1141,80 @@ class Unit(object):
     def _property_hash(self):
         """Return a hash() of this Unit's properties (for use with dirty)."""
         try:
-            return sha(pickle.dumps(self._properties)).digest()
+            if self.track_changes:
+                # Only hash the values which __set__ cannot track.
+                props = self._properties
+                data = [props.get(k) for k in self._hashed_properties]
+            else:
+                data = self._properties
+                if isinstance(data, CompactProperties):
+                    data = data.copy()
+            return sha(pickle.dumps(data)).digest()
         except TypeError, x:
             x.args += (self.__class__.__name__, self._properties.keys())
             raise
     
     def dirty(self):
         """If this Unit's properties have been modified, return True."""
-        return self._initial_property_hash != self._property_hash()
+        if self._changed:
+            return True
+        if self._hashed_properties:
+            return self._initial_property_hash != self._property_hash()
+        return False
+    
+    def changed(self):
+        """Return a set of the keys of properties which have been modified.
+        
+        Properties which are hashed (see UnitProperty.mutable) cannot be
+        told apart; if their hash has changed, all of them are included.
+        """
+        keys = set(self._changed or ())
+        if (self._hashed_properties and
+            self._initial_property_hash != self._property_hash()):
+            keys.update(self._hashed_properties)
+        return keys
+    
+    def _mark_changed(self, key):
+        """Record that the named property has been modified."""
+        if self._changed is None:
+            # Create the set lazily; most recalled units are never modified.
+            self._changed = set([key])
+        else:
+            self._changed.add(key)
     
     def cleanse(self):
         """Reset this Unit's 'dirty' flag to False."""
-        self._initial_property_hash = self._property_hash()
+        if self._changed:
+            self._changed = None
+        if self._hashed_properties:
+            self._initial_property_hash = self._property_hash()
+    
+    def _undefer(self, *keys):
+        """Load the values of the given deferred properties from storage."""
+        if self.sandbox is None:
+            raise errors.UnrecallableError(
+                "The deferred properties %r of %r cannot be loaded "
+                "outside of a sandbox." % (keys, self))
+        self.sandbox.undefer(self.__class__, keys, [self])
+    
+    def _set_deferred(self, values):
+        """Set the given {key: value} pairs of deferred properties.
+        
+        Storage Managers call this from undefer() with values (already
+        coerced) which they have loaded. Since these values were present
+        in storage all along, this does not dirty the unit.
+        """
+        wasdirty = self.dirty()
+        props = self._properties
+        deferred = self._deferred
+        for key, value in values.iteritems():
+            props[key] = value
+            if deferred:
+                deferred.discard(key)
+        if not deferred:
+            self._deferred = None
+        if not wasdirty:
+            self.cleanse()
     
     def set_property(cls, key, type=unicode, index=False,
                      descriptor=UnitProperty):
@@ -694,6 +1223,7 @@ class Unit(object):
         setattr(cls, key, prop)
         if key not in cls.properties:
             cls.properties.append(key)
+        cls._compile_properties()
         return prop
     set_property = classmethod(set_property)
     
@@ -707,6 +1237,7 @@ class Unit(object):
         """Remove the specified property from this Unit class."""
         delattr(cls, key)
         cls.properties.remove(key)
+        cls._compile_properties()
     remove_property = classmethod(remove_property)
     
     def indices(cls):
@@ -738,6 +1269,11 @@ class Unit(object):
     
     def associate(nearClass, nearKey, farClass, farKey, nearDescriptor, farDescriptor):
         """Set UnitAssociations between nearClass.key and farClass.farKey."""
+        for cls, key in ((nearClass, nearKey), (farClass, farKey)):
+            prop = getattr(cls, key, None)
+            if isinstance(prop, UnitProperty):
+                prop.association_key = True
+        
         # Mangle this class first
         farClassName = farClass.__name__
         descriptor = nearDescriptor(nearKey, farClass, farKey)